@@ -1,15 +1,34 @@
 # ============================================================
 # app.py — 完全自包含版本，不依赖 route_optimizer.py
 # ============================================================
-from flask import Flask, jsonify, render_template, request, send_file
+from flask import Flask, Response, jsonify, render_template, request, send_file
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-import json, os, io, urllib.parse, threading
-from datetime import datetime
+import json, os, io, urllib.parse, threading, hashlib, sqlite3, time, math, uuid, functools, random
+import contextlib, csv, tempfile
+try:
+    import fcntl          # 调度 leader 文件锁（仅 POSIX）
+except ImportError:
+    fcntl = None
+from typing import NamedTuple
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import numpy as np
 import pandas as pd
 import requests as http_requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import deque
 import openpyxl
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+try:
+    import pyarrow as pa              # Parquet 导出（可选依赖）
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 app = Flask(__name__)
 
@@ -17,17 +36,120 @@ app = Flask(__name__)
 WAREHOUSE_COORD = "59.8542194,17.6650221"
 DRIVERS        = ["Abbe", "Saman", "Sarkis", "Cornelia", "Pawlos"]
 
-STATE_FILE  = "last_results.json"
+STATE_FILE  = "last_results.json"   # 生成后导出的 JSON 快照；首次启动时导入状态库
 PHONES_FILE  = "driver_phones.json"
 EMAILS_FILE  = "driver_emails.json"
 EMAIL_CONFIG_FILE = "email_config.json"
 
+# 距离矩阵来源（MATRIX_PROVIDER）：
+#   osrm      — OSRM table 服务，OSRM_BASE_URL 默认公共服务器，可指向自建实例
+#   file      — 预计算矩阵文件 MATRIX_FILE（JSON）
+#   haversine — 本地直线距离估算，不访问网络
+MATRIX_PROVIDER = os.environ.get("MATRIX_PROVIDER", "osrm").strip().lower()
+OSRM_BASE_URL   = os.environ.get("OSRM_BASE_URL", "https://router.project-osrm.org").rstrip("/")
+MATRIX_FILE     = os.environ.get("MATRIX_FILE", "matrix.json")
+# Haversine 估算参数：直线距离 × 绕行系数，按平均车速换算时间
+HAVERSINE_DETOUR    = float(os.environ.get("HAVERSINE_DETOUR", "1.35"))
+HAVERSINE_SPEED_KMH = float(os.environ.get("HAVERSINE_SPEED_KMH", "35"))
+# 单次 table 请求最多携带的坐标数（公共 OSRM 上限约 100），超出时分块并发请求
+OSRM_MAX_TABLE_COORDS = int(os.environ.get("OSRM_MAX_TABLE_COORDS", "100"))
+OSRM_TILE_WORKERS     = int(os.environ.get("OSRM_TILE_WORKERS", "4"))
+# OSRM 请求超时与传输层重试（连接错误、429 / 5xx，按 Retry-After / 指数退避）
+OSRM_TIMEOUT_SEC = float(os.environ.get("OSRM_TIMEOUT_SEC", "30"))
+OSRM_RETRIES     = int(os.environ.get("OSRM_RETRIES", "2"))
+# 所有外部 HTTP 请求的建连超时
+HTTP_CONNECT_TIMEOUT_SEC = float(os.environ.get("HTTP_CONNECT_TIMEOUT_SEC", "5"))
+# 生成时先为全部司机的门店构建一张去重的整车队矩阵，再按司机切片（0 = 每个司机单独请求）
+FLEET_MATRIX = os.environ.get("FLEET_MATRIX", "1") != "0"
+# 并行求解的进程数（1 = 顺序执行）。OR-Tools 回调持有 GIL，线程无法并行，因此用进程池。
+SOLVE_WORKERS = int(os.environ.get("SOLVE_WORKERS", "1"))
+
+# OR-Tools 求解预算：时间上限 = base + per_node × 节点数（不超过 max），真正生效的停止条件
+# 按“解的个数”计，与 CPU 负载无关（同一矩阵无论与多少进程 / 线程争用 CPU，路线都相同）：
+#   solution_limit — 按实测 GLS 吞吐量换算：时间上限 / SOLVER_SAFETY_FACTOR 内能产生的解数，
+#                    正常负载下远早于时间上限结束，时间上限只在机器严重过载时才会触发；
+#   stall          — 连续这么多个解没有改进时提前停止（绝对数，不随节点数放大）。
+#   batch       — 每日 / 手动生成，大路线可以多花时间
+#   interactive — 交互式冷启动求解，要求亚秒级响应
+#   warm        — /api/reorder 以当前顺序为初始解，只做短时间改进
+#   fleet       — 整车队 VRP（/api/fleet/rebalance），所有门店一起重新分配
+# 节点数 ≤ SOLVER_SMALL_NODES 的小路线只做局部下降（毫秒级完成）。
+SOLVER_PROFILES = {
+    "batch": {
+        "base_ms":     1000,
+        "per_node_ms": 200,
+        "max_ms":      int(float(os.environ.get("SOLVER_BATCH_MAX_SEC", "20")) * 1000),
+        "stall":       int(os.environ.get("SOLVER_BATCH_STALL", "1000")),
+    },
+    "interactive": {
+        "base_ms":     150,
+        "per_node_ms": 20,
+        "max_ms":      int(os.environ.get("SOLVER_INTERACTIVE_MAX_MS", "800")),
+        "stall":       int(os.environ.get("SOLVER_INTERACTIVE_STALL", "200")),
+    },
+    "warm": {
+        "base_ms":     50,
+        "per_node_ms": 10,
+        "max_ms":      int(os.environ.get("SOLVER_WARM_MAX_MS", "400")),
+        "stall":       int(os.environ.get("SOLVER_WARM_STALL", "100")),
+    },
+    "fleet": {
+        "base_ms":     2000,
+        "per_node_ms": 100,
+        "max_ms":      int(float(os.environ.get("SOLVER_FLEET_MAX_SEC", "30")) * 1000),
+        "stall":       int(os.environ.get("SOLVER_FLEET_STALL", "1000")),
+    },
+}
+SOLVER_SMALL_NODES = 8
+# 单线程 GLS 吞吐量（实测，TSP、RegisterTransitMatrix）：每毫秒约 SOLVER_GLS_RATE / n^1.8 个解，
+# 取实测下限：10 个节点约 5 个/ms，40 个约 0.4 个/ms，80 个约 0.1 个/ms
+SOLVER_GLS_RATE      = 300
+SOLVER_GLS_EXPONENT  = 1.8
+# 解数只按时间上限的 1/3 换算：与另外两个进程争用同一核时仍在时间上限内按解数结束
+SOLVER_SAFETY_FACTOR = 3
+# 车队 VRP 最小化最长路线（makespan）时，最长路线每秒的额外成本权重
+FLEET_SPAN_COEFF = int(os.environ.get("FLEET_SPAN_COEFF", "100"))
+
+# TSP 引擎：ortools（默认）| local（内置 NumPy 局部搜索，不依赖 OR-Tools）
+TSP_ENGINE = os.environ.get("TSP_ENGINE", "ortools").strip().lower()
+# 局部搜索只考虑新弧终点在 K 近邻中的移动
+LOCAL_SEARCH_NEIGHBOURS = 12
+# 求解指标中附带贪心基线对比（额外计算一次最近邻路线，默认关闭）
+SOLVER_METRICS = os.environ.get("SOLVER_METRICS", "0") == "1"
+
+# OSRM 距离矩阵持久化缓存（按坐标对存储，过期后重新请求）
+MATRIX_CACHE_FILE = os.environ.get("MATRIX_CACHE_FILE", "matrix_cache.sqlite3")
+MATRIX_CACHE_TTL  = float(os.environ.get("MATRIX_CACHE_TTL_DAYS", "7")) * 86400
+
+# 状态库（SQLite）：每个司机的结果一行，reorder 只改写对应司机；
+# 多 worker 部署时也是各进程共享的状态（结果、版本号、running 标记、生成任务）
+STATE_DB_FILE = os.environ.get("STATE_DB_FILE", "state.sqlite3")
+# 生成任务登记超过该时长仍未结束（进程崩溃等）视为失效，允许重新生成
+GENERATE_STALE_SEC = int(os.environ.get("GENERATE_STALE_SEC", "1800"))
+
+# 历史归档（SQLite）：每次生成 / reorder 后追加每个司机的路线和停靠点，供容量规划查询
+HISTORY_DB_FILE = os.environ.get("HISTORY_DB_FILE", "history.sqlite3")
+
+# 多 worker 时只有拿到该文件锁的进程运行定时任务；其他进程定期重试接管
+SCHEDULER_LOCK_FILE = os.environ.get("SCHEDULER_LOCK_FILE", "scheduler.lock")
+LEADER_RETRY_SEC    = 30
+
+# 邮件发送（Resend API）：后台线程池限流并发发送，429 / 5xx / 网络错误按指数退避重试。
+# EMAIL_API_URL 可指向本地 fake_resend.py 调试
+EMAIL_API_URL      = os.environ.get("EMAIL_API_URL", "https://api.resend.com").rstrip("/")
+EMAIL_WORKERS      = int(os.environ.get("EMAIL_WORKERS", "4"))
+EMAIL_TIMEOUT_SEC  = float(os.environ.get("EMAIL_TIMEOUT_SEC", "15"))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get("EMAIL_MAX_ATTEMPTS", "5"))
+EMAIL_BACKOFF_SEC  = float(os.environ.get("EMAIL_BACKOFF_SEC", "1"))
+EMAIL_BATCH_SIZE   = 100     # Resend /emails/batch 单次最多 100 封
+
 state = {
     "results": {},
     "generated_at": None,
     "schedule_hour": 7,
     "schedule_minute": 0,
     "running": False,
+    "job_id": None,          # 正在运行的生成任务（可能在其他 worker 中）
 }
 driver_phones  = {d: "" for d in DRIVERS}
 driver_emails  = {
@@ -39,17 +161,164 @@ email_config   = {
     "api_key": os.environ.get("RESEND_API_KEY", ""),
 }
 scheduler = BackgroundScheduler()
+# 调度 leader：fh = 持有的锁文件，schedule = 已装载到调度器的 (hour, minute)
+_leader = {"fh": None, "schedule": None}
+
+# /api/status 版本号：任何影响其内容的修改都递增 version，结果变化的司机记录当时的版本。
+# 版本号存放在状态库中由所有 worker 共享，取 max(旧值 + 1, 当前毫秒时间戳)，
+# 即使状态库重建也单调增加，旧的 since / ETag 自然失效。本地副本由 sync_state() 刷新。
+_status_version = {"version": 0, "drivers": {}}
+_status_version_lock = threading.Lock()
+
+# summary 视图中每个司机保留的字段（不含 store_objects / urls / 门店列表）
+STATUS_SUMMARY_FIELDS = ("status", "store_count", "duration", "duration_sec",
+                         "distance", "unmatched_count", "error")
+
+# 坐标索引缓存：坐标文件 mtime / 内容哈希未变化时直接复用，避免重复解析 Excel
+_coord_cache = {
+    "path":       None,
+    "mtime_ns":   None,
+    "size":       None,
+    "sha1":       None,
+    "coord_dict": None,
+    "hits":       0,
+    "misses":     0,
+}
+_coord_cache_lock = threading.Lock()
 
+_matrix_file_cache = {"mtime_ns": None, "index": None, "durations": None, "distances": None}
 
-# ── 持久化 ──────────────────────────────────────────────────
-def load_state():
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            saved = json.load(f)
-            state["results"]         = saved.get("results", {})
-            state["generated_at"]    = saved.get("generated_at")
-            state["schedule_hour"]   = saved.get("schedule_hour", 7)
-            state["schedule_minute"] = saved.get("schedule_minute", 0)
+_baseline_cache = {}   # 矩阵指纹 → 贪心基线成本（每个矩阵只算一次）
+
+# 最近一次生成的整车队矩阵 + reorder 时按司机补建的矩阵（结构同 build_fleet_matrix），
+# 交互式 reorder 直接切片复用，不再重新请求矩阵。只属于 generated_at 这一次生成，
+# 通过 _route_memo() 访问（见其说明）；pending 表示本进程正在生成、generated_at 尚未确定
+_route_matrix_memo = {"generated_at": None, "pending": False, "fleet": None, "drivers": {}}
+
+_matrix_cache_stats = {"hits": 0, "misses": 0, "fetches": 0, "last_evict": 0.0}
+_matrix_cache_lock  = threading.Lock()
+
+
+# ── 状态持久化 ───────────────────────────────────────────────
+# results 表：driver → 结果 JSON（紧凑格式），meta 表：generated_at / 定时设置。
+# 每次写入都在一个事务内完成，进程中途崩溃不会留下写了一半的状态；
+# reorder 只改写一个司机的行（不碰 meta），写入量与改动量成正比，与车队规模无关。
+_STATE_META_KEYS = ("generated_at", "schedule_hour", "schedule_minute")
+
+
+def init_state_db():
+    """启动时建表一次；WAL 模式记录在数据库文件中，之后的连接无需再设置。"""
+    conn = sqlite3.connect(STATE_DB_FILE, timeout=10)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " driver TEXT PRIMARY KEY, result TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, created REAL NOT NULL, job TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS deliveries ("
+            " driver TEXT PRIMARY KEY, delivery TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+    finally:
+        conn.close()
+
+
+def _state_db_connect():
+    return sqlite3.connect(STATE_DB_FILE, timeout=10)
+
+
+@contextlib.contextmanager
+def _state_db_write():
+    """BEGIN IMMEDIATE 事务：先拿写锁再读，读-改-写在多个 worker 之间也是原子的。"""
+    conn = _state_db_connect()
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def _meta_get(conn, key, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+
+def _meta_set(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                 (key, json.dumps(value)))
+
+
+def _write_json_atomic(path, data, **dump_kwargs):
+    """
+    先写同目录临时文件再 os.replace，读者只会看到旧文件或完整的新文件。
+    临时文件名唯一（mkstemp），多个 worker 同时保存时不会互相截断对方的临时文件。
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                               prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, 0o644)          # mkstemp 默认 0600
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+def _apply_saved_state(saved):
+    state["results"]         = saved.get("results", {})
+    state["generated_at"]    = saved.get("generated_at")
+    state["schedule_hour"]   = saved.get("schedule_hour", 7)
+    state["schedule_minute"] = saved.get("schedule_minute", 0)
+
+
+def _read_state_db():
+    """读取状态库，返回 (results, meta)。"""
+    conn = _state_db_connect()
+    try:
+        results = {d: json.loads(r) for d, r in
+                   conn.execute("SELECT driver, result FROM results")}
+        meta = {k: json.loads(v) for k, v in
+                conn.execute("SELECT key, value FROM meta")}
+    finally:
+        conn.close()
+    return results, meta
+
+
+def _running_job_id(meta):
+    """meta 中登记且未过期的生成任务 id。"""
+    running = meta.get("running")
+    if running and time.time() - running["at"] < GENERATE_STALE_SEC:
+        return running["job"]
+    return None
+
+
+def _apply_state_db(results, meta):
+    _apply_saved_state({**meta, "results": results})
+    state["job_id"]  = _running_job_id(meta)
+    state["running"] = bool(state["job_id"])
+    with _status_version_lock:
+        _status_version["version"] = meta.get("status_version", 0)
+        _status_version["drivers"] = meta.get("driver_versions", {})
+
+
+def _load_side_files():
     if os.path.exists(PHONES_FILE):
         with open(PHONES_FILE, "r", encoding="utf-8") as f:
             driver_phones.update(json.load(f))
@@ -67,55 +336,330 @@ def load_state():
             if os.environ.get("RESEND_API_KEY"):
                 email_config["api_key"] = os.environ["RESEND_API_KEY"]
 
-def save_state():
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump({
-            "results":         state["results"],
-            "generated_at":    state["generated_at"],
-            "schedule_hour":   state["schedule_hour"],
-            "schedule_minute": state["schedule_minute"],
-        }, f, ensure_ascii=False, indent=2)
+
+def load_state():
+    loaded = False
+    try:
+        init_state_db()
+        results, meta = _read_state_db()
+        if results or meta:
+            _apply_state_db(results, meta)
+            loaded = True
+    except sqlite3.Error as e:
+        print(f"[STATE] ✗ 读取状态库失败: {e}")
+    if not loaded and os.path.exists(STATE_FILE):
+        # 首次启动：从旧的 JSON 文件导入
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            _apply_saved_state(json.load(f))
+        print(f"[STATE] 从 {STATE_FILE} 导入 {len(state['results'])} 个司机的结果")
+        save_state(meta=_STATE_META_KEYS)
+        bump_status_version(list(state["results"]))
+    _load_side_files()
+
+
+def sync_state():
+    """
+    其他 worker 修改过状态（状态库中的版本号与本地不同）时重新加载到本进程。
+    每个请求前调用，版本未变时只读一行 meta。leader 顺带装载新的定时设置。
+    """
+    try:
+        conn = _state_db_connect()
+        try:
+            version = _meta_get(conn, "status_version", 0)
+        finally:
+            conn.close()
+        if version == _status_version["version"]:
+            return
+        _apply_state_db(*_read_state_db())
+    except sqlite3.Error as e:
+        print(f"[STATE] ✗ 同步状态库失败: {e}")
+        return
+    _load_side_files()
+    apply_schedule()
+
+def save_state(drivers=None, meta=()):
+    """
+    写入状态库：drivers 为要写入结果的司机（None = 全部，() = 不写结果），
+    meta 为要写入的 meta 键（_STATE_META_KEYS 的子集，默认不写）。
+    只写调用方真正修改过的内容：本进程的其他 meta 可能已被别的 worker 更新，
+    整体写回会覆盖掉它们（例如 reorder 把旧的定时设置写回）。
+    全部写入时同时删除已不在 state["results"] 中的司机。
+    """
+    names = list(state["results"]) if drivers is None else list(drivers)
+    now   = time.time()
+    try:
+        conn = _state_db_connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [(k, json.dumps(state[k])) for k in meta],
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO results (driver, result, updated_at) VALUES (?, ?, ?)",
+                    [(d, json.dumps(state["results"][d], ensure_ascii=False, separators=(",", ":")), now)
+                     for d in names if d in state["results"]],
+                )
+                if drivers is None:
+                    stale = [d for (d,) in conn.execute("SELECT driver FROM results")
+                             if d not in state["results"]]
+                    conn.executemany("DELETE FROM results WHERE driver = ?",
+                                     [(d,) for d in stale])
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[STATE] ✗ 写入状态库失败: {e}")
+
+def export_state_json():
+    """整份结果导出为 JSON 快照（只在生成完成后调用），原子替换。"""
+    _write_json_atomic(STATE_FILE, {
+        "results":         state["results"],
+        "generated_at":    state["generated_at"],
+        "schedule_hour":   state["schedule_hour"],
+        "schedule_minute": state["schedule_minute"],
+    }, indent=2)
+
+def bump_status_version(drivers=()):
+    """状态有变化时调用；drivers 为结果发生变化的司机。返回新版本号。"""
+    with _status_version_lock:
+        with _state_db_write() as conn:
+            version = max(_meta_get(conn, "status_version", 0) + 1, int(time.time() * 1000))
+            driver_versions = _meta_get(conn, "driver_versions", {})
+            for d in drivers:
+                driver_versions[d] = version
+            _meta_set(conn, "status_version", version)
+            _meta_set(conn, "driver_versions", driver_versions)
+        _status_version["version"] = version
+        _status_version["drivers"] = driver_versions
+        return version
+
+
+def _claim_running(job_id):
+    """
+    在状态库登记正在运行的生成任务，保证所有 worker 中同时只有一个生成。
+    登记成功返回 None；已有未过期的任务时返回该任务 id。
+    """
+    with _state_db_write() as conn:
+        busy = _running_job_id({"running": _meta_get(conn, "running")})
+        if busy:
+            return busy
+        _meta_set(conn, "running", {"job": job_id, "at": time.time(), "pid": os.getpid()})
+    state["running"], state["job_id"] = True, job_id
+    return None
+
+
+def _release_running(job_id):
+    with _state_db_write() as conn:
+        running = _meta_get(conn, "running")
+        if running and running["job"] == job_id:
+            _meta_set(conn, "running", None)
+    state["running"], state["job_id"] = False, None
 
 def save_phones():
-    with open(PHONES_FILE, "w", encoding="utf-8") as f:
-        json.dump(driver_phones, f, ensure_ascii=False, indent=2)
+    _write_json_atomic(PHONES_FILE, driver_phones, indent=2)
 
 def save_emails():
-    with open(EMAILS_FILE, "w", encoding="utf-8") as f:
-        json.dump(driver_emails, f, ensure_ascii=False, indent=2)
+    _write_json_atomic(EMAILS_FILE, driver_emails, indent=2)
 
 def save_email_config():
     # api_key 仅通过环境变量管理，不写入文件
-    with open(EMAIL_CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump({"sender": email_config.get("sender", "")},
-                  f, ensure_ascii=False, indent=2)
+    _write_json_atomic(EMAIL_CONFIG_FILE, {"sender": email_config.get("sender", "")}, indent=2)
+
+
+# ── 外部 HTTP 客户端 ─────────────────────────────────────────
+# 每个上游（OSRM / 邮件 API）一个共享 Session：连接池复用 keep-alive 连接，
+# 省去每次请求的 TCP + TLS 握手；pool_block 让并发连接数不超过 pool_size。
+# 幂等的 GET 由 urllib3 Retry 在传输层重试；邮件 POST 不在这里重试，
+# 由发送队列自己退避（需要记录 retrying 状态，且 POST 重试可能重复发信）。
+# 每个上游按进程统计请求数、错误、重试次数和耗时（/api/http/stats）。
+HTTP_UPSTREAMS = {
+    "osrm": {
+        "base_url":  OSRM_BASE_URL,
+        "timeout":   (HTTP_CONNECT_TIMEOUT_SEC, OSRM_TIMEOUT_SEC),
+        "retries":   OSRM_RETRIES,
+        "pool_size": max(OSRM_TILE_WORKERS, 4),
+    },
+    "email": {
+        "base_url":  EMAIL_API_URL,
+        "timeout":   (HTTP_CONNECT_TIMEOUT_SEC, EMAIL_TIMEOUT_SEC),
+        "retries":   0,
+        "pool_size": EMAIL_WORKERS,
+    },
+}
+HTTP_LATENCY_WINDOW = 500        # 每个上游保留最近多少次请求的耗时用于分位数
+
+_http_sessions = {}
+_http_metrics  = {}
+_http_lock     = threading.Lock()
+
+
+def _http_session(upstream):
+    # 按 pid 区分：子进程不能复用父进程连接池里的 socket
+    key = (upstream, os.getpid())
+    with _http_lock:
+        session = _http_sessions.get(key)
+        if session is None:
+            cfg = HTTP_UPSTREAMS[upstream]
+            retry = Retry(
+                total=cfg["retries"], backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",),
+                respect_retry_after_header=True, raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cfg["pool_size"],
+                                  pool_block=True, max_retries=retry)
+            session = http_requests.Session()
+            session.mount("http://",  adapter)
+            session.mount("https://", adapter)
+            _http_sessions[key] = session
+        return session
+
+
+def _http_record(upstream, elapsed_ms, error=None, retries=0):
+    with _http_lock:
+        m = _http_metrics.setdefault(upstream, {
+            "requests": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "error_kinds": {}, "last_error": None, "recent_ms": deque(maxlen=HTTP_LATENCY_WINDOW),
+        })
+        m["requests"] += 1
+        m["retries"]  += retries
+        m["total_ms"] += elapsed_ms
+        m["max_ms"]    = max(m["max_ms"], elapsed_ms)
+        m["recent_ms"].append(elapsed_ms)
+        if error:
+            m["errors"] += 1
+            m["error_kinds"][error] = m["error_kinds"].get(error, 0) + 1
+            m["last_error"] = {"error": error, "at": time.time()}
+
+
+def http_request(upstream, method, path, **kwargs):
+    """
+    通过 upstream 的共享 Session 请求 base_url + path，返回 requests.Response。
+    HTTP 错误码照常返回（计入错误统计），网络异常记录后原样抛出。
+    """
+    cfg = HTTP_UPSTREAMS[upstream]
+    kwargs.setdefault("timeout", cfg["timeout"])
+    t0 = time.perf_counter()
+    try:
+        resp = _http_session(upstream).request(method, cfg["base_url"] + path, **kwargs)
+    except http_requests.RequestException as e:
+        _http_record(upstream, (time.perf_counter() - t0) * 1000, error=type(e).__name__)
+        raise
+    history = getattr(getattr(resp.raw, "retries", None), "history", ()) or ()
+    _http_record(upstream, (time.perf_counter() - t0) * 1000,
+                 error=f"HTTP {resp.status_code}" if resp.status_code >= 400 else None,
+                 retries=len(history))
+    return resp
+
+
+def http_stats():
+    out = {}
+    with _http_lock:
+        for upstream, m in _http_metrics.items():
+            recent = sorted(m["recent_ms"])
+            pct = lambda q: round(recent[min(len(recent) - 1, int(q * len(recent)))], 1)
+            out[upstream] = {
+                "requests":    m["requests"],
+                "errors":      m["errors"],
+                "error_rate":  round(m["errors"] / m["requests"], 4),
+                "retries":     m["retries"],
+                "avg_ms":      round(m["total_ms"] / m["requests"], 1),
+                "p50_ms":      pct(0.50),
+                "p95_ms":      pct(0.95),
+                "max_ms":      round(m["max_ms"], 1),
+                "error_kinds": dict(m["error_kinds"]),
+                "last_error":  m["last_error"],
+            }
+    return out
 
 
 # ── 核心逻辑 ─────────────────────────────────────────────────
-def load_and_merge_data(driver_name):
-    coords_file = 'coords.xlsx' if os.path.exists('coords.xlsx') else 'coords.csv'
-    try:
-        df_coords = pd.read_excel(coords_file, engine='openpyxl')
-    except Exception as e:
-        return [], f"读取坐标文件失败: {e}"
+class Store(NamedTuple):
+    """
+    门店 / 仓库记录。坐标在加载时校验并解析为 float，之后的矩阵、求解等
+    热路径直接使用数值；JSON 形态（坐标为字符串的 dict）只在 API / 状态边界
+    通过 to_dict() 生成。
+    """
+    name: str
+    lat:  float
+    lng:  float
+
+    @classmethod
+    def parse(cls, name, lat, lng):
+        """校验坐标并构造记录；坐标缺失或非法（空串、nan、None）时返回 None。"""
+        try:
+            lat, lng = float(lat), float(lng)
+        except (TypeError, ValueError):
+            return None
+        if not (math.isfinite(lat) and math.isfinite(lng)):
+            return None
+        return cls(str(name).strip(), lat, lng)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls.parse(d.get("name", ""), d.get("lat"), d.get("lng"))
+
+    def to_dict(self):
+        return {"name": self.name, "lat": str(self.lat), "lng": str(self.lng)}
+
+
+WAREHOUSE = Store.parse("Lager (Uppsala)", *WAREHOUSE_COORD.split(','))
+
 
+def _source_file(stem):
+    """优先读取 .xlsx，不存在时读取同名 .csv（实际也是 xlsx 格式）。"""
+    return f'{stem}.xlsx' if os.path.exists(f'{stem}.xlsx') else f'{stem}.csv'
+
+
+def _parse_coord_dict(df):
+    """从原始坐标表 DataFrame 构建 match_name -> {Latitude, Longitude}。"""
     header_row_idx = 0
-    for i in range(min(15, len(df_coords))):
-        if any('namn' in str(v).lower() for v in df_coords.iloc[i].tolist()):
+    for i in range(min(15, len(df))):
+        if any('namn' in str(v).lower() for v in df.iloc[i].tolist()):
             header_row_idx = i
             break
-    df_coords.columns = df_coords.iloc[header_row_idx]
-    df_coords = df_coords.iloc[header_row_idx+1:].reset_index(drop=True).iloc[:, :3]
-    df_coords.columns = ['Namn', 'Latitude', 'Longitude']
-    df_coords['match_name'] = df_coords['Namn'].astype(str).str.strip().str.lower()
-    df_coords = df_coords.drop_duplicates(subset=['match_name'], keep='first')
-    coord_dict = df_coords.set_index('match_name')[['Latitude', 'Longitude']].to_dict('index')
-
-    routes_file = 'routes.xlsx' if os.path.exists('routes.xlsx') else 'routes.csv'
+    df.columns = df.iloc[header_row_idx]
+    df = df.iloc[header_row_idx+1:].reset_index(drop=True).iloc[:, :3]
+    df.columns = ['Namn', 'Latitude', 'Longitude']
+    df['match_name'] = df['Namn'].astype(str).str.strip().str.lower()
+    df = df.drop_duplicates(subset=['match_name'], keep='first')
+    return df.set_index('match_name')[['Latitude', 'Longitude']].to_dict('index')
+
+
+def load_workbook_snapshot():
+    """
+    一次性读取坐标表和路线表，返回供所有司机共享的内存快照。
+    run_all_drivers 每次生成只调用一次，避免每个司机重复解析 Excel。
+
+    返回 dict: coord_dict, df_routes, error（读取失败时为错误信息，否则 None）。
+    """
+    snapshot = {"coord_dict": {}, "df_routes": None, "error": None}
     try:
-        df_routes = pd.read_excel(routes_file, engine='openpyxl')
+        snapshot["coord_dict"] = get_coord_dict()
     except Exception as e:
-        return [], f"读取路线文件失败: {e}"
+        snapshot["error"] = f"读取坐标文件失败: {e}"
+        return snapshot
+
+    try:
+        snapshot["df_routes"] = pd.read_excel(_source_file('routes'), engine='openpyxl')
+    except Exception as e:
+        snapshot["error"] = f"读取路线文件失败: {e}"
+    return snapshot
+
+
+def load_and_merge_data(driver_name, snapshot=None):
+    """
+    从快照中取出司机的门店列表并匹配坐标。
+    snapshot 为空时现场读取一次（单司机场景）。
+    返回 (matched: [Store], unmatched)；失败时 unmatched 为错误字符串。
+    坐标缺失或非法的门店计入 unmatched。
+    """
+    if snapshot is None:
+        snapshot = load_workbook_snapshot()
+    if snapshot["error"]:
+        return [], snapshot["error"]
+
+    coord_dict = snapshot["coord_dict"]
+    df_routes  = snapshot["df_routes"]
 
     driver_col = None
     name_row   = -1
@@ -138,63 +682,149 @@ def load_and_merge_data(driver_name):
         if pd.isna(store) or str(store).strip() in ("", "nan"):
             continue
         key = str(store).strip().lower()
+        record = None
         if key in coord_dict:
-            matched.append({
-                "name": str(store).strip(),
-                "lat":  str(coord_dict[key]['Latitude']),
-                "lng":  str(coord_dict[key]['Longitude']),
-            })
+            record = Store.parse(str(store).strip(),
+                                 coord_dict[key]['Latitude'], coord_dict[key]['Longitude'])
+        if record:
+            matched.append(record)
         else:
             unmatched.append(str(store).strip())
     return matched, unmatched
 
 
+def get_coord_dict():
+    """
+    返回缓存的 name->coords 映射，坐标文件变化时自动重新加载。
+
+    先比较 mtime/size，未变则直接命中；变了再比较内容 SHA-1，
+    仅内容真正改变（或文件切换 xlsx/csv）时才重新解析 Excel。
+    读取失败时抛出异常，由调用方决定如何降级。
+    返回的 dict 为共享对象，调用方不得修改。
+    """
+    path = _source_file('coords')
+    st   = os.stat(path)
+    with _coord_cache_lock:
+        c = _coord_cache
+        if (c["coord_dict"] is not None and c["path"] == path
+                and c["mtime_ns"] == st.st_mtime_ns and c["size"] == st.st_size):
+            c["hits"] += 1
+            return c["coord_dict"]
+
+        with open(path, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        if c["coord_dict"] is not None and c["path"] == path and c["sha1"] == digest:
+            # 文件被 touch / 重新上传但内容未变
+            c["mtime_ns"], c["size"] = st.st_mtime_ns, st.st_size
+            c["hits"] += 1
+            return c["coord_dict"]
+
+        coord_dict = _parse_coord_dict(pd.read_excel(io.BytesIO(raw), engine='openpyxl'))
+        c.update(path=path, mtime_ns=st.st_mtime_ns, size=st.st_size,
+                 sha1=digest, coord_dict=coord_dict)
+        c["misses"] += 1
+        print(f"[COORDS] 重新加载 {path}: {len(coord_dict)} 个坐标 (sha1={digest[:8]})")
+        return coord_dict
+
+
+def coord_cache_stats():
+    with _coord_cache_lock:
+        c = _coord_cache
+        return {
+            "path":    c["path"],
+            "sha1":    c["sha1"],
+            "entries": len(c["coord_dict"] or {}),
+            "hits":    c["hits"],
+            "misses":  c["misses"],
+        }
+
+
 def load_coord_dict():
-    """Load name->coords mapping directly from coords source file."""
-    coords_file = 'coords.xlsx' if os.path.exists('coords.xlsx') else 'coords.csv'
+    """Load name->coords mapping from the coords source file (cached)."""
     try:
-        df = pd.read_excel(coords_file, engine='openpyxl')
+        return get_coord_dict()
     except Exception:
         return {}
-    header_row_idx = 0
-    for i in range(min(15, len(df))):
-        if any('namn' in str(v).lower() for v in df.iloc[i].tolist()):
-            header_row_idx = i
-            break
-    df.columns = df.iloc[header_row_idx]
-    df = df.iloc[header_row_idx+1:].reset_index(drop=True).iloc[:, :3]
-    df.columns = ['Namn', 'Latitude', 'Longitude']
-    df['match_name'] = df['Namn'].astype(str).str.strip().str.lower()
-    df = df.drop_duplicates(subset=['match_name'], keep='first')
-    return df.set_index('match_name')[['Latitude', 'Longitude']].to_dict('index')
 
 
 
 
+def _osrm_tile_sizes(n_orig, n_dest, max_coords):
+    """
+    计算分块大小 (行数, 列数)，保证每块的 行数 + 列数 ≤ max_coords。
+    某一侧较小时整侧放入一块，把剩余容量留给另一侧。
+    """
+    half = max(1, max_coords // 2)
+    if n_orig <= half:
+        return n_orig, max(1, max_coords - n_orig)
+    if n_dest <= half:
+        return max(1, max_coords - n_dest), n_dest
+    return half, max(1, max_coords - half)
+
+
 def _distance_matrix_osrm(origins, destinations):
     """
-    使用 OSRM 公共 API 计算距离/时间矩阵（完全免费，无需 API Key）。
+    使用 OSRM table 服务计算距离/时间矩阵（公共服务器免费，无需 API Key）。
+    服务地址由 OSRM_BASE_URL 决定，可指向自建 OSRM 或兼容的本地替身（fake_osrm.py）。
     文档：http://project-osrm.org/docs/v5.24.0/api/#table-service
+
+    坐标总数超过 OSRM_MAX_TABLE_COORDS 时，把 origins × destinations 切成
+    若干行块×列块，用有界线程池并发请求后拼接。table 服务每个元素独立计算，
+    拼接结果与单次请求完全一致；任一分块失败则整体失败。
     返回 (time_matrix秒, dist_matrix米)，失败返回 (None, None)。
     """
     n_orig = len(origins)
     n_dest = len(destinations)
+    if n_orig + n_dest <= OSRM_MAX_TABLE_COORDS:
+        return _osrm_table_request(origins, destinations)
+
+    rows, cols = _osrm_tile_sizes(n_orig, n_dest, OSRM_MAX_TABLE_COORDS)
+    tiles = [(r0, c0) for r0 in range(0, n_orig, rows) for c0 in range(0, n_dest, cols)]
+    print(f"[OSRM] {n_orig}×{n_dest} 矩阵分为 {len(tiles)} 块（每块 ≤ {rows}×{cols}）")
+
+    def fetch(tile):
+        r0, c0 = tile
+        return _osrm_table_request(origins[r0:r0 + rows], destinations[c0:c0 + cols])
+
+    workers = max(1, min(OSRM_TILE_WORKERS, len(tiles)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(fetch, tiles))
+
+    time_matrix = [[None] * n_dest for _ in range(n_orig)]
+    dist_matrix = [[None] * n_dest for _ in range(n_orig)]
+    for (r0, c0), (t_part, d_part) in zip(tiles, parts):
+        if not t_part:
+            print(f"[OSRM] ✗ 分块 ({r0},{c0}) 失败，整体矩阵失败")
+            return None, None
+        for i, (t_row, d_row) in enumerate(zip(t_part, d_part)):
+            time_matrix[r0 + i][c0:c0 + len(t_row)] = t_row
+            dist_matrix[r0 + i][c0:c0 + len(d_row)] = d_row
+
+    print(f"[OSRM] ✓ {n_orig}×{n_dest} 分块矩阵拼接完成")
+    return time_matrix, dist_matrix
+
+
+def _osrm_table_request(origins, destinations):
+    """单次 OSRM table 请求。返回 (time_matrix秒, dist_matrix米)，失败返回 (None, None)。"""
+    n_orig = len(origins)
+    n_dest = len(destinations)
 
     # OSRM 格式：longitude,latitude（注意经纬顺序与 Google 相反）
     all_pts   = origins + destinations
-    coords_str = ";".join(f"{float(p['lng'])},{float(p['lat'])}" for p in all_pts)
+    coords_str = ";".join(f"{p.lng},{p.lat}" for p in all_pts)
     src_indices = ";".join(str(i)         for i in range(n_orig))
     dst_indices = ";".join(str(n_orig + i) for i in range(n_dest))
 
-    url = (
-        f"https://router.project-osrm.org/table/v1/driving/{coords_str}"
+    path = (
+        f"/table/v1/driving/{coords_str}"
         f"?sources={src_indices}&destinations={dst_indices}"
         f"&annotations=duration,distance"
     )
 
     print(f"[OSRM] Requesting {n_orig}×{n_dest} matrix ({n_orig * n_dest} elements)")
     try:
-        resp = http_requests.get(url, timeout=30)
+        resp = http_request("osrm", "GET", path)
         data = resp.json()
 
         if data.get("code") != "Ok":
@@ -229,6 +859,422 @@ def _distance_matrix_osrm(origins, destinations):
         return None, None
 
 
+def _osrm_route_legs(points):
+    """
+    OSRM route 服务：按顺序经过 points，返回各段 [(秒, 米)]（共 len(points)-1 段），
+    失败返回 None。overview=false 只返回逐段汇总，响应大小与点数成正比。
+    点数超过 OSRM_MAX_TABLE_COORDS 时分段请求，相邻分段共用衔接点。
+    continue_straight=false 允许在途经点掉头：否则某段可能被迫沿上一段方向继续行驶，
+    比点对点的 table 值更长；各段写入与 table 共用的 pairs 缓存，必须与 table 口径一致。
+    """
+    legs = []
+    step = max(2, OSRM_MAX_TABLE_COORDS)
+    for i in range(0, len(points) - 1, step - 1):
+        chunk = points[i:i + step]
+        coords_str = ";".join(f"{p.lng},{p.lat}" for p in chunk)
+        path = f"/route/v1/driving/{coords_str}?overview=false&steps=false&continue_straight=false"
+        try:
+            data = http_request("osrm", "GET", path).json()
+        except Exception as e:
+            print(f"[OSRM] ✗ route 请求异常: {e}")
+            return None
+        if data.get("code") != "Ok" or not data.get("routes"):
+            print(f"[OSRM] ✗ route code={data.get('code')} message={data.get('message','')}")
+            return None
+        legs += [(leg.get("duration") or 0, leg.get("distance") or 0)
+                 for leg in data["routes"][0]["legs"]]
+    print(f"[OSRM] ✓ route {len(legs)} 段")
+    return legs
+
+
+def _haversine_matrix(src_lat, src_lng, dst_lat, dst_lng,
+                      detour=None, speed_kmh=None):
+    """
+    NumPy 广播计算 Haversine 矩阵：输入为度数坐标数组（各自一次性解析），
+    返回 (time 秒, dist 米) 两个 int64 矩阵，形状 len(src) × len(dst)。
+    直线距离 × detour 绕行系数估算路程，按 speed_kmh 换算时间（截断取整）。
+    """
+    detour    = HAVERSINE_DETOUR if detour is None else detour
+    speed_kmh = HAVERSINE_SPEED_KMH if speed_kmh is None else speed_kmh
+    R = 6371000
+    lat1 = np.radians(np.asarray(src_lat, dtype=np.float64))[:, None]
+    lng1 = np.radians(np.asarray(src_lng, dtype=np.float64))[:, None]
+    lat2 = np.radians(np.asarray(dst_lat, dtype=np.float64))[None, :]
+    lng2 = np.radians(np.asarray(dst_lng, dtype=np.float64))[None, :]
+    h = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    dist_m = 2 * R * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0))) * detour
+    return (dist_m / (speed_kmh / 3.6)).astype(np.int64), dist_m.astype(np.int64)
+
+
+def _distance_matrix_haversine(origins, destinations):
+    """本地 Haversine 矩阵（不访问网络，总是成功）。"""
+    time_m, dist_m = _haversine_matrix(
+        [p.lat for p in origins],      [p.lng for p in origins],
+        [p.lat for p in destinations], [p.lng for p in destinations],
+    )
+    return time_m.tolist(), dist_m.tolist()
+
+
+def _distance_matrix_file(origins, destinations):
+    """
+    从预计算矩阵文件读取（文件变化时自动重新加载）。
+    格式：{"points": ["lng,lat", ...], "durations": [[秒]], "distances": [[米]]}
+    points 与 _coord_key 相同（6 位小数）。任一坐标不在文件中时返回 (None, None)。
+    """
+    c = _matrix_file_cache
+    try:
+        mtime_ns = os.stat(MATRIX_FILE).st_mtime_ns
+        if c["mtime_ns"] != mtime_ns:
+            with open(MATRIX_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            points = [f"{float(lng):.6f},{float(lat):.6f}"
+                      for lng, lat in (p.split(",") for p in data["points"])]
+            c.update(mtime_ns=mtime_ns, index={k: i for i, k in enumerate(points)},
+                     durations=data["durations"],
+                     distances=data.get("distances") or [[0] * len(points) for _ in points])
+            print(f"[MATRIX-FILE] 加载 {MATRIX_FILE}: {len(points)} 个坐标")
+    except Exception as e:
+        print(f"[MATRIX-FILE] ✗ 读取 {MATRIX_FILE} 失败: {e}")
+        return None, None
+
+    index = c["index"]
+    try:
+        src = [index[_coord_key(p)] for p in origins]
+        dst = [index[_coord_key(p)] for p in destinations]
+    except KeyError as e:
+        print(f"[MATRIX-FILE] ✗ 坐标 {e} 不在矩阵文件中")
+        return None, None
+    return ([[c["durations"][i][j] for j in dst] for i in src],
+            [[c["distances"][i][j] for j in dst] for i in src])
+
+
+# 所有后端签名相同：(origins, destinations) → (time_matrix, dist_matrix) 或 (None, None)
+_MATRIX_PROVIDERS = {
+    "osrm":      _distance_matrix_osrm,
+    "file":      _distance_matrix_file,
+    "haversine": _distance_matrix_haversine,
+}
+# 只有远程后端需要经过持久化缓存
+_CACHED_PROVIDERS = {"osrm"}
+
+
+def _pairwise_legs(points):
+    """没有 route 服务的后端：逐段做 1×1 查询。"""
+    fetch = _MATRIX_PROVIDERS[_matrix_provider()]
+    legs  = []
+    for a, b in zip(points, points[1:]):
+        time_m, dist_m = fetch([a], [b])
+        if not time_m:
+            return None
+        legs.append((time_m[0][0], dist_m[0][0]))
+    return legs
+
+
+# 逐段后端签名：(points) → [(秒, 米)] * (len(points)-1) 或 None；未列出的后端逐段 1×1
+_LEG_PROVIDERS = {
+    "osrm": _osrm_route_legs,
+}
+
+
+def _matrix_provider():
+    if MATRIX_PROVIDER not in _MATRIX_PROVIDERS:
+        print(f"[MATRIX] ✗ 未知 MATRIX_PROVIDER={MATRIX_PROVIDER!r}，使用 osrm")
+        return "osrm"
+    return MATRIX_PROVIDER
+
+
+# ── 距离矩阵缓存 ─────────────────────────────────────────────
+# 表结构：pairs(src, dst) → (duration 秒, distance 米, fetched_at)
+# src/dst 为 "lng,lat"（保留 6 位小数，约 0.1 米精度）。
+# 门店坐标几乎不变，每日生成和 reorder 基本都能直接命中本地缓存，
+# 只有缺失或过期的坐标对才会向 OSRM 请求。
+def _coord_key(p):
+    return f"{p.lng:.6f},{p.lat:.6f}"
+
+
+def _matrix_cache_connect():
+    conn = sqlite3.connect(MATRIX_CACHE_FILE, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS pairs ("
+        " src TEXT NOT NULL, dst TEXT NOT NULL,"
+        " duration REAL NOT NULL, distance REAL NOT NULL,"
+        " fetched_at REAL NOT NULL,"
+        " PRIMARY KEY (src, dst)) WITHOUT ROWID"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS pairs_fetched_at ON pairs(fetched_at)")
+    return conn
+
+
+def _matrix_cache_get(src_keys, dst_keys):
+    """读取未过期的坐标对，返回 {(src, dst): (duration, distance)}。"""
+    found   = {}
+    dst_set = set(dst_keys)
+    cutoff  = time.time() - MATRIX_CACHE_TTL
+    src_list = sorted(set(src_keys))
+    try:
+        conn = _matrix_cache_connect()
+        try:
+            # SQLite 参数个数有限，按批查询
+            for i in range(0, len(src_list), 500):
+                chunk = src_list[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT src, dst, duration, distance FROM pairs "
+                    f"WHERE fetched_at >= ? AND src IN ({','.join('?' * len(chunk))})",
+                    [cutoff] + chunk,
+                )
+                for s, d, dur, dist in rows:
+                    if d in dst_set:
+                        found[(s, d)] = (dur, dist)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[MATRIX-CACHE] ✗ 读取失败: {e}")
+    return found
+
+
+def _matrix_cache_get_pairs(pairs):
+    """按主键逐对读取未过期的坐标对，返回 {(src, dst): (duration, distance)}。"""
+    found  = {}
+    cutoff = time.time() - MATRIX_CACHE_TTL
+    try:
+        conn = _matrix_cache_connect()
+        try:
+            for s, d in set(pairs):
+                row = conn.execute(
+                    "SELECT duration, distance FROM pairs "
+                    "WHERE src = ? AND dst = ? AND fetched_at >= ?",
+                    (s, d, cutoff),
+                ).fetchone()
+                if row:
+                    found[(s, d)] = row
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[MATRIX-CACHE] ✗ 读取失败: {e}")
+    return found
+
+
+def _matrix_cache_put(entries):
+    """写入坐标对 [(src, dst, duration, distance), ...]，并按 TTL 定期清理过期数据。"""
+    if not entries:
+        return
+    now = time.time()
+    try:
+        conn = _matrix_cache_connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO pairs (src, dst, duration, distance, fetched_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(s, d, dur, dist, now) for s, d, dur, dist in entries],
+                )
+                with _matrix_cache_lock:
+                    due = now - _matrix_cache_stats["last_evict"] > 3600
+                    if due:
+                        _matrix_cache_stats["last_evict"] = now
+                if due:
+                    evicted = conn.execute(
+                        "DELETE FROM pairs WHERE fetched_at < ?",
+                        (now - MATRIX_CACHE_TTL,),
+                    ).rowcount
+                    if evicted:
+                        print(f"[MATRIX-CACHE] 清理过期坐标对 {evicted} 条")
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[MATRIX-CACHE] ✗ 写入失败: {e}")
+
+
+def matrix_cache_stats():
+    with _matrix_cache_lock:
+        stats = {k: v for k, v in _matrix_cache_stats.items() if k != "last_evict"}
+    try:
+        conn = _matrix_cache_connect()
+        try:
+            stats["entries"] = conn.execute("SELECT COUNT(*) FROM pairs").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        stats["entries"] = None
+    return stats
+
+
+def _distance_matrix(origins, destinations):
+    """
+    按 MATRIX_PROVIDER 获取距离/时间矩阵。
+    远程后端（osrm）先查本地缓存，只对缺失的坐标对发起请求，
+    请求结果写回缓存后拼出完整矩阵。
+    返回 (time_matrix秒, dist_matrix米)，失败返回 (None, None)。
+    """
+    provider = _matrix_provider()
+    fetch    = _MATRIX_PROVIDERS[provider]
+    if provider not in _CACHED_PROVIDERS:
+        return fetch(origins, destinations)
+
+    src_keys = [_coord_key(p) for p in origins]
+    dst_keys = [_coord_key(p) for p in destinations]
+    points   = dict(zip(src_keys, origins))
+    points.update(zip(dst_keys, destinations))
+    cached   = _matrix_cache_get(src_keys, dst_keys)
+
+    uniq_dst = list(dict.fromkeys(dst_keys))
+    miss_src = [s for s in dict.fromkeys(src_keys)
+                if any((s, d) not in cached for d in uniq_dst)]
+    miss_dst = [d for d in uniq_dst
+                if any((s, d) not in cached for s in miss_src)]
+
+    n_total = len(src_keys) * len(dst_keys)
+    n_hit   = sum(1 for s in src_keys for d in dst_keys if (s, d) in cached)
+    with _matrix_cache_lock:
+        _matrix_cache_stats["hits"]   += n_hit
+        _matrix_cache_stats["misses"] += n_total - n_hit
+    print(f"[MATRIX-CACHE] 命中 {n_hit}/{n_total}")
+
+    # 缺失的坐标对只发一次请求：包围它们的子块（有缺失的行 × 缺失列的并集），
+    # 超过 OSRM_MAX_TABLE_COORDS 时由 _distance_matrix_osrm 分块。
+    # 各行缺口不同时也不会退化成逐行请求；子块里已缓存的坐标对顺便刷新。
+    if miss_src:
+        time_m, dist_m = fetch(
+            [points[k] for k in miss_src], [points[k] for k in miss_dst],
+        )
+        if not time_m:
+            return None, None
+        with _matrix_cache_lock:
+            _matrix_cache_stats["fetches"] += 1
+        entries = []
+        for i, s in enumerate(miss_src):
+            for j, d in enumerate(miss_dst):
+                pair = (time_m[i][j], dist_m[i][j])
+                cached[(s, d)] = pair
+                # 不可达（999999）同样写入缓存并按 TTL 过期，不会每次都重新请求
+                entries.append((s, d, pair[0], pair[1]))
+        _matrix_cache_put(entries)
+
+    time_matrix = [[cached[(s, d)][0] for d in dst_keys] for s in src_keys]
+    dist_matrix = [[cached[(s, d)][1] for d in dst_keys] for s in src_keys]
+    return time_matrix, dist_matrix
+
+
+def _route_legs(path):
+    """
+    按顺序经过 path 的各段 [(秒, 米)]，失败返回 None。只涉及 len(path)-1 个坐标对：
+    先查内存中的整车队 / reorder 矩阵，再逐对查持久化缓存，
+    缺失的连续段合并后各发一次 route 请求，结果写回缓存。
+    """
+    keys  = [_coord_key(p) for p in path]
+    pairs = list(zip(keys, keys[1:]))
+    memo_set = _route_memo()
+    for memo in (memo_set["fleet"], *memo_set["drivers"].values()):
+        if memo and all(k in memo["index"] for k in keys):
+            idx = [memo["index"][k] for k in keys]
+            return [(memo["time"][a][b], memo["dist"][a][b]) for a, b in zip(idx, idx[1:])]
+
+    provider = _matrix_provider()
+    fetch    = _LEG_PROVIDERS.get(provider, _pairwise_legs)
+    if provider not in _CACHED_PROVIDERS:
+        return fetch(path)
+
+    cached = _matrix_cache_get_pairs(pairs)
+    n_hit  = sum(1 for p in pairs if p in cached)
+    with _matrix_cache_lock:
+        _matrix_cache_stats["hits"]   += n_hit
+        _matrix_cache_stats["misses"] += len(pairs) - n_hit
+    print(f"[MATRIX-CACHE] 逐段命中 {n_hit}/{len(pairs)}")
+
+    runs = []   # 缺失段的连续区间 [lo, hi)
+    for i, pair in enumerate(pairs):
+        if pair in cached:
+            continue
+        if runs and runs[-1][1] == i:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+
+    for lo, hi in runs:
+        legs = fetch(path[lo:hi + 1])
+        if not legs or len(legs) != hi - lo:
+            return None
+        with _matrix_cache_lock:
+            _matrix_cache_stats["fetches"] += 1
+        entries = []
+        for (s, d), leg in zip(pairs[lo:hi], legs):
+            cached[(s, d)] = leg
+            if leg[0] < 999999:
+                entries.append((s, d, leg[0], leg[1]))
+        _matrix_cache_put(entries)
+
+    return [cached[p] for p in pairs]
+
+
+def build_fleet_matrix(stores):
+    """
+    为整个车队构建一张去重矩阵：仓库 + 所有司机门店（按坐标去重）。
+    矩阵走 _distance_matrix，因此同样享受缓存与分块请求。
+    返回 {"index": {coord_key: 行号}, "time": [[秒]], "dist": [[米]], "built_at": 时间戳}，
+    失败返回 None。
+    """
+    nodes = {}
+    for p in [WAREHOUSE] + list(stores):
+        nodes.setdefault(_coord_key(p), p)
+    keys = list(nodes)
+    print(f"[FLEET] 构建整车队矩阵: {len(keys)} 个唯一坐标（含仓库）")
+    time_m, dist_m = _distance_matrix([nodes[k] for k in keys], [nodes[k] for k in keys])
+    if not time_m:
+        print("[FLEET] ✗ 整车队矩阵失败，回退到每个司机单独请求")
+        return None
+    return {"index": {k: i for i, k in enumerate(keys)}, "time": time_m, "dist": dist_m,
+            "built_at": time.time()}
+
+
+def _route_memo():
+    """
+    返回当前可用的内存矩阵 {"fleet": ..., "drivers": {...}}。
+    内存矩阵是每个进程各自的，必须和其他 worker 保持一致、并且会过期：
+    - state 的 generated_at 变了（本进程或其他 worker 重新生成，经 sync_state 同步）→ 全部丢弃；
+    - 单个矩阵建成超过 MATRIX_CACHE_TTL → 丢弃，与 SQLite 坐标对缓存同样过期。
+    丢弃后调用方经 build_fleet_matrix → _distance_matrix 走 SQLite 坐标对缓存重建，
+    不会直接打到 OSRM。
+    """
+    memo = _route_matrix_memo
+    if not memo["pending"] and memo["generated_at"] != state.get("generated_at"):
+        memo.update(generated_at=state.get("generated_at"), fleet=None, drivers={})
+    cutoff = time.time() - MATRIX_CACHE_TTL
+    if memo["fleet"] and memo["fleet"]["built_at"] < cutoff:
+        memo["fleet"] = None
+    for driver in [d for d, m in memo["drivers"].items() if m["built_at"] < cutoff]:
+        del memo["drivers"][driver]
+    return memo
+
+
+def _slice_fleet_matrix(fleet, nodes):
+    """从整车队矩阵中切出 nodes 对应的子矩阵；有节点不在其中时返回 (None, None)。"""
+    try:
+        idx = [fleet["index"][_coord_key(p)] for p in nodes]
+    except KeyError:
+        return None, None
+    return ([[fleet["time"][i][j] for j in idx] for i in idx],
+            [[fleet["dist"][i][j] for j in idx] for i in idx])
+
+
+def route_matrix_for(driver, stores):
+    """
+    返回覆盖仓库 + stores 的矩阵（build_fleet_matrix 结构），供交互式 reorder 复用：
+    先查最近一次生成的整车队矩阵，再查该司机上次 reorder 建的矩阵，
+    都不覆盖时（例如新增门店）才重新构建并记住。
+    """
+    nodes = [WAREHOUSE] + list(stores)
+    memo_set = _route_memo()
+    for memo in (memo_set["fleet"], memo_set["drivers"].get(driver)):
+        if memo and all(_coord_key(p) in memo["index"] for p in nodes):
+            return memo
+    memo = build_fleet_matrix(stores)
+    if memo:
+        memo_set["drivers"][driver] = memo
+    return memo
+
+
 def _greedy_tsp_from(matrix, start=0):
     """
     贪心最近邻 TSP（Nearest Neighbor Heuristic）。
@@ -257,10 +1303,205 @@ def _greedy_tsp_from(matrix, start=0):
     return order
 
 
-def _ortools_tsp(matrix, start=0, locked_positions=None):
+def _nearest_neighbour_tour(M, start=0, locked_positions=None):
+    """
+    最近邻构造初始解（NumPy 版）：tour[0] = start，锁定节点先放入指定槽位，
+    其余槽位依次选离前一站最近的未访问节点。
+    """
+    n = len(M)
+    tour = np.full(n, -1, dtype=np.int64)
+    tour[0] = start
+    free = np.ones(n, dtype=bool)
+    free[start] = False
+    for step, node in (locked_positions or {}).items():
+        if 0 < step < n and free[node]:
+            tour[step] = node
+            free[node] = False
+    for pos in range(1, n):
+        if tour[pos] >= 0:
+            continue
+        j = int(np.argmin(np.where(free, M[tour[pos - 1]], np.inf)))
+        tour[pos] = j
+        free[j] = False
+    return tour
+
+
+def _warm_route(initial_order, n, start=0, locked_positions=None):
+    """
+    校验热启动初始路线（不含 start 的访问顺序）：必须恰好覆盖其余全部节点，
+    且锁定节点位于指定步数。不满足时返回 None，由调用方改用冷启动。
+    """
+    if not initial_order:
+        return None
+    route = [int(x) for x in initial_order]
+    if sorted(route) != [i for i in range(n) if i != start]:
+        return None
+    if any(route[step - 1] != node for step, node in (locked_positions or {}).items()):
+        return None
+    return route
+
+
+def _local_search_tsp(matrix, start=0, locked_positions=None, profile="batch",
+                      initial_order=None):
+    """
+    内置 TSP 局部搜索引擎（不依赖 OR-Tools）。
+    最近邻初始解（或 initial_order 提供的热启动路线）→ 反复执行最优的
+    2-opt / Or-opt（段长 1~3）移动，直到无改进或超时。
+
+    每轮在 NumPy 上一次性评估全部候选移动，只保留新弧终点在 K 近邻表中的移动。
+    矩阵可以不对称：2-opt 反转段的成本用正向 / 反向前缀和在 O(1) 内求出。
+    locked_positions 与 _ortools_tsp 含义相同，包含锁定槽位的移动一律跳过，
+    因此锁定总能满足。时间上限沿用 _solver_budget(n, profile)。
+
+    返回访问顺序列表（不含 start），格式与 _greedy_tsp_from 相同。
+    """
+    M = np.asarray(matrix, dtype=np.float64)
+    n = len(M)
+    if n <= 2:
+        return [i for i in range(n) if i != start]
+    deadline = time.monotonic() + _solver_budget(n, profile)["time_limit_ms"] / 1000
+
+    warm = _warm_route(initial_order, n, start, locked_positions)
+    tour = (np.array([start] + warm, dtype=np.int64) if warm
+            else _nearest_neighbour_tour(M, start, locked_positions))
+
+    # 锁定槽位（含仓库所在的第 0 位）；lock_cum[k] = 位置 < k 的锁定数
+    locked = np.zeros(n, dtype=bool)
+    locked[0] = True
+    for step in (locked_positions or {}):
+        if 0 < step < n:
+            locked[step] = True
+    lock_cum = np.concatenate(([0], np.cumsum(locked)))
+
+    def locks_in(lo, hi):
+        return lock_cum[hi + 1] - lock_cum[lo]
+
+    k = min(n - 1, LOCAL_SEARCH_NEIGHBOURS)
+    off_diag = M + np.diag(np.full(n, np.inf))
+    near = np.zeros((n, n), dtype=bool)
+    near[np.arange(n)[:, None], np.argsort(off_diag, axis=1)[:, :k]] = True
+
+    pos = np.arange(n)
+    while time.monotonic() < deadline:
+        t_ext = np.append(tour, tour[0])
+        seg   = M[t_ext[:-1], t_ext[1:]]          # seg[k] = 第 k 条弧成本
+        F = np.concatenate(([0.0], np.cumsum(seg)))
+        B = np.concatenate(([0.0], np.cumsum(M[t_ext[1:], t_ext[:-1]])))
+        best_delta, best_move = -1e-7, None
+
+        # 2-opt：反转 tour[i..j]
+        i, j = pos[1:, None], pos[None, 1:]
+        prev, first, last, after = t_ext[i - 1], t_ext[i], t_ext[j], t_ext[j + 1]
+        delta = (M[prev, last] + M[first, after] - seg[i - 1] - seg[j]
+                 + (B[j] - B[i]) - (F[j] - F[i]))
+        valid = (j > i) & (locks_in(i, j) == 0) & near[prev, last]
+        delta = np.where(valid, delta, np.inf)
+        a, b = np.unravel_index(np.argmin(delta), delta.shape)
+        if delta[a, b] < best_delta:
+            best_delta, best_move = delta[a, b], ("2opt", a + 1, b + 1)
+
+        # Or-opt：把 tour[i..i+L-1] 移到位置 p 与 p+1 之间
+        for L in (1, 2, 3):
+            if n - L < 1:
+                break
+            i, p = pos[1:n - L + 1, None], pos[None, :]
+            s_first, s_last = t_ext[i], t_ext[i + L - 1]
+            u, v = t_ext[p], t_ext[p + 1]
+            remove_gain = seg[i - 1] + seg[i + L - 1] - M[t_ext[i - 1], t_ext[i + L]]
+            delta = M[u, s_first] + M[s_last, v] - seg[p] - remove_gain
+            after_seg = p > i + L - 1
+            lo = np.where(after_seg, i, p + 1)
+            hi = np.where(after_seg, p, i + L - 1)
+            valid = ((p < i - 1) | after_seg) & (locks_in(lo, hi) == 0) & near[u, s_first]
+            delta = np.where(valid, delta, np.inf)
+            a, b = np.unravel_index(np.argmin(delta), delta.shape)
+            if delta[a, b] < best_delta:
+                best_delta, best_move = delta[a, b], ("oropt", a + 1, b, L)
+
+        if best_move is None:
+            break
+        if best_move[0] == "2opt":
+            _, i, j = best_move
+            tour[i:j + 1] = tour[i:j + 1][::-1].copy()
+        else:
+            _, i, p, L = best_move
+            moved = tour[i:i + L].copy()
+            rest  = np.delete(tour, np.s_[i:i + L])
+            tour  = np.insert(rest, p + 1 if p < i else p + 1 - L, moved)
+
+    return [int(x) for x in tour[1:]]
+
+
+def _solve_tsp(matrix, start=0, locked_positions=None, profile="batch", initial_order=None):
+    """
+    按 TSP_ENGINE 选择求解引擎，返回 (order, locks_honored, engine)，格式同 _ortools_tsp。
+    engine 是实际使用的引擎（OR-Tools 不可用或失败时为 "local"），不一定等于 TSP_ENGINE。
+    """
+    if TSP_ENGINE == "local":
+        order = _local_search_tsp(matrix, start, locked_positions, profile, initial_order)
+        return order, True, "local"
+    return _ortools_tsp(matrix, start, locked_positions, profile, initial_order)
+
+
+def _solver_budget(n, profile="batch"):
+    """
+    按节点数和场景返回求解预算：
+    {"guided": 是否启用 GLS, "solution_limit": 最多解数, "stall_solutions": 连续无改进的解数上限,
+     "time_limit_ms": 时间上限}
+    解数只取决于节点数和场景，因此结果可复现；时间上限只在机器严重过载时才会先到。
+    """
+    p = SOLVER_PROFILES.get(profile, SOLVER_PROFILES["batch"])
+    limit_ms = min(p["max_ms"], p["base_ms"] + p["per_node_ms"] * n)
+    if n <= SOLVER_SMALL_NODES:
+        # 小路线局部下降即可收敛（自然结束，本身确定）
+        return {"guided": False, "solution_limit": None, "stall_solutions": None,
+                "time_limit_ms": limit_ms}
+    per_ms = SOLVER_GLS_RATE / n ** SOLVER_GLS_EXPONENT
+    return {
+        "guided":          True,
+        "solution_limit":  max(10, round(limit_ms / SOLVER_SAFETY_FACTOR * per_ms)),
+        "stall_solutions": p["stall"],
+        "time_limit_ms":   limit_ms,
+    }
+
+
+def _set_solver_limits(sp, budget):
+    """把预算中的 solution_limit 和保险时间上限写入搜索参数。"""
+    if budget["solution_limit"]:
+        sp.solution_limit = budget["solution_limit"]
+    sp.time_limit.FromMilliseconds(budget["time_limit_ms"])
+
+
+def _ortools_stall_limit(routing, stall_solutions):
+    """
+    连续 stall_solutions 个解没有改进时停止搜索（GLS 自身不会提前结束）。
+    按解计数而不是按时间：单线程搜索的解序列是确定的，停止点因此与 CPU 负载无关。
+    回调只在每个新解时执行一次（不在弧成本评估里），实测每个解约 18 µs：10–30 个节点时
+    GLS 吞吐量下降约 10–15%，60 个节点以上测不出；换来的是小路线在几百个解后就停止。
+    """
+    if not stall_solutions:
+        return
+    best = {"cost": None, "since": 0}
+
+    def on_solution():
+        cost = routing.CostVar().Max()
+        if best["cost"] is None or cost < best["cost"]:
+            best["cost"], best["since"] = cost, 0
+        else:
+            best["since"] += 1
+
+    routing.AddAtSolutionCallback(on_solution)
+    routing.AddSearchMonitor(routing.solver().CustomLimit(
+        lambda: best["since"] >= stall_solutions))
+
+
+def _ortools_tsp(matrix, start=0, locked_positions=None, profile="batch", initial_order=None):
     """
     使用 Google OR-Tools 求解 TSP 全局最优路线。
     输入：行×列的秒数矩阵，start 为仓库节点索引。
+    profile: 求解预算场景（见 SOLVER_PROFILES），"batch"、"interactive" 或 "warm"。
+    initial_order: 可选的热启动路线（不含 start）。合法时经 ReadAssignmentFromRoutes
+                   作为初始解，跳过初始解构造，直接在其基础上改进。
 
     locked_positions: dict { 访问步数(int) → 矩阵节点索引(int) }
                       depot 出发时步数 = 0，第 1 站步数 = 1，以此类推。
@@ -277,21 +1518,23 @@ def _ortools_tsp(matrix, start=0, locked_positions=None):
                          完全跳过 FirstSolutionStrategy（PATH_CHEAPEST_ARC /
                          LOCAL_CHEAPEST_INSERTION 等都无法可靠处理 CumulVar）。
 
-    返回：(order, solved_with_locks)
+    返回：(order, solved_with_locks, engine)
         order: 访问顺序列表（不含起点 start），格式与 _greedy_tsp_from 相同。
         solved_with_locks: bool，True 表示含锁定约束求解成功，
                            False 表示降级（无约束或贪心）。
+        engine: 实际给出结果的引擎："ortools"；回退到内置局部搜索时为 "local"；
+                不超过 2 个节点无需求解时为 "trivial"。
     """
     try:
         from ortools.constraint_solver import routing_enums_pb2
         from ortools.constraint_solver import pywrapcp
     except ImportError:
-        print("[OR-TOOLS] ✗ ortools 未安装，回退到贪心算法")
-        return _greedy_tsp_from(matrix, start), False
+        print("[OR-TOOLS] ✗ ortools 未安装，回退到内置局部搜索")
+        return _local_search_tsp(matrix, start, locked_positions, profile, initial_order), True, "local"
 
     n = len(matrix)
     if n <= 2:
-        return [i for i in range(n) if i != start], (not locked_positions)
+        return [i for i in range(n) if i != start], (not locked_positions), "trivial"
 
     def _extract_order(routing, manager, solution):
         """从 solution 中提取访问顺序列表（不含 start）。"""
@@ -304,20 +1547,24 @@ def _ortools_tsp(matrix, start=0, locked_positions=None):
             index = solution.Value(routing.NextVar(index))
         return order
 
+    # 整数秒矩阵一次性转换（截断取整，与原 int() 回调一致），
+    # 以 RegisterTransitMatrix 交给 OR-Tools 在 C++ 侧查表，
+    # GLS 每次评估弧成本不再回调 Python。
+    int_matrix = np.asarray(matrix, dtype=np.float64).astype(np.int64).tolist()
+
     def _build_base_model():
         """构建基础路由模型（不含锁定约束）。"""
         mgr = pywrapcp.RoutingIndexManager(n, 1, start)
         mdl = pywrapcp.RoutingModel(mgr)
-
-        def time_callback(from_index, to_index):
-            i = mgr.IndexToNode(from_index)
-            j = mgr.IndexToNode(to_index)
-            return int(matrix[i][j])
-
-        transit_idx = mdl.RegisterTransitCallback(time_callback)
+        transit_idx = mdl.RegisterTransitMatrix(int_matrix)
         mdl.SetArcCostEvaluatorOfAllVehicles(transit_idx)
         return mgr, mdl
 
+    budget = _solver_budget(n, profile)
+    warm   = _warm_route(initial_order, n, start, locked_positions)
+    if initial_order and not warm:
+        print("[OR-TOOLS] 热启动路线不完整或不满足锁定，改为冷启动")
+
     def _default_search_params():
         sp = pywrapcp.DefaultRoutingSearchParameters()
         sp.first_solution_strategy = (
@@ -325,22 +1572,20 @@ def _ortools_tsp(matrix, start=0, locked_positions=None):
         )
         sp.local_search_metaheuristic = (
             routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+            if budget["guided"] else
+            routing_enums_pb2.LocalSearchMetaheuristic.GREEDY_DESCENT
         )
-        sp.time_limit.seconds = 5
+        _set_solver_limits(sp, budget)
         sp.log_search = False
         return sp
 
+    def _add_stall_limit(routing):
+        _ortools_stall_limit(routing, budget["stall_solutions"])
+
     def _log_comparison(label, obj, locked_count=0):
-        """对比 OR-Tools 解与贪心解并打印日志。"""
-        greedy_order = _greedy_tsp_from(matrix, start)
-        path = [start] + greedy_order
-        greedy_sec = sum(matrix[path[i]][path[i + 1]] for i in range(len(path) - 1))
-        greedy_sec += matrix[greedy_order[-1]][start]
-        improvement = (greedy_sec - obj) / max(greedy_sec, 1) * 100
+        """打印求解结果（与贪心基线的对比见 SOLVER_METRICS）。"""
         lock_info = f" | 锁定 {locked_count}" if locked_count else ""
-        print(f"[OR-TOOLS] ✓ {n} 节点{lock_info}{label} | "
-              f"OR-Tools={round(obj/60)}min 贪心={round(greedy_sec/60)}min "
-              f"节省={improvement:.1f}%")
+        print(f"[OR-TOOLS] ✓ {n} 节点{lock_info}{label} | OR-Tools={round(obj/60)}min")
 
     try:
         # ── 阶段 1：带锁定约束的全局优化 ──────────────────────
@@ -350,10 +1595,8 @@ def _ortools_tsp(matrix, start=0, locked_positions=None):
             # ─── 1a. 添加 CumulVar 维度约束 ─────────────────
             # 约束作用：在 GLS 改进阶段防止锁定节点被移动。
             # 不依赖 FirstSolutionStrategy——初始解由我们手动构建。
-            def unit_transit(from_index, to_index):
-                return 1
-
-            unit_transit_idx = routing.RegisterTransitCallback(unit_transit)
+            # 每条弧步数 +1，用一元向量注册，同样无需 Python 回调。
+            unit_transit_idx = routing.RegisterUnaryTransitVector([1] * n)
             routing.AddDimension(
                 unit_transit_idx,
                 0,       # slack = 0（无松弛）
@@ -369,47 +1612,52 @@ def _ortools_tsp(matrix, start=0, locked_positions=None):
 
             print(f"[OR-TOOLS] CumulVar 约束: {locked_positions}  (step → node)")
 
-            # ─── 1b. 手动构建满足约束的初始解 ────────────────
-            # 核心思路：将锁定节点放入指定槽位，
-            # 剩余槽位用贪心最近邻（基于完整距离矩阵）填充未锁定节点。
-            locked_node_set = set(locked_positions.values())
-            unlocked_nodes  = [i for i in range(n)
-                               if i != start and i not in locked_node_set]
-
-            # 初始路线数组：route[0] = 第 1 站，route[1] = 第 2 站 …
-            route = [None] * (n - 1)
-            for step, node in locked_positions.items():
-                route[step - 1] = node  # step 从 1 开始，数组从 0 开始
-
-            # 贪心最近邻填充未锁定节点
-            remaining = set(unlocked_nodes)
-            for i in range(len(route)):
-                if route[i] is not None:
-                    continue
-                # 前一个节点（用于计算距离）
-                prev_node = start if i == 0 else route[i - 1]
-                # 从 remaining 中选最近的
-                best_node, best_cost = None, float('inf')
-                for cand in remaining:
-                    cost = matrix[prev_node][cand]
-                    if cost < best_cost:
-                        best_node, best_cost = cand, cost
-                if best_node is not None:
-                    route[i] = best_node
-                    remaining.discard(best_node)
-
-            # 安全检查：如果还有剩余节点（不应该发生），追加到末尾
-            for leftover in remaining:
-                for i in range(len(route)):
-                    if route[i] is None:
-                        route[i] = leftover
-                        break
+            # ─── 1b. 初始解：热启动路线，否则手动构建 ──────────
+            # 热启动路线已校验满足锁定槽位，直接使用；否则将锁定节点
+            # 放入指定槽位，剩余槽位用贪心最近邻（基于完整距离矩阵）填充。
+            if warm:
+                route = warm
+                print(f"[OR-TOOLS] 热启动初始解: {len(route)} 站")
+            else:
+                locked_node_set = set(locked_positions.values())
+                unlocked_nodes  = [i for i in range(n)
+                                   if i != start and i not in locked_node_set]
 
-            print(f"[OR-TOOLS] 手动初始解: depot → {route[:5]}{'…' if len(route)>5 else ''} "
-                  f"→ depot  ({len(route)} 站)")
+                # 初始路线数组：route[0] = 第 1 站，route[1] = 第 2 站 …
+                route = [None] * (n - 1)
+                for step, node in locked_positions.items():
+                    route[step - 1] = node  # step 从 1 开始，数组从 0 开始
 
-            # ─── 1c. 从手动初始解开始优化 ────────────────────
+                # 贪心最近邻填充未锁定节点
+                remaining = set(unlocked_nodes)
+                for i in range(len(route)):
+                    if route[i] is not None:
+                        continue
+                    # 前一个节点（用于计算距离）
+                    prev_node = start if i == 0 else route[i - 1]
+                    # 从 remaining 中选最近的
+                    best_node, best_cost = None, float('inf')
+                    for cand in remaining:
+                        cost = matrix[prev_node][cand]
+                        if cost < best_cost:
+                            best_node, best_cost = cand, cost
+                    if best_node is not None:
+                        route[i] = best_node
+                        remaining.discard(best_node)
+
+                # 安全检查：如果还有剩余节点（不应该发生），追加到末尾
+                for leftover in remaining:
+                    for i in range(len(route)):
+                        if route[i] is None:
+                            route[i] = leftover
+                            break
+
+                print(f"[OR-TOOLS] 手动初始解: depot → {route[:5]}{'…' if len(route)>5 else ''} "
+                      f"→ depot  ({len(route)} 站)")
+
+            # ─── 1c. 从初始解开始优化 ────────────────────────
             search_params = _default_search_params()
+            _add_stall_limit(routing)
             routing.CloseModelWithParameters(search_params)
             initial_assignment = routing.ReadAssignmentFromRoutes([route], True)
 
@@ -421,7 +1669,7 @@ def _ortools_tsp(matrix, start=0, locked_positions=None):
                     order = _extract_order(routing, manager, solution)
                     _log_comparison("", solution.ObjectiveValue(),
                                     len(locked_positions))
-                    return order, True
+                    return order, True, "ortools"
                 else:
                     print("[OR-TOOLS] ✗ SolveFromAssignment 返回 None（GLS 无法改进？）")
             else:
@@ -433,7 +1681,17 @@ def _ortools_tsp(matrix, start=0, locked_positions=None):
         # ── 阶段 2：无约束全局优化（降级或无锁定） ─────────────
         manager, routing = _build_base_model()
         search_params = _default_search_params()
-        solution = routing.SolveWithParameters(search_params)
+        _add_stall_limit(routing)
+        solution = None
+        if warm:
+            routing.CloseModelWithParameters(search_params)
+            initial_assignment = routing.ReadAssignmentFromRoutes([warm], True)
+            if initial_assignment:
+                solution = routing.SolveFromAssignmentWithParameters(
+                    initial_assignment, search_params,
+                )
+        if not solution:
+            solution = routing.SolveWithParameters(search_params)
 
         # 无锁定请求时 locks_honored=True（没有约束就不存在"未满足"）
         # 有锁定但降级时 locks_honored=False
@@ -443,306 +1701,1130 @@ def _ortools_tsp(matrix, start=0, locked_positions=None):
             order = _extract_order(routing, manager, solution)
             label = "" if no_lock_requested else "（锁定降级）"
             _log_comparison(label, solution.ObjectiveValue())
-            return order, no_lock_requested  # True if no locks, False if degraded
+            return order, no_lock_requested, "ortools"  # True if no locks, False if degraded
+
+        print("[OR-TOOLS] ✗ 无约束也未找到解，回退到内置局部搜索")
+        return _local_search_tsp(matrix, start, locked_positions, profile, initial_order), True, "local"
+
+    except Exception as e:
+        import traceback
+        print(f"[OR-TOOLS] ✗ 异常，回退到内置局部搜索: {e}\n{traceback.format_exc()}")
+        return _local_search_tsp(matrix, start, locked_positions, profile, initial_order), True, "local"
+
+
+def _tour_cost(matrix, full_order, start=0):
+    """start → full_order → start 的总成本。"""
+    path = [start] + list(full_order) + [start]
+    return sum(matrix[path[i]][path[i + 1]] for i in range(len(path) - 1))
+
+
+def _baseline_cost(matrix, start=0):
+    """贪心最近邻基线成本，按矩阵内容指纹缓存，同一矩阵只计算一次。"""
+    key = (hashlib.sha1(np.asarray(matrix, dtype=np.float64).tobytes()).hexdigest(), start)
+    if key not in _baseline_cache:
+        if len(_baseline_cache) >= 64:
+            _baseline_cache.clear()
+        _baseline_cache[key] = _tour_cost(matrix, _greedy_tsp_from(matrix, start), start)
+    return _baseline_cache[key]
+
+
+def _solve_with_metrics(matrix, locked_positions=None, profile="batch", initial_order=None):
+    """
+    调用 _solve_tsp（仓库为节点 0）并记录求解指标。
+    返回 (full_order, locks_honored, metrics)，metrics 含 engine、solve_ms、final_cost；
+    热启动时附带 initial_cost，SOLVER_METRICS=1 时额外包含 baseline_cost 与 improvement_pct。
+    """
+    t0 = time.perf_counter()
+    full_order, locks_honored, engine = _solve_tsp(
+        matrix, start=0, locked_positions=locked_positions, profile=profile,
+        initial_order=initial_order,
+    )
+    metrics = {
+        "engine":     engine,
+        "profile":    profile,
+        "solve_ms":   round((time.perf_counter() - t0) * 1000),
+        "final_cost": round(_tour_cost(matrix, full_order)),
+    }
+    if initial_order:
+        metrics["initial_cost"] = round(_tour_cost(matrix, initial_order))
+    if SOLVER_METRICS and len(matrix) > 1:
+        baseline = _baseline_cost(matrix)
+        metrics["baseline_cost"]   = round(baseline)
+        metrics["improvement_pct"] = round(
+            (baseline - metrics["final_cost"]) / max(baseline, 1) * 100, 1)
+    print(f"[SOLVER] {metrics}")
+    return full_order, locks_honored, metrics
+
+
+def _stats_from_matrices(full_order, time_matrix, dist_matrix):
+    """
+    直接从已有的时间/距离矩阵计算路线总统计，完全不调用任何 API。
+
+    full_order: OR-Tools / 贪心返回的顺序列表（不含起点 0），
+                路线为 0 → full_order[0] → ... → full_order[-1] → 0
+    time_matrix: N×N 秒数矩阵
+    dist_matrix: N×N 距离矩阵（米）
+
+    返回 stats dict，legs 为每段 [秒, 米]（仓库 → 第 1 站 → … → 返回仓库），随结果保存供导出 / 归档。
+    """
+    route = [0] + list(full_order) + [0]   # 仓库(0) → 所有门店 → 返回仓库
+    legs  = [(time_matrix[a][b], dist_matrix[a][b]) for a, b in zip(route, route[1:])]
+    total_sec  = sum(t for t, _ in legs)
+    total_dist = sum(d for _, d in legs)
+
+    # OSRM 返回浮点数，累加后可能有精度漂移，取整
+    total_sec  = round(total_sec)
+    total_dist = round(total_dist)
+
+    hours = total_sec // 3600
+    mins  = (total_sec % 3600) // 60
+    dur_str = f"{hours}h {mins}min" if hours > 0 else f"{mins}min"
+    print(f"[STATS-MATRIX] ✓ {dur_str} ({total_sec}s) {round(total_dist/1000,1)}km "
+          f"[直接从矩阵计算，无额外 API 调用]")
+    return {
+        "duration_min":  round(total_sec / 60),
+        "duration_sec":  total_sec,
+        "distance_km":   round(total_dist / 1000, 1),
+        "legs":          [[round(t, 1), round(d, 1)] for t, d in legs],
+    }
+
+
+def optimize_route(stores, locked_indices=None, fleet_matrix=None, profile="batch",
+                   warm_start=False):
+    """
+    对门店列表进行路线优化（使用 OSRM + OR-Tools TSP）。
+
+    stores:         [Store]，坐标已在加载 / API 边界校验。
+    locked_indices: set/list，stores 列表中需要锁定访问位置的索引（0-indexed）。
+                    锁定门店会被转换为 OR-Tools 硬约束 {访问步数: 矩阵节点}，
+                    在全局 N×N 距离矩阵中进行整体优化，未锁定门店自由调度。
+    fleet_matrix:   build_fleet_matrix() 的结果；提供时直接切片，不再请求矩阵。
+    profile:        求解预算场景，交互式 reorder 传 "warm"。
+    warm_start:     True 时以 stores 的当前顺序作为初始解（只做改进，不重新构造）。
+
+    返回 (optimized_stores: [Store], stats_dict) 或 (None, error_string)。
+    stats_dict 包含 duration_min, duration_sec, distance_km,
+               以及 locks_honored (bool) 表示锁定约束是否被满足。
+    """
+    valid_stores = list(stores)
+
+    if not valid_stores:
+        return None, "Inga butiker med giltiga koordinater"
+
+    if len(valid_stores) == 1:
+        return valid_stores, {"duration_min": 0, "duration_sec": 0,
+                              "distance_km": 0.0, "locks_honored": True}
+
+    print(f"[OPTIMIZE] stores={len(valid_stores)}")
+
+    # ── 构建 locked_positions: {访问步数 → 矩阵节点索引} ──
+    # 矩阵节点编号：0 = 仓库，1..n = stores[0..n-1]。
+    # 步数编号：depot = 0，第 1 站 = 1，第 2 站 = 2，…
+    # 前端发送的 stores 列表已是用户期望的顺序，锁定门店钉死在当前位置，
+    # 所以 stores[k] 对应的矩阵节点 = k+1，步数也 = k+1。
+    locked_positions = None  # dict {step(int): matrix_node(int)}
+    if locked_indices:
+        lp = {i + 1: i + 1 for i in sorted(set(locked_indices)) if 0 <= i < len(valid_stores)}
+        if lp:
+            locked_positions = lp
+            print(f"[OPTIMIZE] locked_positions (step→node): {locked_positions}")
+
+    # 当前顺序即矩阵节点 1..n；锁定门店本就在自己的槽位上，天然满足约束
+    initial_order = list(range(1, len(valid_stores) + 1)) if warm_start else None
+
+    # ── 距离矩阵 + OR-Tools TSP ──────────────────────────────
+    time_m, dist_m = _route_matrices([WAREHOUSE] + valid_stores, fleet_matrix)
+    solved = _solve_with_metrics(
+        time_m, locked_positions=locked_positions, profile=profile,
+        initial_order=initial_order,
+    )
+    return _apply_solution(valid_stores, solved, time_m, dist_m)
+
+
+def _route_matrices(all_nodes, fleet_matrix=None):
+    """
+    all_nodes（仓库在前）的 (time_matrix秒, dist_matrix米)。
+    有整车队矩阵时直接切片；矩阵后端失败时回退到 Haversine（本地计算，零成本，总是成功）。
+    """
+    time_m, dist_m = (_slice_fleet_matrix(fleet_matrix, all_nodes)
+                      if fleet_matrix else (None, None))
+    if not time_m:
+        time_m, dist_m = _distance_matrix(all_nodes, all_nodes)
+    if time_m and len(time_m) == len(all_nodes):
+        return time_m, dist_m
+    print(f"[OPTIMIZE] {_matrix_provider()} 矩阵失败，回退到 Haversine + OR-Tools（本地计算）…")
+    return _distance_matrix_haversine(all_nodes, all_nodes)
+
+
+def _apply_solution(stores, solved, time_m, dist_m):
+    """
+    把 _solve_with_metrics 的结果 (full_order, locks_honored, metrics) 换算成
+    optimize_route 的返回值 (optimized_stores, stats_dict)。
+    """
+    full_order, locks_honored, metrics = solved
+    store_order = [idx - 1 for idx in full_order if idx > 0]
+    optimized   = [stores[i] for i in store_order]
+    print(f"[OPTIMIZE] ✓ TSP order: {store_order} (locks_honored={locks_honored})")
+    stats = _stats_from_matrices(full_order, time_m, dist_m)
+    stats["locks_honored"] = locks_honored
+    stats["solver"]        = metrics
+    return optimized, stats
+
+
+def get_route_stats(ordered_stores):
+    """
+    计算已排好序的路线（[Store]）的时间/距离统计（供 reorder 场景使用）。
+    只需要 仓库 → store[0] → … → store[n-1] → 仓库 这 n+1 段，
+    由 _route_legs 逐段读取 / 请求，不拉取完整矩阵。
+    Returns dict with duration_min, duration_sec, distance_km, legs.
+    """
+    if not ordered_stores:
+        return {"duration_min": 0, "duration_sec": 0, "distance_km": 0.0}
+
+    path = [WAREHOUSE] + list(ordered_stores) + [WAREHOUSE]
+    print(f"[STATS] 逐段统计 {len(path) - 1} 段…")
+    legs = _route_legs(path)
+    if not legs:
+        print(f"[STATS] ✗ Leg fetch failed, returning None")
+        return None
 
-        print("[OR-TOOLS] ✗ 无约束也未找到解，回退到贪心算法")
-        return _greedy_tsp_from(matrix, start), no_lock_requested
+    # OSRM 返回浮点数，累加后取整
+    total_sec  = round(sum(t for t, _ in legs))
+    total_dist = round(sum(d for _, d in legs))
 
+    hours = total_sec // 3600
+    mins  = (total_sec % 3600) // 60
+    dur_str = f"{hours}h {mins}min" if hours > 0 else f"{mins}min"
+    print(f"[STATS] ✓ {dur_str} ({total_sec}s) {round(total_dist/1000,1)}km")
+    return {
+        "duration_min":  round(total_sec / 60),
+        "duration_sec":  total_sec,
+        "distance_km":   round(total_dist / 1000, 1),
+        "legs":          [[round(t, 1), round(d, 1)] for t, d in legs],
+    }
+
+
+def generate_urls(optimized_stores):
+    """
+    生成 Google Maps 分段导航链接（每段最多 11 个点）。
+    仓库用坐标字符串，门店用名称（Google Maps 中显示店名）。
+    """
+    urls   = []
+    path   = [WAREHOUSE_COORD] + [s.name for s in optimized_stores] + [WAREHOUSE_COORD]
+    for i in range(0, len(path) - 1, 10):
+        chunk  = path[i: i+11]
+        origin = chunk[0]; dest = chunk[-1]; wps = chunk[1:-1]
+        wp_str = ""
+        if wps:
+            wp_str = "&waypoints=" + urllib.parse.quote(
+                "|".join(wps))
+        urls.append(
+            f"https://www.google.com/maps/dir/?api=1"
+            f"&origin={urllib.parse.quote(origin)}"
+            f"&destination={urllib.parse.quote(dest)}{wp_str}"
+        )
+    return urls
+
+
+def _driver_result(driver, unmatched, optimized, stats_or_err):
+    """把单个司机的 optimize_route 结果 (optimized, stats_or_err) 组装成结果 dict。"""
+    if not optimized:
+        return {"status": "error", "error": str(stats_or_err)}
+
+    urls = generate_urls(optimized)
+
+    dur_sec = stats_or_err.get('duration_sec', stats_or_err.get('duration_min', 0) * 60)
+    hours   = dur_sec // 3600
+    mins    = (dur_sec % 3600) // 60
+    dur_str = f"{hours} h {mins} min" if hours > 0 else f"{mins} min"
+
+    print(f"[RUN_ALL] {driver}: {dur_str} ({dur_sec}s) "
+          f"{stats_or_err['distance_km']}km")
+    return {
+        "status":        "ok",
+        "stores":        [s.name for s in optimized],
+        "store_objects": [s.to_dict() for s in optimized],
+        "store_count":   len(optimized),
+        "urls":          urls,
+        "duration":      dur_str,
+        "duration_sec":  dur_sec,
+        "distance":      f"{stats_or_err['distance_km']} km",
+        "unmatched":     unmatched if isinstance(unmatched, list) else [],
+        "unmatched_count": len(unmatched) if isinstance(unmatched, list) else 0,
+        "solver_metrics": stats_or_err.get("solver"),
+        "legs":          stats_or_err.get("legs"),
+    }
+
+
+def _solve_pool(workers):
+    """
+    创建求解进程池。子进程用 spawn 启动而不是 fork：gunicorn worker 里同时运行着
+    请求线程、调度器和邮件线程，fork 会把其他线程持有的锁（HTTP 连接池、缓存、stdio）
+    以加锁状态复制进子进程，还会继承调度锁 fd 和打开的 SQLite 连接。
+    spawn 出的子进程重新导入本模块（启动段只在主进程执行），
+    只接收矩阵和求解参数（_solve_with_metrics），不接触网络、缓存和状态库。
+    """
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+def run_all_drivers(progress=None):
+    """
+    为所有司机生成路线，返回按 DRIVERS 顺序的结果 dict。
+    progress(event, driver=None, **data) 可选，每个司机依次收到
+    loaded → matrix → solved → stats 事件（stats 携带完整结果）。
+    """
+    results = {}
+    emit    = progress or (lambda event, driver=None, **data: None)
+    print(f"[RUN_ALL] 开始为所有司机优化路线")
+
+    def finish(driver, result):
+        results[driver] = result
+        if result.get("status") == "ok":
+            emit("solved", driver, solve_ms=(result.get("solver_metrics") or {}).get("solve_ms"))
+        emit("stats", driver, status=result.get("status"),
+             duration=result.get("duration"), distance=result.get("distance"), result=result)
+
+    # 坐标表 / 路线表每次生成只解析一次，所有司机共享同一快照
+    snapshot = load_workbook_snapshot()
+
+    loaded = {}
+    for driver in DRIVERS:
+        try:
+            loaded[driver] = load_and_merge_data(driver, snapshot)
+        except Exception as e:
+            finish(driver, {"status": "error", "error": str(e)})
+            continue
+        stores, unmatched = loaded[driver]
+        emit("loaded", driver, stores=len(stores),
+             unmatched=len(unmatched) if isinstance(unmatched, list) else 0)
+
+    # 整车队一次矩阵请求，各司机从中切片
+    fleet = None
+    if FLEET_MATRIX:
+        fleet = build_fleet_matrix([s for stores, _ in loaded.values() for s in stores])
+    # 新一次生成的矩阵；do_generate 确定 generated_at 后结束 pending
+    _route_matrix_memo.update(pending=True, fleet=fleet, drivers={})
+    source = "fleet" if fleet else "driver"
+
+    # 矩阵都在本进程中获取（切片 / 缓存 / OSRM），拿到后立即上报 matrix 事件；
+    # 求解进程只做纯计算。
+    todo = {}   # driver → (stores, unmatched, time_m, dist_m)
+    for driver, (stores, unmatched) in loaded.items():
+        try:
+            if len(stores) < 2:
+                # 没有门店或只有一家：不需要矩阵和求解
+                emit("matrix", driver, source=source)
+                if not stores:
+                    err = unmatched if isinstance(unmatched, str) else "未匹配到任何门店"
+                    finish(driver, {"status": "error", "error": err})
+                else:
+                    finish(driver, _driver_result(driver, unmatched, *optimize_route(stores)))
+                continue
+            time_m, dist_m = _route_matrices([WAREHOUSE] + stores, fleet)
+        except Exception as e:
+            finish(driver, {"status": "error", "error": str(e)})
+            continue
+        emit("matrix", driver, source=source)
+        todo[driver] = (stores, unmatched, time_m, dist_m)
+
+    def solved(driver, solve):
+        stores, unmatched, time_m, dist_m = todo[driver]
+        try:
+            route  = _apply_solution(stores, solve(), time_m, dist_m)
+            result = _driver_result(driver, unmatched, *route)
+        except Exception as e:
+            result = {"status": "error", "error": str(e)}
+        finish(driver, result)
+
+    # 每个司机的输入相同、互不共享状态，并行与顺序执行得到相同的逐司机结果；
+    # 进程数不超过 CPU 核数，保证每次求解拿到完整的计算资源。
+    workers = min(SOLVE_WORKERS, len(todo), os.cpu_count() or 1)
+    if workers > 1:
+        print(f"[RUN_ALL] 并行求解: {workers} 个进程")
+        with _solve_pool(workers) as pool:
+            futures = {pool.submit(_solve_with_metrics, time_m): driver
+                       for driver, (_, _, time_m, _) in todo.items()}
+            # 按完成顺序上报进度，先算完的司机先出现在看板上
+            for fut in as_completed(futures):
+                solved(futures[fut], fut.result)
+    else:
+        for driver, (_, _, time_m, _) in todo.items():
+            solved(driver, lambda: _solve_with_metrics(time_m))
+    return {d: results[d] for d in DRIVERS}
+
+
+# ── 车队 VRP ─────────────────────────────────────────────────
+# 路线表按列把门店固定分给司机，每个司机单独求 TSP，路线长短可能相差很大。
+# 车队模式把所有门店放进一个多车辆 VRP（每个司机一辆车，都从仓库出发并返回），
+# 目标为 makespan（最长路线最短，即均衡加班）或 total（总行驶时间最短），
+# 可选每个司机的最多门店数 / 最长时长。以路线表的分配（各自按 TSP 排好序）作为初始解，
+# 结果只作为报告与路线表分配并列给出，不改动当前路线。
+def _ortools_vrp(matrix, routes, max_stops=None, max_duration=None, objective="makespan",
+                 profile="fleet"):
+    """
+    matrix: 节点 0 为仓库的秒数矩阵；routes: 每辆车的初始路线（节点列表，不含仓库）。
+    max_stops / max_duration: 每辆车的上限列表，元素为 None 表示不限。
+    约束过紧时允许放弃门店（高惩罚），返回未分配节点而不是整体无解。
+    返回 (routes, dropped_nodes, objective_value)；OR-Tools 不可用或无解时返回 None。
+    """
+    try:
+        from ortools.constraint_solver import routing_enums_pb2
+        from ortools.constraint_solver import pywrapcp
+    except ImportError:
+        print("[VRP] ✗ ortools 未安装")
+        return None
+
+    n, v = len(matrix), len(routes)
+    max_duration = max_duration or [None] * v
+    max_stops    = max_stops or [None] * v
+    # OR-Tools 对非正容量直接 abort 整个进程，不能交给它检查
+    if any(x is not None and x <= 0 for x in [*max_duration, *max_stops]):
+        print("[VRP] ✗ 上限必须为正数")
+        return None
+    int_matrix = np.asarray(matrix, dtype=np.float64).astype(np.int64).tolist()
+    horizon    = int(sum(max(row) for row in int_matrix)) + 1   # 任何一条路线的时长上界
+
+    manager = pywrapcp.RoutingIndexManager(n, v, 0)
+    routing = pywrapcp.RoutingModel(manager)
+    transit_idx = routing.RegisterTransitMatrix(int_matrix)
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_idx)
+
+    routing.AddDimensionWithVehicleCapacity(
+        transit_idx, 0, [int(d) if d else horizon for d in max_duration], True, "time")
+    if objective == "makespan":
+        routing.GetDimensionOrDie("time").SetGlobalSpanCostCoefficient(FLEET_SPAN_COEFF)
+
+    if any(max_stops):
+        stop_idx = routing.RegisterUnaryTransitVector([0] + [1] * (n - 1))
+        routing.AddDimensionWithVehicleCapacity(
+            stop_idx, 0, [int(s) if s else n for s in max_stops], True, "stops")
+
+    # 放弃一个门店的代价高于它可能带来的任何弧成本 + makespan 成本
+    penalty = horizon * (FLEET_SPAN_COEFF + 1)
+    for node in range(1, n):
+        routing.AddDisjunction([manager.NodeToIndex(node)], penalty)
+
+    budget = _solver_budget(n, profile)
+    sp = pywrapcp.DefaultRoutingSearchParameters()
+    sp.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION
+    sp.local_search_metaheuristic = (
+        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+        if budget["guided"] else
+        routing_enums_pb2.LocalSearchMetaheuristic.GREEDY_DESCENT
+    )
+    _set_solver_limits(sp, budget)
+    _ortools_stall_limit(routing, budget["stall_solutions"])
+
+    solution = None
+    routing.CloseModelWithParameters(sp)
+    initial = routing.ReadAssignmentFromRoutes([list(r) for r in routes], True)
+    if initial:
+        solution = routing.SolveFromAssignmentWithParameters(initial, sp)
+    else:
+        print("[VRP] 路线表分配不满足上限约束，改为冷启动")
+    if not solution:
+        solution = routing.SolveWithParameters(sp)
+    if not solution:
+        print("[VRP] ✗ 未找到解")
+        return None
+
+    out, visited = [], set()
+    for vehicle in range(v):
+        order, index = [], solution.Value(routing.NextVar(routing.Start(vehicle)))
+        while not routing.IsEnd(index):
+            order.append(manager.IndexToNode(index))
+            index = solution.Value(routing.NextVar(index))
+        out.append(order)
+        visited.update(order)
+    dropped = [i for i in range(1, n) if i not in visited]
+    return out, dropped, solution.ObjectiveValue()
+
+
+def _route_summary(stores, order, time_m, dist_m):
+    """order 为节点列表（不含仓库），返回报告中单个司机的条目。"""
+    stats = _stats_from_matrices(order, time_m, dist_m) if order else {
+        "duration_sec": 0, "distance_km": 0.0}
+    dur_sec = stats["duration_sec"]
+    return {
+        "stores":       [stores[i - 1].name for i in order],
+        "store_count":  len(order),
+        "duration_sec": dur_sec,
+        "duration":     (f"{dur_sec // 3600} h {(dur_sec % 3600) // 60} min" if dur_sec >= 3600
+                         else f"{dur_sec // 60} min"),
+        "distance_km":  stats["distance_km"],
+    }
+
+
+def _fleet_totals(routes):
+    durations = [r["duration_sec"] for r in routes.values()]
+    return {"makespan_sec": max(durations, default=0), "total_sec": sum(durations),
+            "spread_sec": max(durations, default=0) - min(durations, default=0)}
+
+
+def rebalance_fleet(objective="makespan", max_stops=None, max_duration_sec=None, progress=None):
+    """
+    对路线表的全部门店求车队 VRP，返回与路线表分配并列的报告。
+    max_stops / max_duration_sec: 全体统一的 int，或 {司机: int}。
+    progress: 可选回调 progress(event, **data)，矩阵就绪和开始求解时各调用一次。
+    失败时返回 {"error": ...}。
+    """
+    progress = progress or (lambda *a, **k: None)
+    snapshot = load_workbook_snapshot()
+    loaded   = {}
+    for driver in DRIVERS:
+        stores, unmatched = load_and_merge_data(driver, snapshot)
+        if isinstance(unmatched, str):
+            return {"error": unmatched}
+        loaded[driver] = stores
+    vehicles = [d for d in DRIVERS if d in loaded]
+    # 每次出现都是一次拜访：同一门店出现在两列时保留两个节点
+    stores = [s for d in vehicles for s in loaded[d]]
+    if not stores:
+        return {"error": "Inga butiker i ruttfilen"}
+
+    fleet = _route_memo()["fleet"]
+    time_m, dist_m = _slice_fleet_matrix(fleet, [WAREHOUSE] + stores) if fleet else (None, None)
+    if time_m is None:
+        fleet = build_fleet_matrix(stores)
+        if not fleet:
+            return {"error": "Avståndsmatris kunde inte hämtas"}
+        time_m, dist_m = _slice_fleet_matrix(fleet, [WAREHOUSE] + stores)
+    progress("matrix", nodes=len(stores) + 1)
+
+    # 路线表分配：每个司机的门店节点，按 TSP 排序后作为初始解和对比基准
+    baseline, offset = {}, 1
+    for d in vehicles:
+        nodes = list(range(offset, offset + len(loaded[d])))
+        offset += len(nodes)
+        if len(nodes) > 1:
+            sub = [[time_m[a][b] for b in [0] + nodes] for a in [0] + nodes]
+            order, _, _ = _solve_tsp(sub, 0, profile="interactive")
+            nodes = [nodes[i - 1] for i in order]
+        baseline[d] = nodes
+
+    def per_driver(value):
+        if isinstance(value, dict):
+            return [value.get(d) for d in vehicles]
+        return [value] * len(vehicles)
+
+    spreadsheet = {d: _route_summary(stores, baseline[d], time_m, dist_m) for d in vehicles}
+    max_duration = per_driver(max_duration_sec)
+    if objective == "total":
+        # 只看总时长时车辆没有固定成本，门店会集中到少数司机身上；
+        # 未指定上限的司机不超过路线表分配中最长路线的时长（不比现在加班更多）
+        cap = _fleet_totals(spreadsheet)["makespan_sec"]
+        max_duration = [m or cap for m in max_duration]
+
+    progress("solving", time_limit_ms=_solver_budget(len(stores) + 1, "fleet")["time_limit_ms"])
+    t0 = time.perf_counter()
+    solved = _ortools_vrp(time_m, [baseline[d] for d in vehicles],
+                          max_stops=per_driver(max_stops),
+                          max_duration=max_duration, objective=objective)
+    if solved is None:
+        return {"error": "Flottoptimering misslyckades (kräver OR-Tools)"}
+    routes, dropped, obj = solved
+    solve_ms = round((time.perf_counter() - t0) * 1000)
+
+    rebalanced  = {d: _route_summary(stores, r, time_m, dist_m) for d, r in zip(vehicles, routes)}
+    for d in vehicles:
+        before, after = set(spreadsheet[d]["stores"]), set(rebalanced[d]["stores"])
+        rebalanced[d]["moved_in"]  = sorted(after - before)
+        rebalanced[d]["moved_out"] = sorted(before - after)
+
+    totals = {"spreadsheet": _fleet_totals(spreadsheet), "rebalanced": _fleet_totals(rebalanced)}
+    print(f"[VRP] ✓ {len(stores)} 门店 / {len(vehicles)} 司机 | {objective} | "
+          f"makespan {totals['spreadsheet']['makespan_sec']}s → {totals['rebalanced']['makespan_sec']}s"
+          f" | {solve_ms}ms")
+    return {
+        "objective":   objective,
+        "spreadsheet": spreadsheet,
+        "rebalanced":  rebalanced,
+        "totals":      totals,
+        "unassigned":  [stores[i - 1].name for i in dropped],
+        "solver":      {"solve_ms": solve_ms, "objective_value": obj, "nodes": len(stores) + 1},
+    }
+
+
+# ── 后台任务 ─────────────────────────────────────────────────
+# 每次生成（手动 / 定时）对应一个 job，按顺序记录进度事件：
+#   started → 每个司机 loaded / matrix / solved / stats → done | failed
+# 车队 VRP 报告同样作为 job（trigger = fleet）在后台求解，避免请求超过 gunicorn 超时：
+#   started → matrix → solving → done（事件中带 report）| failed
+# 看板通过 /api/jobs/<id>/events（SSE）实时接收，不再轮询 /api/status。
+# job 同时写入状态库，其他 worker 收到的 SSE 请求轮询状态库转发。
+JOB_HISTORY  = 20
+JOB_POLL_SEC = 1.0
+jobs         = {}                      # 本进程运行的 job：job_id → job（插入顺序即时间顺序）
+_jobs_cond   = threading.Condition()
+
+
+def _utc_now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _persist_job(job_id, payload):
+    try:
+        conn = _state_db_connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO jobs (id, created, job) VALUES (?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET job = excluded.job",
+                    (job_id, time.time(), payload),
+                )
+                conn.execute(
+                    "DELETE FROM jobs WHERE id NOT IN "
+                    "(SELECT id FROM jobs ORDER BY created DESC LIMIT ?)", (JOB_HISTORY,),
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[JOB] ✗ 写入状态库失败: {e}")
+
+
+def _load_jobs(job_id=None, limit=JOB_HISTORY):
+    """从状态库读取 job（新的在前）；指定 job_id 时返回该 job 或 None。"""
+    conn = _state_db_connect()
+    try:
+        if job_id:
+            row = conn.execute("SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return json.loads(row[0]) if row else None
+        return [json.loads(j) for (j,) in conn.execute(
+            "SELECT job FROM jobs ORDER BY created DESC LIMIT ?", (limit,))]
+    finally:
+        conn.close()
+
+
+def _new_job(trigger, job_id=None):
+    job = {
+        "id":          job_id or uuid.uuid4().hex[:12],
+        "trigger":     trigger,          # manual | scheduled | fleet
+        "status":      "running",        # running | done | failed
+        "started_at":  _utc_now(),
+        "finished_at": None,
+        "error":       None,
+        "progress":    {},               # driver → 最近完成的阶段
+        "events":      [],
+    }
+    with _jobs_cond:
+        jobs[job["id"]] = job
+        while len(jobs) > JOB_HISTORY:
+            jobs.pop(next(iter(jobs)))
+        payload = json.dumps(job, ensure_ascii=False)
+    _persist_job(job["id"], payload)
+    return job
+
+
+def _job_event(job, event, driver=None, **data):
+    """
+    追加一条进度事件（seq 从 1 递增，作为 SSE 的 id）并唤醒等待中的 SSE 连接。
+    先写状态库再唤醒：客户端收到 done / failed 后立即查询 /api/jobs/<id> 也能看到最终状态。
+    """
+    with _jobs_cond:
+        ev = {"seq": len(job["events"]) + 1, "event": event, "driver": driver,
+              "at": _utc_now(), **data}
+        job["events"].append(ev)
+        if driver:
+            job["progress"][driver] = event
+        if event in ("done", "failed"):
+            job["status"]      = event
+            job["finished_at"] = ev["at"]
+            job["error"]       = data.get("error")
+        payload = json.dumps(job, ensure_ascii=False)
+    _persist_job(job["id"], payload)
+    with _jobs_cond:
+        _jobs_cond.notify_all()
+
+
+def _job_summary(job):
+    return {k: v for k, v in job.items() if k != "events"}
+
+
+def do_generate(job=None):
+    # ★ 手动生成时 api_generate() 已登记 running 并创建 job（避免竞态）；
+    #   定时任务在这里登记，其他 worker 正在生成时跳过本次
+    if job is None:
+        job_id = uuid.uuid4().hex[:12]
+        busy = _claim_running(job_id)
+        if busy:
+            print(f"[JOB] 生成任务 {busy} 正在运行，跳过定时生成")
+            return
+        bump_status_version()
+        job = _new_job("scheduled", job_id)
+    _job_event(job, "started", drivers=DRIVERS)
+    error = None
+    try:
+        state["results"]      = run_all_drivers(progress=functools.partial(_job_event, job))
+        state["generated_at"] = _utc_now()
+        save_state(meta=("generated_at",))
+        export_state_json()
+        archive_routes(state["results"], "generate", job_id=job["id"])
+    except Exception as e:
+        import traceback
+        error = str(e)
+        print(f"[JOB] ✗ {job['id']} 生成失败: {e}\n{traceback.format_exc()}")
+    finally:
+        _route_matrix_memo.update(pending=False, generated_at=state.get("generated_at"))
+        _release_running(job["id"])
+        bump_status_version(DRIVERS if not error else ())
+    # running 复位后再发结束事件，前端收到后拉取的状态已是最终结果
+    if error:
+        _job_event(job, "failed", error=error)
+    else:
+        _job_event(job, "done", generated_at=state["generated_at"])
+
+
+_fleet_lock = threading.Lock()
+
+
+def start_rebalance(objective, max_stops=None, max_duration_sec=None):
+    """
+    在后台线程运行车队 VRP，返回 (job, None)；本进程已有车队 job 在运行时返回 (None, 其 id)，
+    同一 worker 不并行跑多个几十秒的求解。
+    """
+    with _fleet_lock:
+        with _jobs_cond:
+            busy = next((j["id"] for j in jobs.values()
+                         if j["trigger"] == "fleet" and j["status"] == "running"), None)
+        if busy:
+            return None, busy
+        job = _new_job("fleet")
+    threading.Thread(target=do_rebalance, args=(job, objective, max_stops, max_duration_sec),
+                     daemon=True).start()
+    return job, None
+
+
+def do_rebalance(job, objective, max_stops=None, max_duration_sec=None):
+    _job_event(job, "started", objective=objective)
+    try:
+        report = rebalance_fleet(objective, max_stops, max_duration_sec,
+                                 progress=functools.partial(_job_event, job))
     except Exception as e:
         import traceback
-        print(f"[OR-TOOLS] ✗ 异常，回退到贪心算法: {e}\n{traceback.format_exc()}")
-        return _greedy_tsp_from(matrix, start), (not locked_positions)
+        print(f"[VRP] ✗ {job['id']} 车队优化失败: {e}\n{traceback.format_exc()}")
+        report = {"error": f"Internt fel: {e}"}
+    if "error" in report:
+        _job_event(job, "failed", error=report["error"])
+    else:
+        _job_event(job, "done", report=report)
 
 
-def _stats_from_matrices(full_order, time_matrix, dist_matrix):
-    """
-    直接从已有的时间/距离矩阵计算路线总统计，完全不调用任何 API。
+def reschedule(hour, minute):
+    if scheduler.get_job("daily_gen"):
+        scheduler.remove_job("daily_gen")
+    # ★ 必须指定时区，否则 CronTrigger 使用服务器默认时区（常为 UTC）
+    #   导致用户设置 16:26 本地时间，实际在 UTC 16:26 才触发
+    from zoneinfo import ZoneInfo
+    tz = ZoneInfo("Europe/Stockholm")
+    scheduler.add_job(do_generate, CronTrigger(hour=hour, minute=minute, timezone=tz),
+                      id="daily_gen", replace_existing=True)
+    print(f"[SCHEDULE] Armed daily job at {hour:02d}:{minute:02d} Europe/Stockholm")
 
-    full_order: OR-Tools / 贪心返回的顺序列表（不含起点 0），
-                路线为 0 → full_order[0] → ... → full_order[-1] → 0
-    time_matrix: N×N 秒数矩阵
-    dist_matrix: N×N 距离矩阵（米）
 
-    返回 stats dict。
-    """
-    route = [0] + list(full_order)   # 仓库(0) → 所有门店
-    total_sec  = 0
-    total_dist = 0
-    for i in range(len(route) - 1):
-        a, b = route[i], route[i + 1]
-        total_sec  += time_matrix[a][b]
-        total_dist += dist_matrix[a][b]
-    # 最后一站返回仓库
-    total_sec  += time_matrix[route[-1]][0]
-    total_dist += dist_matrix[route[-1]][0]
+def is_scheduler_leader():
+    return _leader["fh"] is not None
 
-    # OSRM 返回浮点数，累加后可能有精度漂移，取整
-    total_sec  = round(total_sec)
-    total_dist = round(total_dist)
 
-    hours = total_sec // 3600
-    mins  = (total_sec % 3600) // 60
-    dur_str = f"{hours}h {mins}min" if hours > 0 else f"{mins}min"
-    print(f"[STATS-MATRIX] ✓ {dur_str} ({total_sec}s) {round(total_dist/1000,1)}km "
-          f"[直接从矩阵计算，无额外 API 调用]")
-    return {
-        "duration_min":  round(total_sec / 60),
-        "duration_sec":  total_sec,
-        "distance_km":   round(total_dist / 1000, 1),
-    }
+def apply_schedule():
+    """leader 进程把 state 中的定时设置装载到调度器（未变化时不动）；非 leader 不做任何事。"""
+    sched = (state["schedule_hour"], state["schedule_minute"])
+    if is_scheduler_leader() and _leader["schedule"] != sched:
+        reschedule(*sched)
+        _leader["schedule"] = sched
 
 
-def optimize_route(stores, locked_indices=None):
+def _try_become_leader():
     """
-    对门店列表进行路线优化（使用 OSRM + OR-Tools TSP）。
-
-    locked_indices: set/list，stores 列表中需要锁定访问位置的索引（0-indexed）。
-                    锁定门店会被转换为 OR-Tools 硬约束 {访问步数: 矩阵节点}，
-                    在全局 N×N 距离矩阵中进行整体优化，未锁定门店自由调度。
-
-    返回 (optimized_stores, stats_dict) 或 (None, error_string)。
-    stats_dict 包含 duration_min, duration_sec, distance_km,
-               以及 locks_honored (bool) 表示锁定约束是否被满足。
+    非阻塞获取 SCHEDULER_LOCK_FILE 的排他锁；拿到锁的进程启动调度器。
+    锁随进程退出自动释放，不需要清理。不支持 fcntl 的平台按单进程处理。
     """
-    valid_stores = [s for s in stores if s.get('lat') and s.get('lng')
-                    and str(s['lat']).strip() not in ('', 'nan', 'None')
-                    and str(s['lng']).strip() not in ('', 'nan', 'None')]
+    fh = open(SCHEDULER_LOCK_FILE, "a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fh.close()
+            return False
+    _leader["fh"] = fh
+    print(f"[SCHEDULE] pid {os.getpid()} 成为调度 leader")
+    scheduler.start()
+    apply_schedule()
+    return True
+
+
+def _leader_loop():
+    """后台线程：非 leader 定期重试拿锁（接管退出的 leader）；leader 定期同步定时设置。"""
+    while True:
+        time.sleep(LEADER_RETRY_SEC)
+        try:
+            if not is_scheduler_leader():
+                _try_become_leader()
+            if is_scheduler_leader():
+                sync_state()
+        except Exception as e:
+            print(f"[SCHEDULE] ✗ leader 检查失败: {e}")
+
+
+# ── 导出 ─────────────────────────────────────────────────────
+# 行数据全部用生成器逐行产出，openpyxl 用 write-only 模式（边写边落盘），
+# 文件写到匿名临时文件后分块发送，进程内存与导出行数无关。
+# 停靠点表的各段时间 / 距离来自求解时随结果保存的 legs，导出时不访问 OSRM；
+# 没有 legs 的旧结果只导出停靠顺序，时间 / 距离留空。
+EXPORT_STOP_FIELDS = ("generated_at", "driver", "position", "store", "lat", "lng",
+                      "leg_sec", "leg_m", "cum_sec", "cum_m")
+
+_XL = {
+    "hdr_fill":  PatternFill("solid", fgColor="1A1A2E"),
+    "hdr_font":  Font(color="F5A623", bold=True, size=11),
+    "ok_fill":   PatternFill("solid", fgColor="0D2137"),
+    "err_fill":  PatternFill("solid", fgColor="2D1A1A"),
+    "wht_font":  Font(color="E0E0E0", size=10),
+    "link_font": Font(color="4A9FD4", size=9, underline="single"),
+    "center":    Alignment(horizontal="center", vertical="center"),
+    "left_wrap": Alignment(horizontal="left",   vertical="center", wrap_text=True),
+    "thin":      Border(**{s: Side(style='thin', color='333355')
+                           for s in ('left', 'right', 'top', 'bottom')}),
+}
 
-    if not valid_stores:
-        return None, "Inga butiker med giltiga koordinater"
 
-    if len(valid_stores) == 1:
-        return valid_stores, {"duration_min": 0, "duration_sec": 0,
-                              "distance_km": 0.0, "locks_honored": True}
+def _stop_rows_for(driver, r, generated_at):
+    """单个司机的停靠点行：仓库出发 → 各门店 → 返回仓库，附每段和累计的时间 / 距离。"""
+    stores = [Store.from_dict(s) for s in r.get("store_objects", [])]
+    legs   = r.get("legs")
+    if not legs or len(legs) != len(stores) + 1:
+        legs = None
+    stops = [WAREHOUSE] + stores + [WAREHOUSE]
+    cum_sec = cum_m = 0.0
+    for pos, s in enumerate(stops):
+        leg_sec = leg_m = None
+        if pos and legs:
+            leg_sec, leg_m = (float(v) for v in legs[pos - 1])
+            cum_sec += leg_sec
+            cum_m   += leg_m
+        yield {
+            "generated_at": generated_at,
+            "driver":       driver,
+            "position":     pos,
+            "store":        s.name if s else r["store_objects"][pos - 1].get("name", ""),
+            "lat":          s.lat if s else None,
+            "lng":          s.lng if s else None,
+            "leg_sec":      leg_sec,
+            "leg_m":        leg_m,
+            "cum_sec":      round(cum_sec, 1) if legs else None,
+            "cum_m":        round(cum_m, 1) if legs else None,
+        }
 
-    print(f"[OPTIMIZE] stores={len(valid_stores)}")
 
-    # ── 构建 locked_positions: {访问步数 → 矩阵节点索引} ──
-    # stores 可能有坐标缺失而被过滤的项，需要建立 stores→valid_stores 索引映射。
-    # 矩阵节点编号：0 = 仓库，1..n = valid_stores[0..n-1]。
-    # 步数编号：depot = 0，第 1 站 = 1，第 2 站 = 2，…
-    # 所以 valid_stores[k] 对应的矩阵节点 = k+1，步数也 = k+1。
-    locked_positions = None  # dict {step(int): matrix_node(int)}
-    if locked_indices:
-        locked_set = set(locked_indices)
-        # stores 原始索引 → valid_stores 索引
-        valid_idx_map = {}
-        vi = 0
-        for orig_i, s in enumerate(stores):
-            if (s.get('lat') and s.get('lng')
-                    and str(s['lat']).strip() not in ('', 'nan', 'None')
-                    and str(s['lng']).strip() not in ('', 'nan', 'None')):
-                valid_idx_map[orig_i] = vi
-                vi += 1
-
-        # 构建 {step: node}
-        # 前端发送的 stores 列表已是用户期望的顺序，
-        # locked 的门店应该钉死在 valid_stores 空间中的对应位置。
-        # valid_idx = valid_idx_map[orig_i]，矩阵节点 = valid_idx + 1，
-        # 步数 = valid_idx + 1（depot=0 出发后第 1 站步数=1）。
-        lp = {}
-        for orig_i in sorted(locked_set):
-            if orig_i not in valid_idx_map:
-                continue
-            valid_idx = valid_idx_map[orig_i]
-            matrix_node = valid_idx + 1
-            step = valid_idx + 1
-            lp[step] = matrix_node
-        if lp:
-            locked_positions = lp
-            print(f"[OPTIMIZE] locked_positions (step→node): {locked_positions} "
-                  f"（stores 原始索引 {sorted(locked_set & set(valid_idx_map))}）")
+def export_stop_rows(drivers=None):
+    """当前结果中每个停靠点一行（dict，键为 EXPORT_STOP_FIELDS），按司机顺序逐行产出。"""
+    generated_at = state.get("generated_at")
+    for driver in drivers or DRIVERS:
+        r = state["results"].get(driver)
+        if r and r.get("status") == "ok":
+            yield from _stop_rows_for(driver, r, generated_at)
+
+
+def _stream_csv(rows):
+    """逐行生成 CSV 文本（带 BOM，Excel 直接打开不乱码）。"""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_STOP_FIELDS)
+    buf.write("\ufeff")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        if buf.tell() > 64 * 1024:
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate()
+    yield buf.getvalue()
+
+
+def _write_parquet(rows, batch_size=10000):
+    """按 batch_size 行一个 row group 写入临时文件，返回已回到开头的文件对象。"""
+    schema = pa.schema([
+        ("generated_at", pa.string()), ("driver", pa.string()), ("position", pa.int32()),
+        ("store", pa.string()), ("lat", pa.float64()), ("lng", pa.float64()),
+        ("leg_sec", pa.float64()), ("leg_m", pa.float64()),
+        ("cum_sec", pa.float64()), ("cum_m", pa.float64()),
+    ])
+    tmp = tempfile.TemporaryFile()
+    with pq.ParquetWriter(tmp, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    tmp.seek(0)
+    return tmp
+
+
+def _xl_row(ws, values, fill, font=None, align=None):
+    cells = []
+    for v in values:
+        c = WriteOnlyCell(ws, value=v)
+        c.fill, c.font, c.border = fill, font or _XL["wht_font"], _XL["thin"]
+        c.alignment = align or _XL["center"]
+        cells.append(c)
+    return cells
+
+
+def _xl_header(ws, headers, widths):
+    for i, w in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(i)].width = w
+    ws.freeze_panes = "A2"
+    ws.row_dimensions[1].height = 22
+    ws.append(_xl_row(ws, headers, _XL["hdr_fill"], _XL["hdr_font"]))
 
-    # ── OSRM 矩阵 + OR-Tools TSP ─────────────────────────────
-    wh_lat, wh_lng = WAREHOUSE_COORD.split(',')
-    warehouse  = {"lat": wh_lat, "lng": wh_lng}
-    all_nodes  = [warehouse] + valid_stores
 
-    time_m, dist_m = _distance_matrix_osrm(all_nodes, all_nodes)
-    if time_m and len(time_m) == len(all_nodes):
-        full_order, locks_honored = _ortools_tsp(
-            time_m, start=0, locked_positions=locked_positions,
-        )
-        store_order = [idx - 1 for idx in full_order if idx > 0]
-        optimized   = [valid_stores[i] for i in store_order]
-        print(f"[OPTIMIZE] ✓ OR-Tools TSP order: {store_order} (locks_honored={locks_honored})")
-        stats = _stats_from_matrices(full_order, time_m, dist_m)
-        stats["locks_honored"] = locks_honored
-        return optimized, stats
-
-    # ── OSRM 失败时：Haversine + OR-Tools 保底（本地计算，零成本）──
-    print("[OPTIMIZE] OSRM 失败，回退到 Haversine + OR-Tools（本地计算）…")
-    import math
-
-    def _haversine_sec(a, b, speed_kmh=35):
-        R = 6371000
-        lat1, lng1 = float(a["lat"]), float(a["lng"])
-        lat2, lng2 = float(b["lat"]), float(b["lng"])
-        dphi = math.radians(lat2 - lat1)
-        dlam = math.radians(lng2 - lng1)
-        h = math.sin(dphi/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*math.sin(dlam/2)**2
-        dist_m = 2 * R * math.asin(math.sqrt(h)) * 1.35
-        return int(dist_m / (speed_kmh / 3.6)), int(dist_m)
-
-    n = len(all_nodes)
-    fb_time = [[0]*n for _ in range(n)]
-    fb_dist = [[0]*n for _ in range(n)]
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                fb_time[i][j], fb_dist[i][j] = _haversine_sec(all_nodes[i], all_nodes[j])
+def _to_min(sec):
+    return round(sec / 60, 1) if sec is not None else None
 
-    full_order, locks_honored = _ortools_tsp(fb_time, start=0, locked_positions=locked_positions)
-    store_order = [idx - 1 for idx in full_order if idx > 0]
-    optimized   = [valid_stores[i] for i in store_order]
-    stats = _stats_from_matrices(full_order, fb_time, fb_dist)
-    stats["locks_honored"] = locks_honored
-    print(f"[OPTIMIZE] Haversine fallback 完成: {store_order}")
-    return optimized, stats
 
+def _to_km(m):
+    return round(m / 1000, 2) if m is not None else None
 
-def get_route_stats(ordered_stores):
-    """
-    计算已排好序的路线的时间/距离统计（供 reorder 场景使用）。
-    使用 OSRM 矩阵。
-    Returns dict with duration_min, duration_sec, distance_km.
-    """
-    if not ordered_stores:
-        return {"duration_min": 0, "duration_sec": 0, "distance_km": 0.0}
 
-    wh_lat, wh_lng = WAREHOUSE_COORD.split(',')
-    warehouse = {"lat": wh_lat, "lng": wh_lng}
-    all_nodes = [warehouse] + list(ordered_stores)  # index 0=仓库, 1..n=门店
+def _write_xlsx():
+    """write-only 工作簿：Route Links 汇总（全部分段链接）+ 每个司机一张停靠顺序表。"""
+    wb = openpyxl.Workbook(write_only=True)
 
-    print(f"[STATS] Fetching {len(all_nodes)}×{len(all_nodes)} matrix for route stats…")
-    time_m, dist_m = _distance_matrix_osrm(all_nodes, all_nodes)
+    ws = wb.create_sheet("Route Links")
+    n_seg = max([len(r.get("urls") or []) for r in state["results"].values()] + [1])
+    _xl_header(ws, ["Chaufför", "Butiker", "Tid", "Distans", "Status"]
+                   + [f"Segment {i + 1}" for i in range(n_seg)],
+               [12, 8, 12, 12, 10] + [60] * n_seg)
+    for ri, driver in enumerate(DRIVERS, 2):
+        r    = state["results"].get(driver, {})
+        ok   = r.get("status") == "ok"
+        fill = _XL["ok_fill"] if ok else _XL["err_fill"]
+        urls = list(r.get("urls") or [])
+        row  = _xl_row(ws, [driver, r.get("store_count", "—"), r.get("duration", "—"),
+                            r.get("distance", "—"), "Klar" if ok else f"Fel: {r.get('error','')}"], fill)
+        for url in urls + [""] * (n_seg - len(urls)):
+            row += _xl_row(ws, [url], fill, _XL["link_font"] if url else None, _XL["left_wrap"])
+        # write-only 模式下行高必须在写入该行之前设置
+        ws.row_dimensions[ri].height = 30
+        ws.append(row)
 
-    if not time_m or len(time_m) != len(all_nodes):
-        print(f"[STATS] ✗ Matrix fetch failed, returning None")
-        return None
+    for driver in DRIVERS:
+        r = state["results"].get(driver)
+        if not r or r.get("status") != "ok":
+            continue
+        ws = wb.create_sheet(driver[:31])
+        _xl_header(ws, ["#", "Butik", "Lat", "Lng", "Tid (min)", "Distans (km)",
+                        "Ackum. tid (min)", "Ackum. km"], [5, 36, 12, 12, 10, 12, 15, 11])
+        for row in _stop_rows_for(driver, r, state.get("generated_at")):
+            ws.append(_xl_row(ws, [row["position"], row["store"], row["lat"], row["lng"],
+                                   _to_min(row["leg_sec"]), _to_km(row["leg_m"]),
+                                   _to_min(row["cum_sec"]), _to_km(row["cum_m"])], _XL["ok_fill"]))
+
+    tmp = tempfile.TemporaryFile()
+    wb.save(tmp)
+    tmp.seek(0)
+    return tmp
+
+
+# ── 历史归档 ─────────────────────────────────────────────────
+# 只追加不修改：routes 表每次生成 / reorder 每个司机一行，route_stops 为其停靠点
+# （与 /api/export 相同：position 0 为仓库出发，之后各门店，最后一行为返回仓库，
+# 含每段时间 / 距离）。day 为斯德哥尔摩本地日期；同一司机同一天可能有多条
+# （生成后又 reorder），统计时取当天最后一条，即司机实际使用的路线。
+# 查询全部在 SQL 中聚合，依靠 (day, driver) / (store, position) 索引，不把历史读入内存。
+HISTORY_MAX_DAYS = 3650
+
+
+def init_history_db():
+    """历史库同 init_state_db：启动时建表一次，之后的连接只打开文件。"""
+    conn = sqlite3.connect(HISTORY_DB_FILE, timeout=10)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS routes (
+                id           INTEGER PRIMARY KEY,
+                day          TEXT NOT NULL,
+                recorded_at  TEXT NOT NULL,
+                generated_at TEXT,
+                driver       TEXT NOT NULL,
+                source       TEXT NOT NULL,
+                job_id       TEXT,
+                store_count  INTEGER NOT NULL,
+                duration_sec INTEGER,
+                distance_m   INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS route_stops (
+                route_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                store    TEXT NOT NULL,
+                lat      REAL,
+                lng      REAL,
+                leg_sec  REAL,
+                leg_m    REAL,
+                PRIMARY KEY (route_id, position)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_routes_day_driver ON routes (day, driver);
+            CREATE INDEX IF NOT EXISTS idx_routes_driver_day ON routes (driver, day);
+            CREATE INDEX IF NOT EXISTS idx_stops_store ON route_stops (store, position);
+        """)
+    finally:
+        conn.close()
 
-    # 路线顺序：仓库(0) → store[0](1) → store[1](2) → ... → store[n-1](n) → 仓库(0)
-    route = list(range(len(all_nodes)))  # [0, 1, 2, ..., n]
-    total_sec  = 0
-    total_dist = 0
-    for i in range(len(route) - 1):
-        a, b = route[i], route[i + 1]
-        total_sec  += time_m[a][b]
-        total_dist += dist_m[a][b]
-    total_sec  += time_m[route[-1]][0]   # 最后门店 → 仓库
-    total_dist += dist_m[route[-1]][0]
 
-    total_sec  = round(total_sec)
-    total_dist = round(total_dist)
+def _history_db_connect():
+    return sqlite3.connect(HISTORY_DB_FILE, timeout=10)
 
-    hours = total_sec // 3600
-    mins  = (total_sec % 3600) // 60
-    dur_str = f"{hours}h {mins}min" if hours > 0 else f"{mins}min"
-    print(f"[STATS] ✓ {dur_str} ({total_sec}s) {round(total_dist/1000,1)}km")
-    return {
-        "duration_min":  round(total_sec / 60),
-        "duration_sec":  total_sec,
-        "distance_km":   round(total_dist / 1000, 1),
-    }
 
+def _local_day(days_ago=0):
+    from zoneinfo import ZoneInfo
+    now = datetime.now(ZoneInfo("Europe/Stockholm"))
+    return (now - timedelta(days=days_ago)).strftime("%Y-%m-%d")
 
-def _gmaps_point(s):
-    """Return coordinate string for warehouse, store name string for stores."""
-    if s.get("is_warehouse"):
-        return f"{s['lat']},{s['lng']}"
-    return s["name"]
 
+def archive_routes(results, source, job_id=None):
+    """
+    把 results 中状态为 ok 的路线追加到历史归档。各段时间 / 距离取自结果中保存的 legs，
+    不重新请求路线。任何错误都只记录日志：调用时结果已经保存，归档失败不能让
+    生成任务报失败或让 reorder 返回 500。
+    """
+    day, recorded_at = _local_day(), _utc_now()
+    generated_at = state.get("generated_at")
+    try:
+        conn = _history_db_connect()
+        try:
+            with conn:
+                n = 0
+                for driver, r in results.items():
+                    if r.get("status") != "ok":
+                        continue
+                    stops = list(_stop_rows_for(driver, r, generated_at))
+                    distance_m = stops[-1]["cum_m"] if stops and stops[-1]["cum_m"] is not None else None
+                    cur = conn.execute(
+                        "INSERT INTO routes (day, recorded_at, generated_at, driver, source, job_id,"
+                        " store_count, duration_sec, distance_m) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (day, recorded_at, generated_at, driver, source, job_id,
+                         r.get("store_count", 0), r.get("duration_sec"),
+                         round(distance_m) if distance_m is not None else None),
+                    )
+                    # 连同仓库起终点一起保存，历史导出与 /api/export 的行和累计值一致
+                    conn.executemany(
+                        "INSERT INTO route_stops (route_id, position, store, lat, lng, leg_sec, leg_m)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(cur.lastrowid, s["position"], s["store"], s["lat"], s["lng"],
+                          s["leg_sec"], s["leg_m"]) for s in stops],
+                    )
+                    n += 1
+        finally:
+            conn.close()
+        print(f"[HISTORY] 归档 {n} 条路线（{source}）")
+    except Exception as e:
+        print(f"[HISTORY] ✗ 归档失败: {type(e).__name__}: {e}")
 
-def generate_urls(optimized_stores):
-    urls   = []
-    wh_lat, wh_lng = WAREHOUSE_COORD.split(',')
-    wh     = {"name": "Lager (Uppsala)", "lat": wh_lat, "lng": wh_lng, "is_warehouse": True}
-    path   = [wh] + optimized_stores + [wh]
-    for i in range(0, len(path) - 1, 10):
-        chunk  = path[i: i+11]
-        origin = chunk[0]; dest = chunk[-1]; wps = chunk[1:-1]
-        wp_str = ""
-        if wps:
-            wp_str = "&waypoints=" + urllib.parse.quote(
-                "|".join(_gmaps_point(s) for s in wps))
-        urls.append(
-            f"https://www.google.com/maps/dir/?api=1"
-            f"&origin={urllib.parse.quote(_gmaps_point(origin))}"
-            f"&destination={urllib.parse.quote(_gmaps_point(dest))}{wp_str}"
-        )
-    return urls
 
+def _history_window():
+    """请求参数 days（默认 30）→ 起始日期；driver 可选过滤。"""
+    days = min(max(request.args.get("days", 30, type=int), 1), HISTORY_MAX_DAYS)
+    return days, _local_day(days - 1), request.args.get("driver")
 
-def run_all_drivers():
-    results = {}
-    print(f"[RUN_ALL] 开始为所有司机优化路线")
 
-    for driver in DRIVERS:
-        try:
-            stores, unmatched = load_and_merge_data(driver)
-            if not stores:
-                err = unmatched if isinstance(unmatched, str) else "未匹配到任何门店"
-                results[driver] = {"status": "error", "error": err}
-                continue
+# 每个司机每天最后一条路线
+_DAILY_ROUTES_SQL = """
+    SELECT MAX(id) FROM routes
+    WHERE day >= :since AND (:driver IS NULL OR driver = :driver)
+    GROUP BY driver, day
+"""
 
-            optimized, stats_or_err = optimize_route(stores)
-            if not optimized:
-                results[driver] = {"status": "error", "error": str(stats_or_err)}
-                continue
 
-            urls = generate_urls(optimized)
-
-            dur_sec = stats_or_err.get('duration_sec', stats_or_err.get('duration_min', 0) * 60)
-            hours   = dur_sec // 3600
-            mins    = (dur_sec % 3600) // 60
-            dur_str = f"{hours} h {mins} min" if hours > 0 else f"{mins} min"
-
-            results[driver] = {
-                "status":        "ok",
-                "stores":        [s["name"] for s in optimized],
-                "store_objects": optimized,
-                "store_count":   len(optimized),
-                "urls":          urls,
-                "duration":      dur_str,
-                "duration_sec":  dur_sec,
-                "distance":      f"{stats_or_err['distance_km']} km",
-                "unmatched":     unmatched if isinstance(unmatched, list) else [],
-                "unmatched_count": len(unmatched) if isinstance(unmatched, list) else 0,
-            }
-            print(f"[RUN_ALL] {driver}: {dur_str} ({dur_sec}s) "
-                  f"{stats_or_err['distance_km']}km")
-        except Exception as e:
-            results[driver] = {"status": "error", "error": str(e)}
-    return results
+def history_driver_summary(since, driver=None):
+    conn = _history_db_connect()
+    try:
+        rows = conn.execute(f"""
+            SELECT driver, COUNT(*), AVG(duration_sec), MIN(duration_sec), MAX(duration_sec),
+                   AVG(store_count), AVG(distance_m)
+            FROM routes WHERE id IN ({_DAILY_ROUTES_SQL})
+            GROUP BY driver ORDER BY driver
+        """, {"since": since, "driver": driver}).fetchall()
+    finally:
+        conn.close()
+    return {d: {
+        "days":             n,
+        "avg_duration_sec": round(avg) if avg is not None else None,
+        "min_duration_sec": lo,
+        "max_duration_sec": hi,
+        "avg_stores":       round(stores, 1),
+        "avg_distance_km":  round(dist / 1000, 1) if dist is not None else None,
+    } for d, n, avg, lo, hi, stores, dist in rows}
+
+
+def history_first_stops(since, driver=None, store=None, limit=20):
+    """
+    各门店作为第一站的次数（每个司机每天的最后一条路线计一次）。
+    指定 store 时返回该门店的第一站次数、出现次数和按司机的分布。
+    """
+    params = {"since": since, "driver": driver, "store": store, "limit": limit}
+    conn = _history_db_connect()
+    try:
+        if store is None:
+            rows = conn.execute(f"""
+                SELECT s.store, COUNT(*) AS n FROM route_stops s
+                WHERE s.position = 1 AND s.route_id IN ({_DAILY_ROUTES_SQL})
+                GROUP BY s.store ORDER BY n DESC, s.store LIMIT :limit
+            """, params).fetchall()
+            return {"first_stops": [{"store": s, "count": n} for s, n in rows]}
+        rows = conn.execute(f"""
+            SELECT r.driver, SUM(s.position = 1), COUNT(*)
+            FROM route_stops s JOIN routes r ON r.id = s.route_id
+            WHERE s.store = :store AND s.route_id IN ({_DAILY_ROUTES_SQL})
+            GROUP BY r.driver ORDER BY r.driver
+        """, params).fetchall()
+    finally:
+        conn.close()
+    first, visits = sum(r[1] for r in rows), sum(r[2] for r in rows)
+    return {
+        "store":       store,
+        "first_count": first,
+        "visit_count": visits,
+        "first_share": round(first / visits, 3) if visits else None,
+        "by_driver":   {d: {"first_count": f, "visit_count": v} for d, f, v in rows},
+    }
 
 
-# ── 后台任务 ─────────────────────────────────────────────────
-def do_generate():
-    # ★ running 已在 api_generate() 中设为 True（避免竞态）
-    if not state["running"]:
-        state["running"] = True
+def history_stop_rows(since, driver=None):
+    """历史停靠点逐行产出（键同 EXPORT_STOP_FIELDS），游标分批读取，供 CSV / Parquet 导出。"""
+    conn = _history_db_connect()
     try:
-        state["results"]      = run_all_drivers()
-        from datetime import timezone
-        state["generated_at"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-        save_state()
+        cur = conn.execute(f"""
+            SELECT r.generated_at, r.driver, s.position, s.store, s.lat, s.lng, s.leg_sec, s.leg_m,
+                   CASE WHEN COUNT(s.leg_sec) OVER p > 0
+                        THEN ROUND(SUM(COALESCE(s.leg_sec, 0)) OVER w, 1) END,
+                   CASE WHEN COUNT(s.leg_m) OVER p > 0
+                        THEN ROUND(SUM(COALESCE(s.leg_m, 0)) OVER w, 1) END
+            FROM routes r JOIN route_stops s ON s.route_id = r.id
+            WHERE r.id IN ({_DAILY_ROUTES_SQL})
+            WINDOW p AS (PARTITION BY r.id),
+                   w AS (PARTITION BY r.id ORDER BY s.position)
+            ORDER BY r.day, r.driver, s.position
+        """, {"since": since, "driver": driver})
+        while True:
+            batch = cur.fetchmany(1000)
+            if not batch:
+                break
+            for row in batch:
+                yield dict(zip(EXPORT_STOP_FIELDS, row))
     finally:
-        state["running"] = False
+        conn.close()
 
 
-def reschedule(hour, minute):
-    if scheduler.get_job("daily_gen"):
-        scheduler.remove_job("daily_gen")
-    # ★ 必须指定时区，否则 CronTrigger 使用服务器默认时区（常为 UTC）
-    #   导致用户设置 16:26 本地时间，实际在 UTC 16:26 才触发
-    from zoneinfo import ZoneInfo
-    tz = ZoneInfo("Europe/Stockholm")
-    scheduler.add_job(do_generate, CronTrigger(hour=hour, minute=minute, timezone=tz),
-                      id="daily_gen", replace_existing=True)
-    print(f"[SCHEDULE] Armed daily job at {hour:02d}:{minute:02d} Europe/Stockholm")
+# ── Flask 路由 ───────────────────────────────────────────────
+@app.before_request
+def _sync_before_request():
+    # 多 worker 时其他进程可能刚写过状态库；静态资源与状态无关，不必同步
+    if request.path.startswith(app.static_url_path + "/"):
+        return
+    sync_state()
 
 
-# ── Flask 路由 ───────────────────────────────────────────────
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -750,33 +2832,234 @@ def index():
 
 @app.route("/api/status")
 def api_status():
-    resp = jsonify({
-        "results":         state["results"],
+    """
+    版本化状态接口：
+      view=summary（默认）— 每个司机只含 STATUS_SUMMARY_FIELDS
+      view=full           — 完整结果（含 store_objects / urls）及电话、邮箱
+      since=<version>     — 只返回该版本之后结果有变化的司机（完整条目）
+    响应带 ETag（由版本号决定），If-None-Match 命中时返回 304，不做序列化。
+    """
+    with _status_version_lock:
+        version  = _status_version["version"]
+        versions = {d: _status_version["drivers"].get(d, 0) for d in DRIVERS}
+
+    since = request.args.get("since", type=int)
+    view  = request.args.get("view", "summary")
+    if since is not None:
+        # 版本号比当前还新（状态库被替换过）时退回完整视图
+        view = "delta" if since <= version else "full"
+    elif view not in ("summary", "full"):
+        view = "summary"
+
+    etag = f"{version}-{view}"
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+
+    results = state["results"]
+    if view == "summary":
+        results = {d: {k: r[k] for k in STATUS_SUMMARY_FIELDS if k in r}
+                   for d, r in results.items()}
+    elif view == "delta":
+        results = {d: r for d, r in results.items() if versions.get(d, 0) > since}
+
+    body = {
+        "view":            view,
+        "version":         version,
+        "results":         results,
         "generated_at":    state["generated_at"],
         "schedule_hour":   state["schedule_hour"],
         "schedule_minute": state["schedule_minute"],
         "running":         state["running"],
+        "job_id":          state["job_id"],
         "drivers":         DRIVERS,
-        "phones":          driver_phones,
-        "emails":          driver_emails,
-    })
-    # 禁止浏览器/代理缓存路线结果
-    resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    resp.headers["Pragma"]        = "no-cache"
+    }
+    if view != "summary":
+        body.update(versions=versions, phones=driver_phones, emails=driver_emails)
+    resp = jsonify(body)
+    resp.set_etag(etag)
+    # 允许缓存但每次都要用 ETag 重新验证
+    resp.headers["Cache-Control"] = "no-cache"
     return resp
 
 
+@app.route("/api/cache/stats")
+def api_cache_stats():
+    return jsonify({"coords": coord_cache_stats(), "matrix": matrix_cache_stats()})
+
+
+def _parse_fleet_limit(value, field, scale):
+    """
+    解析车队 VRP 上限：None、正数，或 {司机: 正数 | None}，按 scale 换算为整数。
+    负数 / 0 会让 OR-Tools 的容量检查直接终止进程，必须在这里拒绝；未知司机同样拒绝。
+    不合法时抛出 ValueError（消息直接返回给前端）。
+    """
+    def one(v, label):
+        if v is None:
+            return None
+        if isinstance(v, bool) or not isinstance(v, (int, float, str)):
+            raise ValueError(f"{label} måste vara ett positivt tal")
+        try:
+            v = float(v)
+        except ValueError:
+            raise ValueError(f"{label} måste vara ett positivt tal") from None
+        if not math.isfinite(v) or v <= 0 or int(v * scale) < 1:
+            raise ValueError(f"{label} måste vara ett positivt tal")
+        return int(v * scale)
+
+    if isinstance(value, dict):
+        unknown = [d for d in value if d not in DRIVERS]
+        if unknown:
+            raise ValueError(f"{field}: okända chaufförer: {', '.join(map(str, unknown))}")
+        limits = {d: one(v, f"{field}.{d}") for d, v in value.items()}
+        return {d: v for d, v in limits.items() if v is not None} or None
+    return one(value, field)
+
+
+@app.route("/api/fleet/rebalance", methods=["POST"])
+def api_fleet_rebalance():
+    """
+    车队 VRP 报告（不改动当前路线）。JSON 参数均可选：
+      objective:        "makespan"（默认，均衡最长路线）| "total"（总时长最短）
+      max_stops:        int 或 {司机: int}
+      max_duration_min: int 或 {司机: int}
+    参数校验后立即返回 202 和 job_id；报告在 /api/jobs/<id>/events 的 done 事件
+    （或 /api/jobs/<id> 的最后一条事件）中。
+    """
+    data = request.get_json(silent=True) or {}
+    objective = data.get("objective", "makespan")
+    if objective not in ("makespan", "total"):
+        return jsonify({"error": f"Okänt mål: {objective}"}), 400
+    try:
+        max_stops = _parse_fleet_limit(data.get("max_stops"), "max_stops", 1)
+        max_dur   = _parse_fleet_limit(data.get("max_duration_min"), "max_duration_min", 60)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    job, busy = start_rebalance(objective, max_stops or None, max_dur or None)
+    if busy:
+        return jsonify({"ok": False, "message": "Already running", "job_id": busy}), 409
+    return jsonify({"ok": True, "job_id": job["id"]}), 202
+
+
+@app.route("/api/history/drivers")
+def api_history_drivers():
+    """每个司机最近 days 天的路线统计（每天取最后一条路线）。"""
+    days, since, driver = _history_window()
+    return jsonify({"days": days, "since": since, "drivers": history_driver_summary(since, driver)})
+
+
+@app.route("/api/history/first-stops")
+def api_history_first_stops():
+    """最近 days 天各门店作为第一站的次数；store=<名称> 时返回该门店的详情。"""
+    days, since, driver = _history_window()
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 500)
+    return jsonify({"days": days, "since": since,
+                    **history_first_stops(since, driver, request.args.get("store"), limit)})
+
+
+@app.route("/api/history/export")
+def api_history_export():
+    """最近 days 天的历史停靠点，CSV 流式输出（format=parquet 需要 pyarrow）。"""
+    days, since, driver = _history_window()
+    name = f"historik_{since}_{days}d"
+    if request.args.get("format") == "parquet":
+        if pq is None:
+            return jsonify({"error": "Parquet-export kräver pyarrow (pip install pyarrow)"}), 501
+        return send_file(_write_parquet(history_stop_rows(since, driver)),
+                         mimetype="application/vnd.apache.parquet",
+                         as_attachment=True, download_name=f"{name}.parquet")
+    return Response(_stream_csv(history_stop_rows(since, driver)), mimetype="text/csv",
+                    headers={"Content-Disposition": f'attachment; filename="{name}.csv"'})
+
+
+@app.route("/api/http/stats")
+def api_http_stats():
+    """外部 HTTP 请求统计（本进程，多 worker 时每个 worker 各自统计）。"""
+    return jsonify({"pid": os.getpid(), "upstreams": http_stats()})
+
+
 @app.route("/api/generate", methods=["POST"])
 def api_generate():
-    if state["running"]:
-        return jsonify({"ok": False, "message": "Already running"}), 409
-    # ★ FIX: 在启动线程之前设置 running=True，避免竞态条件：
-    #   前端收到 ok 后立刻轮询 /api/status，如果线程还没来得及
-    #   执行 do_generate() 里的 state["running"]=True，前端会
-    #   看到 running=false + 旧结果，从而立刻停止轮询。
-    state["running"] = True
-    threading.Thread(target=do_generate, daemon=True).start()
-    return jsonify({"ok": True})
+    # ★ FIX: 在启动线程之前登记 running，避免竞态条件：
+    #   两次点击（或两个 worker 各收到一次点击）会重复启动生成。
+    job_id = uuid.uuid4().hex[:12]
+    busy = _claim_running(job_id)
+    if busy:
+        return jsonify({"ok": False, "message": "Already running", "job_id": busy}), 409
+    bump_status_version()
+    job = _new_job("manual", job_id)
+    threading.Thread(target=do_generate, args=(job,), daemon=True).start()
+    return jsonify({"ok": True, "job_id": job["id"]})
+
+
+@app.route("/api/jobs")
+def api_jobs():
+    """最近的任务（新的在前），不含事件明细；trigger=manual,scheduled 只返回这些类型。"""
+    limit = max(request.args.get("limit", 10, type=int), 0)
+    triggers = request.args.get("trigger")
+    found = _load_jobs()
+    if triggers:
+        found = [j for j in found if j["trigger"] in triggers.split(",")]
+    return jsonify({"jobs": [_job_summary(j) for j in found[:limit]]})
+
+
+@app.route("/api/jobs/<job_id>")
+def api_job(job_id):
+    job = _load_jobs(job_id)
+    if not job:
+        return jsonify({"ok": False, "error": "Okänt jobb"}), 404
+    return jsonify(job)
+
+
+@app.route("/api/jobs/<job_id>/events")
+def api_job_events(job_id):
+    """
+    SSE 进度流：先补发 Last-Event-ID（或 ?after=）之后的事件，再实时推送，
+    job 结束（done / failed）后关闭。空闲时每 15 秒发送注释行保活。
+    本进程运行的 job 由条件变量唤醒；其他 worker 运行的 job 每 JOB_POLL_SEC 秒查一次状态库。
+    """
+    local = job_id in jobs
+    if not local and not _load_jobs(job_id):
+        return jsonify({"ok": False, "error": "Okänt jobb"}), 404
+    try:
+        after = int(request.headers.get("Last-Event-ID") or request.args.get("after") or 0)
+    except ValueError:
+        after = 0
+
+    def wait_events(sent):
+        """等待 sent 之后的新事件（最多约 15 秒），返回 (新事件, job 是否已结束)。"""
+        if local:
+            job = jobs[job_id]
+            with _jobs_cond:
+                if len(job["events"]) <= sent and job["status"] == "running":
+                    _jobs_cond.wait(timeout=15)
+                return job["events"][sent:], job["status"] != "running"
+        deadline = time.monotonic() + 15
+        while True:
+            job = _load_jobs(job_id) or {"events": [], "status": "failed"}
+            if (len(job["events"]) > sent or job["status"] != "running"
+                    or time.monotonic() > deadline):
+                return job["events"][sent:], job["status"] != "running"
+            time.sleep(JOB_POLL_SEC)
+
+    def stream():
+        sent = after
+        while True:
+            pending, finished = wait_events(sent)
+            if not pending and not finished:
+                yield ": keepalive\n\n"
+                continue
+            for ev in pending:
+                sent = ev["seq"]
+                yield (f"id: {ev['seq']}\nevent: {ev['event']}\n"
+                       f"data: {json.dumps(ev, ensure_ascii=False)}\n\n")
+            if finished:
+                return
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route("/api/schedule", methods=["POST"])
@@ -786,8 +3069,9 @@ def api_schedule():
     minute = int(data.get("minute", 0))
     state["schedule_hour"]   = hour
     state["schedule_minute"] = minute
-    reschedule(hour, minute)
-    save_state()
+    save_state(drivers=(), meta=("schedule_hour", "schedule_minute"))
+    apply_schedule()
+    bump_status_version()
     return jsonify({"ok": True, "hour": hour, "minute": minute})
 
 
@@ -797,86 +3081,116 @@ def api_set_phones():
         if driver in driver_phones:
             driver_phones[driver] = str(number).strip()
     save_phones()
+    bump_status_version()
     return jsonify({"ok": True, "phones": driver_phones})
 
 
 @app.route("/api/export")
 def api_export():
+    """
+    导出当前结果：format=xlsx（默认，汇总 + 每个司机一张停靠顺序表）| csv | parquet。
+    只能是已生成的结果；CSV / Parquet 为每个停靠点一行的扁平表，适合大量数据。
+    """
     if not state["results"]:
         return jsonify({"error": "暂无结果"}), 400
+    fmt   = request.args.get("format", "xlsx").lower()
+    stamp = datetime.now().strftime('%Y%m%d')
+    if fmt == "csv":
+        return Response(_stream_csv(export_stop_rows()), mimetype="text/csv",
+                        headers={"Content-Disposition": f'attachment; filename="rutter_{stamp}.csv"'})
+    if fmt == "parquet":
+        if pq is None:
+            return jsonify({"error": "Parquet-export kräver pyarrow (pip install pyarrow)"}), 501
+        return send_file(_write_parquet(export_stop_rows()), mimetype="application/vnd.apache.parquet",
+                         as_attachment=True, download_name=f"rutter_{stamp}.parquet")
+    if fmt != "xlsx":
+        return jsonify({"error": f"Okänt format: {fmt}"}), 400
+    return send_file(_write_xlsx(),
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        as_attachment=True, download_name=f"rutter_{stamp}.xlsx")
 
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Route Links"
-
-    hdr_fill   = PatternFill("solid", fgColor="1A1A2E")
-    hdr_font   = Font(color="F5A623", bold=True, size=11)
-    ok_fill    = PatternFill("solid", fgColor="0D2137")
-    err_fill   = PatternFill("solid", fgColor="2D1A1A")
-    wht_font   = Font(color="E0E0E0", size=10)
-    center     = Alignment(horizontal="center",  vertical="center")
-    left_wrap  = Alignment(horizontal="left",    vertical="center", wrap_text=True)
-    thin       = Border(**{s: Side(style='thin', color='333355')
-                           for s in ('left','right','top','bottom')})
-
-    headers    = ["Chaufför","Butiker","Tid","Distans","Status",
-                  "Segment 1","Segment 2","Segment 3"]
-    widths     = [12, 8, 12, 12, 10, 60, 60, 60]
-
-    for ci, (h, w) in enumerate(zip(headers, widths), 1):
-        c = ws.cell(row=1, column=ci, value=h)
-        c.fill = hdr_fill; c.font = hdr_font
-        c.alignment = center; c.border = thin
-        ws.column_dimensions[c.column_letter].width = w
-    ws.row_dimensions[1].height = 22
 
-    for ri, driver in enumerate(DRIVERS, 2):
-        r    = state["results"].get(driver, {})
-        fill = ok_fill if r.get("status") == "ok" else err_fill
-        ws.row_dimensions[ri].height = 30
 
-        def mc(col, val, row=ri, f=fill):
-            c = ws.cell(row=row, column=col, value=val)
-            c.fill = f; c.font = wht_font; c.border = thin
-            return c
-
-        mc(1, driver).alignment = center
-        mc(2, r.get("store_count", "—")).alignment = center
-        mc(3, r.get("duration",    "—")).alignment = center
-        mc(4, r.get("distance",    "—")).alignment = center
-        mc(5, "Klar" if r.get("status")=="ok" else f"Fel: {r.get('error','')}").alignment = center
-        for si in range(3):
-            url = (r.get("urls") or [])[si] if si < len(r.get("urls") or []) else ""
-            c = mc(6+si, url); c.alignment = left_wrap
-            if url: c.font = Font(color="4A9FD4", size=9, underline="single")
-
-    buf = io.BytesIO()
-    wb.save(buf); buf.seek(0)
-    return send_file(buf,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        as_attachment=True,
-        download_name=f"rutter_{datetime.now().strftime('%Y%m%d')}.xlsx")
+# ── 司机页面（/links、/nav）────────────────────────────────────
+# 页面只依赖该司机的结果，按结果版本渲染一次后缓存在内存中；
+# CSS / JS 拆到 static/，URL 带内容哈希，可长期缓存。
+STATIC_MAX_AGE = 365 * 86400
+_page_cache    = {}        # (页面, 司机) → {"version", "body", "etag", "modified"}
+_static_hashes = {}        # 静态文件名 → 内容哈希（进程内只算一次）
 
 
+def _static_url(filename):
+    """带内容哈希的静态资源 URL：文件变化 → URL 变化，因此可以设置很长的 max-age。"""
+    if filename not in _static_hashes:
+        with open(os.path.join(app.static_folder, filename), "rb") as f:
+            _static_hashes[filename] = hashlib.sha1(f.read()).hexdigest()[:12]
+    return f"{app.static_url_path}/{filename}?v={_static_hashes[filename]}"
 
-@app.route("/links/<driver_name>")
-def driver_links(driver_name):
-    r    = state["results"].get(driver_name)
-    date = state.get("generated_at", "—")
-    if not r or r.get("status") != "ok":
-        return f"""<!DOCTYPE html><html><head><meta charset="UTF-8">
+
+def _page_data_json(data):
+    """嵌入 <script type="application/json"> 的数据；转义 "</" 防止提前结束 script 标签。"""
+    return json.dumps(data, ensure_ascii=False).replace("</", "<\\/")
+
+
+def _no_routes_page(driver_name):
+    return f"""<!DOCTYPE html><html><head><meta charset="UTF-8">
         <meta name="viewport" content="width=device-width,initial-scale=1">
         <title>{driver_name}</title></head>
         <body style="font-family:sans-serif;padding:2rem;background:#111;color:#fff">
         <h2>Inga rutter för {driver_name} ännu.</h2></body></html>""", 404
 
+
+def _cached_page(kind, driver_name, render):
+    """
+    返回 render(r) 生成的页面：司机结果版本未变时复用缓存的 HTML，
+    带 ETag（内容哈希，多 worker 间一致）和 Last-Modified，条件请求命中时返回 304。
+    """
+    r = state["results"].get(driver_name)
+    if not r or r.get("status") != "ok":
+        return _no_routes_page(driver_name)
+    with _status_version_lock:
+        version = _status_version["drivers"].get(driver_name, 0)
+    entry = _page_cache.get((kind, driver_name))
+    if not entry or entry["version"] != version:
+        body  = render(driver_name, r).encode("utf-8")
+        entry = {
+            "version":  version,
+            "body":     body,
+            "etag":     hashlib.sha1(body).hexdigest()[:20],
+            # 版本号即变更时的毫秒时间戳
+            "modified": datetime.fromtimestamp(version / 1000 if version else time.time(),
+                                               timezone.utc),
+        }
+        _page_cache[(kind, driver_name)] = entry
+    resp = Response(entry["body"], mimetype="text/html")
+    resp.set_etag(entry["etag"])
+    resp.last_modified = entry["modified"]
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+
+@app.after_request
+def _static_cache_headers(resp):
+    # 带内容哈希的静态资源可以长期缓存
+    if request.path.startswith(app.static_url_path + "/") and request.args.get("v"):
+        resp.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE}, immutable"
+    return resp
+
+
+@app.route("/links/<driver_name>")
+def driver_links(driver_name):
+    return _cached_page("links", driver_name, _render_links_page)
+
+
+def _render_links_page(driver_name, r):
+    date = state.get("generated_at", "—")
     urls          = r.get("urls", [])
     store_objects = r.get("store_objects", [
         {"name": s, "lat": "", "lng": ""} for s in r.get("stores", [])
     ])
 
-    # Serialise store objects for injection into JS
-    store_objects_json = json.dumps(store_objects, ensure_ascii=False)
+    # 页面数据以 JSON 数据块注入，静态 JS 从中读取
+    page_data = _page_data_json({"driver": driver_name, "stores": store_objects})
 
     link_btns = "".join(
         f'<a href="{u}" id="mapbtn{i}" class="map-btn">🗺 Segment {i+1} — Öppna i Google Maps</a>'
@@ -888,53 +3202,7 @@ def driver_links(driver_name):
   <meta charset="UTF-8">
   <meta name="viewport" content="width=device-width,initial-scale=1">
   <title>Körorder — {driver_name}</title>
-  <style>
-    *{{box-sizing:border-box;margin:0;padding:0}}
-    body{{font-family:-apple-system,BlinkMacSystemFont,sans-serif;background:#0f111a;color:#e0e6f0;min-height:100vh}}
-    .header{{background:#161b27;border-bottom:1px solid #1e2d45;padding:18px 20px}}
-    .name{{font-size:26px;font-weight:800;color:#fff}}
-    .meta{{font-size:13px;color:#6b7a99;margin-top:4px}}
-    .stats{{display:grid;grid-template-columns:repeat(3,1fr);border-bottom:1px solid #1e2d45}}
-    .stat{{padding:16px;text-align:center;border-right:1px solid #1e2d45}}
-    .stat:last-child{{border-right:none}}
-    .stat-val{{font-size:22px;font-weight:700;color:#f5a623;display:block}}
-    .stat-lbl{{font-size:11px;color:#6b7a99;text-transform:uppercase;letter-spacing:.5px}}
-    .section{{padding:16px 20px}}
-    .section-title{{font-size:11px;color:#6b7a99;text-transform:uppercase;letter-spacing:1px;margin-bottom:12px}}
-    .map-btn{{display:block;margin:10px 0;padding:14px 18px;background:#1a73e8;color:#fff;
-              text-decoration:none;border-radius:8px;font-size:15px;font-weight:600;text-align:center}}
-    .toggle{{background:none;border:1px solid #1e2d45;color:#6b7a99;padding:8px 14px;
-             border-radius:6px;font-size:13px;cursor:pointer;margin-bottom:12px;width:100%}}
-
-    /* ── Stop list ── */
-    #stop-panel{{display:none;margin-top:4px}}
-    .stop-list{{background:#161b27;border-radius:8px;overflow:hidden}}
-    .stop-row{{display:flex;align-items:center;padding:10px 12px;
-               border-bottom:1px solid #1e2d45;gap:8px;
-               transition:background .15s;cursor:grab;user-select:none}}
-    .stop-row:last-child{{border-bottom:none}}
-    .stop-row.dragging{{opacity:.4;background:#0a0c14}}
-    .stop-row.drag-over{{background:#1a2540;border-top:2px solid #1a73e8}}
-    .stop-row.locked-row{{background:#1a1e10}}
-    .stop-num{{color:#f5a623;font-weight:700;font-size:14px;min-width:26px;text-align:right}}
-    .stop-name{{flex:1;font-size:14px;color:#e0e6f0}}
-    .drag-handle{{color:#444;font-size:18px;cursor:grab;padding:0 4px}}
-    .btn-up,.btn-dn{{background:none;border:1px solid #2a3550;color:#6b7a99;
-                     border-radius:4px;font-size:14px;padding:3px 7px;cursor:pointer;line-height:1}}
-    .btn-up:hover,.btn-dn:hover{{background:#1e2d45;color:#fff}}
-    .btn-lock{{background:none;border:none;font-size:18px;cursor:pointer;padding:2px 4px;line-height:1}}
-    .lock-hint{{font-size:11px;color:#6b7a99;text-align:center;padding:8px;font-style:italic}}
-
-    /* ── Recalculate button ── */
-    .recalc-bar{{padding:14px 20px;border-top:1px solid #1e2d45;background:#161b27;position:sticky;bottom:0}}
-    .btn-recalc{{width:100%;padding:14px;background:#2d6a2d;color:#fff;border:none;
-                 border-radius:8px;font-size:15px;font-weight:700;cursor:pointer}}
-    .btn-recalc:hover{{background:#3a8a3a}}
-    .btn-recalc:disabled{{background:#333;color:#666;cursor:not-allowed}}
-    .recalc-status{{font-size:12px;color:#6b7a99;text-align:center;margin-top:6px;min-height:16px}}
-    .locked-badge{{font-size:10px;background:#2a3510;color:#8bc34a;
-                   border:1px solid #4a6420;border-radius:4px;padding:1px 5px;margin-left:6px}}
-  </style>
+  <link rel="stylesheet" href="{_static_url('links.css')}">
 </head>
 <body>
   <div class="header">
@@ -978,165 +3246,8 @@ def driver_links(driver_name):
     <div class="recalc-status" id="recalc-status"></div>
   </div>
 
-<script>
-// ── State ──────────────────────────────────────────────────────
-const DRIVER = {json.dumps(driver_name)};
-let stores   = {store_objects_json};
-let locked   = new Set();   // Set of 0-indexed locked positions (in current order)
-let dragSrcIdx = null;
-
-// ── Render ─────────────────────────────────────────────────────
-function render() {{
-  const list = document.getElementById('stop-list');
-  list.innerHTML = '';
-  stores.forEach((s, i) => {{
-    const isLocked = locked.has(i);
-    const row = document.createElement('div');
-    row.className = 'stop-row' + (isLocked ? ' locked-row' : '');
-    row.draggable = true;
-    row.dataset.idx = i;
-    row.innerHTML = `
-      <span class="drag-handle">⠿</span>
-      <span class="stop-num">${{i+1}}</span>
-      <span class="stop-name">${{s.name}}${{isLocked ? '<span class="locked-badge">🔒 LÅST</span>' : ''}}</span>
-      <button class="btn-up" onclick="moveUp(${{i}})" ${{i===0?'disabled':''}}>▲</button>
-      <button class="btn-dn" onclick="moveDown(${{i}})" ${{i===stores.length-1?'disabled':''}}>▼</button>
-      <button class="btn-lock" onclick="toggleLock(${{i}})" title="${{isLocked?'Lås upp':'Lås position'}}">${{isLocked?'🔒':'🔓'}}</button>
-    `;
-
-    // Drag events
-    row.addEventListener('dragstart', e => {{
-      dragSrcIdx = i;
-      setTimeout(() => row.classList.add('dragging'), 0);
-    }});
-    row.addEventListener('dragend', () => {{
-      row.classList.remove('dragging');
-      document.querySelectorAll('.stop-row').forEach(r => r.classList.remove('drag-over'));
-    }});
-    row.addEventListener('dragover', e => {{
-      e.preventDefault();
-      document.querySelectorAll('.stop-row').forEach(r => r.classList.remove('drag-over'));
-      if (dragSrcIdx !== i) row.classList.add('drag-over');
-    }});
-    row.addEventListener('drop', e => {{
-      e.preventDefault();
-      if (dragSrcIdx !== null && dragSrcIdx !== i) {{
-        moveToPos(dragSrcIdx, i);
-      }}
-    }});
-
-    list.appendChild(row);
-  }});
-
-  // Show recalc bar only if any stop has been moved or locked
-  updateRecalcBar();
-}}
-
-function updateRecalcBar() {{
-  const bar = document.getElementById('recalc-bar');
-  bar.style.display = 'block';   // always show once panel is used
-}}
-
-// ── Mutations ──────────────────────────────────────────────────
-function moveUp(i) {{
-  if (i === 0) return;
-  swapStores(i, i-1);
-}}
-function moveDown(i) {{
-  if (i === stores.length-1) return;
-  swapStores(i, i+1);
-}}
-function swapStores(a, b) {{
-  // Remap locked positions
-  const newLocked = new Set();
-  locked.forEach(p => {{
-    if (p===a) newLocked.add(b);
-    else if (p===b) newLocked.add(a);
-    else newLocked.add(p);
-  }});
-  locked = newLocked;
-  [stores[a], stores[b]] = [stores[b], stores[a]];
-  render();
-}}
-function moveToPos(from, to) {{
-  const item = stores.splice(from, 1)[0];
-  stores.splice(to, 0, item);
-  // Rebuild locked set: shift indices
-  const arr = Array.from(locked);
-  const newLocked = new Set();
-  arr.forEach(p => {{
-    if (p === from) {{ newLocked.add(to); return; }}
-    let np = p;
-    if (from < to) {{ if (p > from && p <= to) np = p - 1; }}
-    else           {{ if (p >= to && p < from) np = p + 1; }}
-    newLocked.add(np);
-  }});
-  locked = newLocked;
-  render();
-}}
-function toggleLock(i) {{
-  if (locked.has(i)) locked.delete(i);
-  else locked.add(i);
-  render();
-}}
-
-// ── Recalculate ────────────────────────────────────────────────
-async function recalculate() {{
-  const btn = document.getElementById('btn-recalc');
-  const status = document.getElementById('recalc-status');
-  btn.disabled = true;
-  btn.textContent = '⏳ Räknar om…';
-  status.textContent = '';
-
-  try {{
-    // Embed locked flag on each store object for the backend
-    const payload = stores.map((s, i) => ({{...s, locked: locked.has(i)}}));
-    const resp = await fetch(`/api/reorder/${{DRIVER}}`, {{
-      method: 'POST',
-      headers: {{'Content-Type': 'application/json'}},
-      body: JSON.stringify({{ stores: payload }})
-    }});
-    const data = await resp.json();
-    if (data.ok) {{
-      stores = data.stores;
-      locked = new Set();   // reset locks after successful recalc
-      render();
-
-      // Update stats
-      document.getElementById('s-dur').textContent  = data.duration;
-      document.getElementById('s-dist').textContent = data.distance;
-
-      // Rebuild map buttons
-      const btns = document.getElementById('map-btns');
-      btns.innerHTML = data.urls.map((u,i) =>
-        `<a href="${{u}}" class="map-btn">🗺 Segment ${{i+1}} — Öppna i Google Maps</a>`
-      ).join('');
-
-      btn.textContent = '✅ Klar! Räkna om igen';
-      status.textContent = `Ny rutt: ${{data.duration}}, ${{data.distance}}`;
-      if (data.warning) {{
-        status.textContent += ` (⚠️ API-fel vid optimering: ${{data.warning}})`;
-      }}
-    }} else {{
-      btn.textContent = '🔄 Räkna om med låsta stopp';
-      status.textContent = '⚠️ Fel: ' + (data.error || data.msg || 'okänt fel');
-    }}
-  }} catch(e) {{
-    btn.textContent = '🔄 Räkna om med låsta stopp';
-    status.textContent = '⚠️ Nätverksfel: ' + e.message;
-  }}
-  btn.disabled = false;
-}}
-
-// ── Init ───────────────────────────────────────────────────────
-render();
-// Show recalc bar only after user opens the stop panel
-document.getElementById('btn-recalc').closest('.recalc-bar').style.display = 'none';
-document.getElementById('toggle-btn').addEventListener('click', () => {{
-  const open = document.getElementById('stop-panel').style.display === 'block';
-  document.getElementById('recalc-bar').style.display = open ? 'block' : 'none';
-}});
-</script>
+<script id="page-data" type="application/json">{page_data}</script>
+<script src="{_static_url('links.js')}"></script>
 </body></html>"""
 
 
@@ -1198,50 +3309,168 @@ def build_email_html(driver, r, base_url):
 </body></html>"""
 
 
-def send_email_to_driver(driver, r, base_url):
-    to_addr = driver_emails.get(driver, "").strip()
-    if not to_addr:
-        return False, "Ingen e-postadress konfigurerad"
-    api_key = email_config.get("api_key", "").strip()
-    if not api_key:
-        return False, "RESEND_API_KEY saknas — lägg till i Railway Variables"
-    sender = email_config.get("sender", "onboarding@resend.dev").strip()
+# ── 邮件发送队列 ─────────────────────────────────────────────
+# 请求线程只负责组装邮件并放入队列，立即返回；后台线程池（EMAIL_WORKERS 个线程）
+# 通过共享的 "email" HTTP 客户端发送，多封邮件优先走 Resend 批量接口。
+# 每个司机的投递状态写入状态库 deliveries 表，任何 worker 都能查询：
+#   queued → sending →（retrying →）sent / failed，没有地址或路线的记为 skipped
+EMAIL_PENDING = ("queued", "sending", "retrying")
+
+_email_pool = ThreadPoolExecutor(max_workers=EMAIL_WORKERS, thread_name_prefix="email")
+
+
+def _set_delivery(drivers, status, msg, **info):
+    entry = {"status": status, "msg": msg, "updated": _utc_now(), **info}
     try:
-        html = build_email_html(driver, r, base_url)
-        payload = {
-            "from":    sender,
-            "to":      [to_addr],
-            "subject": f"Kororder {driver} — {state.get('generated_at','')}",
-            "html":    html,
-        }
-        resp = http_requests.post(
-            "https://api.resend.com/emails",
-            headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-            json=payload,
-            timeout=15
-        )
-        if resp.status_code in (200, 201):
-            return True, "Skickat"
-        else:
-            err = resp.text
-            print(f"[EMAIL ERROR] {driver}: {resp.status_code} {err}")
-            return False, f"Resend API fel {resp.status_code}: {err}"
+        conn = _state_db_connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO deliveries (driver, delivery, updated_at) VALUES (?, ?, ?)",
+                    [(d, json.dumps(entry, ensure_ascii=False), time.time()) for d in drivers],
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[EMAIL] ✗ 写入投递状态失败: {e}")
+
+
+def load_deliveries():
+    conn = _state_db_connect()
+    try:
+        return {d: json.loads(v) for d, v in conn.execute("SELECT driver, delivery FROM deliveries")}
+    finally:
+        conn.close()
+
+
+def _email_backoff(attempt, retry_after=None):
+    """第 attempt 次失败后的等待秒数：指数退避 + 抖动，服务端给了 Retry-After 时不少于它。"""
+    delay = EMAIL_BACKOFF_SEC * 2 ** (attempt - 1) * random.uniform(0.8, 1.2)
+    try:
+        delay = max(delay, min(float(retry_after), 60.0))
+    except (TypeError, ValueError):
+        pass
+    return delay
+
+
+def _email_post(path, payload, drivers):
+    """
+    POST 到邮件 API，429 / 5xx / 网络错误时退避重试（期间状态为 retrying）。
+    返回 (HTTP 状态码或 None, 响应 JSON 或错误信息, 尝试次数)。
+    """
+    headers = {"Authorization": f"Bearer {email_config.get('api_key', '').strip()}"}
+    for attempt in range(1, EMAIL_MAX_ATTEMPTS + 1):
+        code, retry_after = None, None
+        try:
+            resp = http_request("email", "POST", path, headers=headers, json=payload)
+            code = resp.status_code
+            if code in (200, 201):
+                try:
+                    return code, resp.json(), attempt
+                except ValueError:
+                    # 已被接受但响应无法解析：可能已经发出，不重试
+                    return None, f"Ogiltigt svar från Resend API: {resp.text.strip()[:300]}", attempt
+            err = f"Resend API fel {code}: {resp.text.strip()[:300]}"
+            if code != 429 and code < 500:
+                return code, err, attempt           # 请求本身有误，重试无意义
+            retry_after = resp.headers.get("Retry-After")
+        except (http_requests.ConnectionError, http_requests.Timeout) as e:
+            err = f"Nätverksfel: {e}"
+        except http_requests.RequestException as e:
+            return None, f"Förfrågan misslyckades: {e}", attempt
+        print(f"[EMAIL] {', '.join(drivers)}: 第 {attempt} 次失败 — {err}")
+        if attempt == EMAIL_MAX_ATTEMPTS:
+            return code, err, attempt
+        _set_delivery(drivers, "retrying", f"Försöker igen ({attempt + 1}/{EMAIL_MAX_ATTEMPTS})",
+                      attempts=attempt, error=err)
+        time.sleep(_email_backoff(attempt, retry_after))
+
+
+def _send_email_batch(items):
+    """
+    items: [(driver, payload)]。一封走 /emails，多封走 /emails/batch。
+    线程池会吞掉任务里的异常，所以任何意外错误都把这些司机记为 failed，
+    不让它们停在 sending（否则 /api/email-status 永远有 pending）。
+    """
+    drivers = [d for d, _ in items]
+    try:
+        _send_email_items(items, drivers)
     except Exception as e:
-        import traceback
-        print(f"[EMAIL ERROR] {driver}: {traceback.format_exc()}")
-        return False, str(e)
+        _set_delivery(drivers, "failed", f"Internt fel: {e}")
+        print(f"[EMAIL ERROR] {', '.join(drivers)}: {type(e).__name__}: {e}")
+
+
+def _send_email_items(items, drivers):
+    _set_delivery(drivers, "sending", "Skickar…")
+    if len(items) == 1:
+        code, data, attempts = _email_post("/emails", items[0][1], drivers)
+        ids = [data.get("id")] if code in (200, 201) else []
+    else:
+        code, data, attempts = _email_post("/emails/batch", [p for _, p in items], drivers)
+        ids = [e.get("id") for e in data.get("data", [])] if code in (200, 201) else []
+        if code is not None and code < 500 and code not in (200, 201, 429):
+            # 批量接口整批拒绝（如某个地址无效）：逐封重发，只让出错的那封失败
+            print(f"[EMAIL] 批量发送被拒（{code}），改为逐封发送 {len(items)} 封")
+            for item in items:
+                _email_pool.submit(_send_email_batch, [item])
+            return
+    if code in (200, 201):
+        for driver, email_id in zip(drivers, ids + [None] * len(drivers)):
+            _set_delivery([driver], "sent", "Skickat", attempts=attempts, email_id=email_id)
+        print(f"[EMAIL] ✓ {', '.join(drivers)} 已发送（{attempts} 次尝试）")
+    else:
+        _set_delivery(drivers, "failed", data, attempts=attempts)
+        print(f"[EMAIL ERROR] {', '.join(drivers)}: {data}")
+
+
+def _email_payload(driver, r, base_url):
+    return {
+        "from":    email_config.get("sender", "onboarding@resend.dev").strip(),
+        "to":      [driver_emails.get(driver, "").strip()],
+        "subject": f"Kororder {driver} — {state.get('generated_at','')}",
+        "html":    build_email_html(driver, r, base_url),
+    }
+
+
+def queue_emails(drivers, base_url):
+    """
+    为 drivers 组装邮件并放入后台发送队列，立即返回每个司机的受理结果
+    {"ok", "status", "msg"}；之后的投递进度通过 /api/email-status 查询。
+    """
+    if not email_config.get("api_key", "").strip():
+        msg = "RESEND_API_KEY saknas — lägg till i Railway Variables"
+        return {d: {"ok": False, "status": "failed", "msg": msg} for d in drivers}
+
+    out, items = {}, []
+    for driver in drivers:
+        r = state["results"].get(driver)
+        if not r or r.get("status") != "ok":
+            out[driver] = {"ok": False, "status": "skipped", "msg": "Inga rutter"}
+        elif not driver_emails.get(driver, "").strip():
+            out[driver] = {"ok": False, "status": "skipped", "msg": "Ingen e-postadress konfigurerad"}
+        else:
+            try:
+                items.append((driver, _email_payload(driver, r, base_url)))
+            except Exception as e:
+                out[driver] = {"ok": False, "status": "failed", "msg": f"Internt fel: {e}"}
+                continue
+            out[driver] = {"ok": True, "status": "queued", "msg": "I kö"}
+    for driver, res in out.items():
+        if res["status"] in ("skipped", "failed"):
+            _set_delivery([driver], res["status"], res["msg"])
+    if items:
+        _set_delivery([d for d, _ in items], "queued", "I kö", attempts=0)
+    for i in range(0, len(items), EMAIL_BATCH_SIZE):
+        _email_pool.submit(_send_email_batch, items[i:i + EMAIL_BATCH_SIZE])
+    print(f"[EMAIL] 已排队 {len(items)} 封，跳过 {len(out) - len(items)} 个司机")
+    return out
 
 @app.route("/nav/<driver_name>")
 def driver_nav(driver_name):
-    r    = state["results"].get(driver_name)
-    date = state.get("generated_at", "—")
-    if not r or r.get("status") != "ok":
-        return f"""<!DOCTYPE html><html><head><meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width,initial-scale=1">
-        <title>{driver_name}</title></head>
-        <body style="font-family:sans-serif;padding:2rem;background:#111;color:#fff">
-        <h2>Inga rutter för {driver_name} ännu.</h2></body></html>""", 404
+    return _cached_page("nav", driver_name, _render_nav_page)
 
+
+def _render_nav_page(driver_name, r):
     store_objects = r.get("store_objects", [
         {"name": s, "lat": "", "lng": ""} for s in r.get("stores", [])
     ])
@@ -1249,54 +3478,14 @@ def driver_nav(driver_name):
     all_stops = [{"name": "🏭 Lager (Uppsala)", "lat": wh_lat, "lng": wh_lng, "is_warehouse": True}]
     all_stops += store_objects
     all_stops += [{"name": "🏭 Lager (Uppsala)", "lat": wh_lat, "lng": wh_lng, "is_warehouse": True}]
-    stops_json  = json.dumps(all_stops, ensure_ascii=False)
-    driver_json = json.dumps(driver_name)
+    page_data = _page_data_json({"driver": driver_name, "stops": all_stops})
 
     return f"""<!DOCTYPE html>
 <html><head>
   <meta charset="UTF-8">
   <meta name="viewport" content="width=device-width,initial-scale=1,maximum-scale=1">
   <title>Navigering — {driver_name}</title>
-  <style>
-    *{{box-sizing:border-box;margin:0;padding:0}}
-    body{{font-family:-apple-system,BlinkMacSystemFont,sans-serif;background:#0f111a;color:#e0e6f0;min-height:100vh;display:flex;flex-direction:column}}
-    .header{{background:#161b27;border-bottom:1px solid #1e2d45;padding:14px 16px;display:flex;align-items:center;gap:10px}}
-    .back-btn{{color:#6b7a99;font-size:22px;text-decoration:none;line-height:1}}
-    .header-info .driver{{font-size:18px;font-weight:800;color:#fff}}
-    .header-info .meta{{font-size:12px;color:#6b7a99;margin-top:2px}}
-    .progress-bar{{height:5px;background:#1e2d45}}
-    .progress-fill{{height:100%;background:#f5a623;transition:width .4s ease}}
-    .main{{flex:1;padding:16px;display:flex;flex-direction:column;gap:12px}}
-    .status-label{{font-size:11px;color:#6b7a99;text-transform:uppercase;letter-spacing:1px;font-weight:600}}
-    .stop-card{{background:#161b27;border-radius:14px;border:2px solid #1e2d45;padding:18px}}
-    .stop-card.current-card{{border-color:#f5a623}}
-    .stop-card.next-card{{opacity:.8}}
-    .stop-badge{{font-size:11px;font-weight:700;text-transform:uppercase;letter-spacing:.8px;margin-bottom:6px}}
-    .current-badge{{color:#f5a623}}
-    .next-badge{{color:#6b7a99}}
-    .stop-number{{font-size:13px;color:#6b7a99;margin-bottom:4px}}
-    .stop-name{{font-size:26px;font-weight:800;color:#fff;line-height:1.2;word-break:break-word}}
-    .stop-name.warehouse{{font-size:20px;color:#8bc34a}}
-    .btn-nav{{display:flex;align-items:center;justify-content:center;gap:10px;width:100%;padding:18px;border:none;border-radius:12px;background:#1a73e8;color:#fff;font-size:17px;font-weight:700;cursor:pointer;text-decoration:none}}
-    .btn-nav:active{{background:#1558b0}}
-    .btn-arrived{{display:flex;align-items:center;justify-content:center;gap:10px;width:100%;padding:16px;border:none;border-radius:12px;background:#2d6a2d;color:#fff;font-size:16px;font-weight:700;cursor:pointer}}
-    .btn-arrived:active{{background:#1e4a1e}}
-    .btn-arrived.final{{background:#5a2d7a}}
-    .stop-list-section{{background:#161b27;border-radius:12px;overflow:hidden}}
-    .stop-list-title{{font-size:11px;color:#6b7a99;text-transform:uppercase;letter-spacing:1px;padding:12px 14px 8px;border-bottom:1px solid #1e2d45}}
-    .stop-item{{display:flex;align-items:center;padding:10px 14px;border-bottom:1px solid #1a2030;gap:10px}}
-    .stop-item:last-child{{border-bottom:none}}
-    .stop-item.done{{opacity:.35}}
-    .stop-item.active-item{{background:#1a2540}}
-    .item-num{{font-size:12px;color:#f5a623;font-weight:700;min-width:22px;text-align:right}}
-    .item-num.done-num{{color:#2d6a2d}}
-    .item-name{{font-size:14px;color:#e0e6f0;flex:1}}
-    .done-screen{{display:none;flex:1;flex-direction:column;align-items:center;justify-content:center;text-align:center;padding:32px 24px;gap:16px}}
-    .done-icon{{font-size:72px}}
-    .done-title{{font-size:28px;font-weight:800;color:#8bc34a}}
-    .done-sub{{font-size:15px;color:#6b7a99}}
-    .btn-reset{{padding:14px 28px;background:#333;color:#aaa;border:none;border-radius:8px;font-size:14px;cursor:pointer;margin-top:8px}}
-  </style>
+  <link rel="stylesheet" href="{_static_url('nav.css')}">
 </head>
 <body>
   <div class="header">
@@ -1340,66 +3529,8 @@ def driver_nav(driver_name):
     <div class="done-sub">Alla stopp besökta.<br>Bra jobbat, {driver_name}!</div>
     <button class="btn-reset" onclick="resetRoute()">↺ Börja om från lager</button>
   </div>
-<script>
-const DRIVER = {driver_json};
-const STOPS  = {stops_json};
-const KEY    = 'nav_v2_' + DRIVER;
-let curIdx = parseInt(localStorage.getItem(KEY) || '1', 10);
-if (isNaN(curIdx) || curIdx < 1 || curIdx >= STOPS.length) curIdx = 1;
-function save() {{ localStorage.setItem(KEY, curIdx); }}
-function openNav(e) {{
-  e.preventDefault();
-  const s = STOPS[curIdx];
-  let dest = (s.lat && s.lng) ? encodeURIComponent(s.lat + ',' + s.lng) : encodeURIComponent(s.name);
-  window.open('https://www.google.com/maps/dir/?api=1&destination=' + dest + '&travelmode=driving', '_blank');
-}}
-function markArrived() {{ curIdx++; save(); render(); window.scrollTo(0,0); }}
-function resetRoute() {{ curIdx = 1; save(); render(); }}
-function render() {{
-  if (curIdx >= STOPS.length) {{
-    document.getElementById('main-view').style.display   = 'none';
-    document.getElementById('done-screen').style.display = 'flex';
-    document.getElementById('prog-fill').style.width = '100%';
-    document.getElementById('header-meta').textContent = 'Rutten klar! 🎉';
-    return;
-  }}
-  document.getElementById('main-view').style.display   = 'flex';
-  document.getElementById('done-screen').style.display = 'none';
-  const pct = Math.round(((curIdx-1)/(STOPS.length-1))*100);
-  document.getElementById('prog-fill').style.width = pct + '%';
-  const stopsLeft = STOPS.length - 1 - curIdx;
-  document.getElementById('header-meta').textContent = 'Stopp ' + curIdx + ' av ' + (STOPS.length-1) + ' · ' + stopsLeft + ' kvar';
-  const cur = STOPS[curIdx];
-  document.getElementById('cur-num').textContent = (curIdx===STOPS.length-1) ? 'Slutdestination' : 'Stopp ' + curIdx;
-  const curNameEl = document.getElementById('cur-name');
-  curNameEl.textContent = cur.name;
-  curNameEl.className = 'stop-name' + (cur.is_warehouse ? ' warehouse' : '');
-  document.getElementById('nav-btn-text').textContent = 'Navigera till ' + cur.name;
-  const arrivedBtn = document.getElementById('btn-arrived');
-  if (curIdx === STOPS.length-1) {{
-    arrivedBtn.textContent = '🏁 Framme på lagret — avsluta rutten';
-    arrivedBtn.className = 'btn-arrived final';
-  }} else {{
-    arrivedBtn.textContent = '✅ Framme — nästa stopp';
-    arrivedBtn.className = 'btn-arrived';
-  }}
-  const nextIdx = curIdx + 1;
-  const nextCard = document.getElementById('next-card');
-  if (nextIdx < STOPS.length) {{
-    document.getElementById('nxt-num').textContent = (nextIdx===STOPS.length-1) ? 'Slutdestination' : 'Stopp ' + nextIdx;
-    document.getElementById('nxt-name').textContent = STOPS[nextIdx].name;
-    nextCard.style.display = 'block';
-  }} else {{ nextCard.style.display = 'none'; }}
-  document.getElementById('stop-list-items').innerHTML = STOPS.slice(1).map((s,i) => {{
-    const idx=i+1; const isDone=idx<curIdx; const isNow=idx===curIdx;
-    return '<div class="stop-item'+(isDone?' done':'')+(isNow?' active-item':'')+'">'
-      +'<span class="item-num'+(isDone?' done-num':'')+'">'+( isDone?'✓':idx)+'</span>'
-      +'<span class="item-name">'+s.name+'</span>'
-      +(isNow?'<span style="color:#f5a623">▶</span>':'')+'</div>';
-  }}).join('');
-}}
-render();
-</script>
+<script id="page-data" type="application/json">{page_data}</script>
+<script src="{_static_url('nav.js')}"></script>
 </body></html>"""
 
 
@@ -1414,6 +3545,9 @@ def api_reorder(driver_name):
     锁定的门店通过 locked_indices 传入 optimize_route，被纳入完整 N×N 距离矩阵。
     OR-Tools 在感知所有门店地理位置的前提下，通过序列维度约束保持锁定门店的
     相对顺序，同时全局优化未锁定门店的插入位置。
+
+    增量求解：矩阵从 route_matrix_for() 复用（不重新请求），当前顺序作为
+    初始解，只跑 "warm" 档的短时间改进。
     """
     if driver_name not in DRIVERS:
         return jsonify({"ok": False, "error": "Okänd chaufför"}), 404
@@ -1422,38 +3556,34 @@ def api_reorder(driver_name):
     if not store_list:
         return jsonify({"ok": False, "error": "Tom butikslista"}), 400
 
-    # ── Patch missing coordinates from source file ──────────────
-    # Happens when last_results.json was saved in old format without lat/lng.
-    needs_patch = any(
-        str(s.get("lat","")).strip() in ("","nan","None") or
-        str(s.get("lng","")).strip() in ("","nan","None")
-        for s in store_list
-    )
-    if needs_patch:
-        coord_dict = load_coord_dict()
-        patched = []
-        for s in store_list:
-            lat = str(s.get("lat","")).strip()
-            lng = str(s.get("lng","")).strip()
-            if lat in ("","nan","None") or lng in ("","nan","None"):
-                key = s.get("name","").strip().lower()
-                if key in coord_dict:
-                    s = {**s,
-                         "lat": str(coord_dict[key]["Latitude"]),
-                         "lng": str(coord_dict[key]["Longitude"])}
-                    print(f"[REORDER] Patched coords for '{s['name']}'")
-                else:
-                    print(f"[REORDER] WARNING: no coords found for '{s.get('name')}'")
-            patched.append(s)
-        store_list = patched
+    # ── 解析为 Store：坐标只在这里校验一次 ──────────────────────
+    # 缺坐标（旧格式 last_results.json 未保存 lat/lng）时从源文件补齐；
+    # 仍无法补齐的门店剔除并告警。锁定索引基于剔除后的列表。
+    coord_dict     = None
+    all_stores     = []
+    locked_indices = set()
+    for s in store_list:
+        store = Store.from_dict(s)
+        if store is None:
+            if coord_dict is None:
+                coord_dict = load_coord_dict()
+            c = coord_dict.get(str(s.get("name", "")).strip().lower())
+            store = c and Store.parse(s.get("name", ""), c["Latitude"], c["Longitude"])
+            if store:
+                print(f"[REORDER] Patched coords for '{store.name}'")
+            else:
+                print(f"[REORDER] WARNING: no coords found for '{s.get('name')}'")
+                continue
+        if s.get("locked"):
+            locked_indices.add(len(all_stores))
+        all_stores.append(store)
+
+    if not all_stores:
+        return jsonify({"ok": False, "error": "Inga butiker med giltiga koordinater"}), 400
 
-    # ── 收集锁定索引，剥离 locked 字段 ──────────────────────────
     # 锁定门店保持相对顺序的约束由 optimize_route / OR-Tools 处理，
     # 此处不再做任何手工拆分或拼合。
-    locked_indices = {i for i, s in enumerate(store_list) if s.get("locked")}
-    all_stores = [{k: v for k, v in s.items() if k != "locked"} for s in store_list]
-
-    locked_names = [all_stores[i]["name"] for i in sorted(locked_indices)]
+    locked_names = [all_stores[i].name for i in sorted(locked_indices)]
     print(f"[REORDER] {driver_name}: {len(all_stores)} 站 | "
           f"锁定 {len(locked_indices)} 站: {locked_names}")
 
@@ -1464,6 +3594,9 @@ def api_reorder(driver_name):
     optimized, stats_or_err = optimize_route(
         all_stores,
         locked_indices=locked_indices if locked_indices else None,
+        fleet_matrix=route_matrix_for(driver_name, all_stores),
+        profile="warm",
+        warm_start=True,
     )
 
     if not optimized:
@@ -1500,8 +3633,8 @@ def api_reorder(driver_name):
     # ── Update state ───────────────────────────────────────────
     r = state["results"].setdefault(driver_name, {})
     r["status"]        = "ok"
-    r["stores"]        = [s["name"] for s in final]
-    r["store_objects"] = final
+    r["stores"]        = [s.name for s in final]
+    r["store_objects"] = [s.to_dict() for s in final]
     r["store_count"]   = len(final)
     r["urls"]          = urls
     if stats:
@@ -1511,18 +3644,26 @@ def api_reorder(driver_name):
         r["duration"]      = f"{hours} h {mins} min" if hours > 0 else f"{mins} min"
         r["duration_sec"]  = dur_sec
         r["distance"]      = f"{stats['distance_km']} km"
-    elif not r.get("duration"):
-        r["duration"] = "—"
-        r["distance"] = "—"
-    save_state()
+        r["legs"]          = stats.get("legs")
+        if stats.get("solver"):
+            r["solver_metrics"] = stats["solver"]
+    else:
+        r.pop("legs", None)      # 顺序已变，旧的逐段数据不再对应
+        if not r.get("duration"):
+            r["duration"] = "—"
+            r["distance"] = "—"
+    save_state([driver_name])
+    bump_status_version([driver_name])
+    archive_routes({driver_name: r}, "reorder")
 
     return jsonify({
         "ok":     True,
-        "stores": final,
+        "stores": r["store_objects"],
         "urls":   urls,
         "duration": r.get("duration"),
         "distance": r.get("distance"),
         "locks_honored": locks_honored,
+        "solver_metrics": r.get("solver_metrics"),
         "warning": optimization_warning,
     })
 
@@ -1533,6 +3674,7 @@ def api_set_emails():
         if driver in driver_emails:
             driver_emails[driver] = str(addr).strip()
     save_emails()
+    bump_status_version()
     return jsonify({"ok": True})
 
 
@@ -1542,6 +3684,8 @@ def api_set_email_config():
     if "sender" in data:
         email_config["sender"] = data["sender"]
     save_email_config()
+    # 其他 worker 在版本变化时才重新读取 email_config.json
+    bump_status_version()
     return jsonify({"ok": True})
 
 
@@ -1558,30 +3702,34 @@ def api_send_email_one(driver_name):
     r = state["results"].get(driver_name)
     if not r or r.get("status") != "ok":
         return jsonify({"ok": False, "msg": "Inga rutter"}), 400
-    base = request.host_url.rstrip("/")
-    ok, msg = send_email_to_driver(driver_name, r, base)
-    print(f"[EMAIL] {driver_name}: ok={ok} msg={msg}")
-    return jsonify({"ok": ok, "msg": msg})
+    res = queue_emails([driver_name], request.host_url.rstrip("/"))[driver_name]
+    return jsonify(res), 202 if res["ok"] else 400
 
 
 @app.route("/api/send-email-all", methods=["POST"])
 def api_send_email_all():
-    results_out = {}
-    base = request.host_url.rstrip("/")
-    for driver in DRIVERS:
-        r = state["results"].get(driver)
-        if r and r.get("status") == "ok":
-            ok, msg = send_email_to_driver(driver, r, base)
-            results_out[driver] = {"ok": ok, "msg": msg}
-        else:
-            results_out[driver] = {"ok": False, "msg": "Inga rutter"}
-    return jsonify(results_out)
+    """只负责排队，立即返回 202；投递进度见 /api/email-status。"""
+    return jsonify(queue_emails(DRIVERS, request.host_url.rstrip("/"))), 202
+
+
+@app.route("/api/email-status")
+def api_email_status():
+    deliveries = load_deliveries()
+    pending = sum(1 for d in deliveries.values() if d["status"] in EMAIL_PENDING)
+    return jsonify({"deliveries": deliveries, "pending": pending})
 
 # ── 启动 ─────────────────────────────────────────────────────
-# 启动时始终加载状态和调度器（gunicorn 也需要）
-load_state()
-scheduler.start()
-reschedule(state["schedule_hour"], state["schedule_minute"])
+# 启动时始终加载状态（gunicorn 的每个 worker 也需要）；
+# 调度器只在拿到 leader 锁的进程中启动，其余进程在后台线程里等待接管。
+# spawn 出的求解子进程也会导入本模块，它们只做计算，跳过这一段。
+if multiprocessing.current_process().name == "MainProcess":
+    try:
+        init_history_db()
+    except sqlite3.Error as e:
+        print(f"[HISTORY] ✗ 初始化历史库失败: {e}")
+    load_state()
+    _try_become_leader()
+    threading.Thread(target=_leader_loop, daemon=True).start()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5050))
@@ -0,0 +1,81 @@
+# ============================================================
+# fake_osrm.py — 本地 OSRM 替身（开发 / 测试用，不依赖 app.py）
+#
+# 实现 OSRM table / route 服务的请求/响应格式，用 Haversine 估算时间和距离，
+# 结果稳定可复现，便于离线调试和跑测试：
+#
+#   python fake_osrm.py                       # 默认监听 127.0.0.1:5001
+#   OSRM_BASE_URL=http://127.0.0.1:5001 python app.py
+# ============================================================
+from flask import Flask, jsonify, request
+import math, os
+
+app = Flask(__name__)
+
+SPEED_KMH     = float(os.environ.get("FAKE_OSRM_SPEED_KMH", "35"))
+DETOUR_FACTOR = float(os.environ.get("FAKE_OSRM_DETOUR", "1.35"))
+
+
+def _leg(a, b):
+    """a, b 为 (lng, lat)，返回 (秒, 米)。"""
+    R = 6371000
+    lng1, lat1 = a
+    lng2, lat2 = b
+    dphi = math.radians(lat2 - lat1)
+    dlam = math.radians(lng2 - lng1)
+    h = math.sin(dphi/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*math.sin(dlam/2)**2
+    dist_m = 2 * R * math.asin(math.sqrt(h)) * DETOUR_FACTOR
+    return round(dist_m / (SPEED_KMH / 3.6), 1), round(dist_m, 1)
+
+
+def _parse_coords(coords):
+    try:
+        return [tuple(float(v) for v in c.split(",")) for c in coords.split(";")]
+    except ValueError:
+        return None
+
+
+def _parse_indices(raw, n):
+    if not raw or raw == "all":
+        return list(range(n))
+    return [int(i) for i in raw.split(";")]
+
+
+@app.route("/table/v1/<profile>/<path:coords>")
+def table(profile, coords):
+    pts = _parse_coords(coords)
+    if not pts:
+        return jsonify({"code": "InvalidQuery", "message": "Query string malformed"}), 400
+    try:
+        sources      = _parse_indices(request.args.get("sources"), len(pts))
+        destinations = _parse_indices(request.args.get("destinations"), len(pts))
+    except ValueError:
+        return jsonify({"code": "InvalidQuery", "message": "Invalid sources/destinations"}), 400
+
+    annotations = request.args.get("annotations", "duration").split(",")
+    legs = [[_leg(pts[i], pts[j]) for j in destinations] for i in sources]
+    body = {"code": "Ok"}
+    if "duration" in annotations:
+        body["durations"] = [[d for d, _ in row] for row in legs]
+    if "distance" in annotations:
+        body["distances"] = [[m for _, m in row] for row in legs]
+    return jsonify(body)
+
+
+@app.route("/route/v1/<profile>/<path:coords>")
+def route(profile, coords):
+    pts = _parse_coords(coords)
+    if not pts or len(pts) < 2:
+        return jsonify({"code": "InvalidQuery", "message": "Query string malformed"}), 400
+    # 各段独立估算，相当于 continue_straight=false（与 table 的点对点值一致）
+    legs = [_leg(a, b) for a, b in zip(pts, pts[1:])]
+    return jsonify({"code": "Ok", "routes": [{
+        "duration": round(sum(d for d, _ in legs), 1),
+        "distance": round(sum(m for _, m in legs), 1),
+        "legs":     [{"duration": d, "distance": m, "steps": [], "summary": ""} for d, m in legs],
+    }]})
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 5001))
+    app.run(debug=False, host="127.0.0.1", port=port, use_reloader=False)
@@ -0,0 +1,104 @@
+# ============================================================
+# fake_resend.py — 本地 Resend 邮件 API 替身（开发 / 测试用，不依赖 app.py）
+#
+# 实现 POST /emails 和 POST /emails/batch 的请求/响应格式，不真正发信，
+# 收到的邮件保存在内存中，可通过 GET /sent 查看；可注入失败、延迟和格式错误的响应
+# （FAKE_RESEND_MALFORMED=1）测试重试和错误处理：
+#
+#   FAKE_RESEND_FAIL_RATE=0.3 python fake_resend.py    # 默认监听 127.0.0.1:5002
+#   EMAIL_API_URL=http://127.0.0.1:5002 RESEND_API_KEY=test python app.py
+# ============================================================
+from flask import Flask, jsonify, request
+import os, random, threading, time, uuid
+
+app = Flask(__name__)
+
+FAIL_RATE  = float(os.environ.get("FAKE_RESEND_FAIL_RATE", "0"))    # 随机返回 429 / 500 的概率
+LATENCY_MS = int(os.environ.get("FAKE_RESEND_LATENCY_MS", "50"))
+MALFORMED  = os.environ.get("FAKE_RESEND_MALFORMED", "0") == "1"   # 成功时返回非 JSON 的 200 响应
+BATCH_MAX  = 100
+
+sent      = []
+sent_lock = threading.Lock()
+
+
+def _error(code, name, message):
+    return jsonify({"statusCode": code, "name": name, "message": message}), code
+
+
+def _check_request():
+    """鉴权、延迟和随机失败；返回错误响应或 None。"""
+    time.sleep(LATENCY_MS / 1000)
+    if not request.headers.get("Authorization", "").startswith("Bearer "):
+        return _error(401, "missing_api_key", "Missing API key in the authorization header.")
+    if random.random() < FAIL_RATE:
+        if random.random() < 0.5:
+            resp = _error(429, "rate_limit_exceeded", "Too many requests.")
+            resp[0].headers["Retry-After"] = "1"
+            return resp
+        return _error(500, "internal_server_error", "An unexpected error occurred.")
+    return None
+
+
+def _ok(body):
+    if MALFORMED:
+        return "OK", 200, {"Content-Type": "text/plain"}
+    return jsonify(body)
+
+
+def _validate(email):
+    if not isinstance(email, dict) or not email.get("from") or not email.get("subject"):
+        return "Missing `from` or `subject` field."
+    to = email.get("to") or []
+    if isinstance(to, str):
+        to = [to]
+    if not to or any("@" not in addr for addr in to):
+        return "Invalid `to` field."
+    return None
+
+
+def _store(email):
+    email_id = str(uuid.uuid4())
+    with sent_lock:
+        sent.append({"id": email_id, "to": email.get("to"), "subject": email.get("subject"),
+                     "at": time.time()})
+    return email_id
+
+
+@app.route("/emails", methods=["POST"])
+def send_email():
+    err = _check_request()
+    if err:
+        return err
+    email = request.get_json(silent=True)
+    problem = _validate(email)
+    if problem:
+        return _error(422, "validation_error", problem)
+    return _ok({"id": _store(email)})
+
+
+@app.route("/emails/batch", methods=["POST"])
+def send_batch():
+    err = _check_request()
+    if err:
+        return err
+    emails = request.get_json(silent=True)
+    if not isinstance(emails, list) or not 1 <= len(emails) <= BATCH_MAX:
+        return _error(422, "validation_error", f"Batch must contain 1-{BATCH_MAX} emails.")
+    # 与 Resend 默认行为一致：任何一封无效则整批拒绝
+    for i, email in enumerate(emails):
+        problem = _validate(email)
+        if problem:
+            return _error(422, "validation_error", f"emails[{i}]: {problem}")
+    return _ok({"data": [{"id": _store(e)} for e in emails]})
+
+
+@app.route("/sent")
+def list_sent():
+    with sent_lock:
+        return jsonify(sent)
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 5002))
+    app.run(debug=False, host="127.0.0.1", port=port, use_reloader=False, threaded=True)
@@ -0,0 +1,24 @@
+# ============================================================
+# gunicorn.conf.py — 多 worker 部署（Procfile: gunicorn -c gunicorn.conf.py app:app）
+#
+# 各 worker 通过 SQLite 状态库（STATE_DB_FILE）共享路线结果、版本号、
+# running 标记和生成任务；定时任务只在拿到 SCHEDULER_LOCK_FILE 锁的 worker 中运行。
+# ============================================================
+import os
+
+bind    = f"0.0.0.0:{os.environ.get('PORT', '5050')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+
+# 生成进度使用 SSE 长连接，每条连接占用一个线程，因此用 gthread 而不是 sync worker
+worker_class = "gthread"
+threads      = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+# 手动生成在后台线程中运行，请求本身很快；timeout 只需覆盖导出等较慢的请求
+timeout          = 120
+graceful_timeout = 30
+
+# 不预加载：每个 worker 自己导入 app，各自加载状态、竞争调度 leader 锁
+# （预加载会在 master 进程里启动调度器，fork 出的 worker 之间再共享它）
+preload_app = False
+
+accesslog = "-"
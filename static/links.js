@@ -0,0 +1,159 @@
+// /links/<driver> — page data comes from <script id="page-data"> (JSON)
+// ── State ──────────────────────────────────────────────────────
+const PAGE   = JSON.parse(document.getElementById('page-data').textContent);
+const DRIVER = PAGE.driver;
+let stores   = PAGE.stores;
+let locked   = new Set();   // Set of 0-indexed locked positions (in current order)
+let dragSrcIdx = null;
+
+// ── Render ─────────────────────────────────────────────────────
+function render() {
+  const list = document.getElementById('stop-list');
+  list.innerHTML = '';
+  stores.forEach((s, i) => {
+    const isLocked = locked.has(i);
+    const row = document.createElement('div');
+    row.className = 'stop-row' + (isLocked ? ' locked-row' : '');
+    row.draggable = true;
+    row.dataset.idx = i;
+    row.innerHTML = `
+      <span class="drag-handle">⠿</span>
+      <span class="stop-num">${i+1}</span>
+      <span class="stop-name">${s.name}${isLocked ? '<span class="locked-badge">🔒 LÅST</span>' : ''}</span>
+      <button class="btn-up" onclick="moveUp(${i})" ${i===0?'disabled':''}>▲</button>
+      <button class="btn-dn" onclick="moveDown(${i})" ${i===stores.length-1?'disabled':''}>▼</button>
+      <button class="btn-lock" onclick="toggleLock(${i})" title="${isLocked?'Lås upp':'Lås position'}">${isLocked?'🔒':'🔓'}</button>
+    `;
+
+    // Drag events
+    row.addEventListener('dragstart', e => {
+      dragSrcIdx = i;
+      setTimeout(() => row.classList.add('dragging'), 0);
+    });
+    row.addEventListener('dragend', () => {
+      row.classList.remove('dragging');
+      document.querySelectorAll('.stop-row').forEach(r => r.classList.remove('drag-over'));
+    });
+    row.addEventListener('dragover', e => {
+      e.preventDefault();
+      document.querySelectorAll('.stop-row').forEach(r => r.classList.remove('drag-over'));
+      if (dragSrcIdx !== i) row.classList.add('drag-over');
+    });
+    row.addEventListener('drop', e => {
+      e.preventDefault();
+      if (dragSrcIdx !== null && dragSrcIdx !== i) {
+        moveToPos(dragSrcIdx, i);
+      }
+    });
+
+    list.appendChild(row);
+  });
+
+  // Show recalc bar only if any stop has been moved or locked
+  updateRecalcBar();
+}
+
+function updateRecalcBar() {
+  const bar = document.getElementById('recalc-bar');
+  bar.style.display = 'block';   // always show once panel is used
+}
+
+// ── Mutations ──────────────────────────────────────────────────
+function moveUp(i) {
+  if (i === 0) return;
+  swapStores(i, i-1);
+}
+function moveDown(i) {
+  if (i === stores.length-1) return;
+  swapStores(i, i+1);
+}
+function swapStores(a, b) {
+  // Remap locked positions
+  const newLocked = new Set();
+  locked.forEach(p => {
+    if (p===a) newLocked.add(b);
+    else if (p===b) newLocked.add(a);
+    else newLocked.add(p);
+  });
+  locked = newLocked;
+  [stores[a], stores[b]] = [stores[b], stores[a]];
+  render();
+}
+function moveToPos(from, to) {
+  const item = stores.splice(from, 1)[0];
+  stores.splice(to, 0, item);
+  // Rebuild locked set: shift indices
+  const arr = Array.from(locked);
+  const newLocked = new Set();
+  arr.forEach(p => {
+    if (p === from) { newLocked.add(to); return; }
+    let np = p;
+    if (from < to) { if (p > from && p <= to) np = p - 1; }
+    else           { if (p >= to && p < from) np = p + 1; }
+    newLocked.add(np);
+  });
+  locked = newLocked;
+  render();
+}
+function toggleLock(i) {
+  if (locked.has(i)) locked.delete(i);
+  else locked.add(i);
+  render();
+}
+
+// ── Recalculate ────────────────────────────────────────────────
+async function recalculate() {
+  const btn = document.getElementById('btn-recalc');
+  const status = document.getElementById('recalc-status');
+  btn.disabled = true;
+  btn.textContent = '⏳ Räknar om…';
+  status.textContent = '';
+
+  try {
+    // Embed locked flag on each store object for the backend
+    const payload = stores.map((s, i) => ({...s, locked: locked.has(i)}));
+    const resp = await fetch(`/api/reorder/${DRIVER}`, {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json'},
+      body: JSON.stringify({ stores: payload })
+    });
+    const data = await resp.json();
+    if (data.ok) {
+      stores = data.stores;
+      locked = new Set();   // reset locks after successful recalc
+      render();
+
+      // Update stats
+      document.getElementById('s-dur').textContent  = data.duration;
+      document.getElementById('s-dist').textContent = data.distance;
+
+      // Rebuild map buttons
+      const btns = document.getElementById('map-btns');
+      btns.innerHTML = data.urls.map((u,i) =>
+        `<a href="${u}" class="map-btn">🗺 Segment ${i+1} — Öppna i Google Maps</a>`
+      ).join('');
+
+      btn.textContent = '✅ Klar! Räkna om igen';
+      status.textContent = `Ny rutt: ${data.duration}, ${data.distance}`;
+      if (data.warning) {
+        status.textContent += ` (⚠️ API-fel vid optimering: ${data.warning})`;
+      }
+    } else {
+      btn.textContent = '🔄 Räkna om med låsta stopp';
+      status.textContent = '⚠️ Fel: ' + (data.error || data.msg || 'okänt fel');
+    }
+  } catch(e) {
+    btn.textContent = '🔄 Räkna om med låsta stopp';
+    status.textContent = '⚠️ Nätverksfel: ' + e.message;
+  }
+  btn.disabled = false;
+}
+
+// ── Init ───────────────────────────────────────────────────────
+render();
+// Show recalc bar only after user opens the stop panel
+document.getElementById('btn-recalc').closest('.recalc-bar').style.display = 'none';
+document.getElementById('toggle-btn').addEventListener('click', () => {
+  const open = document.getElementById('stop-panel').style.display === 'block';
+  document.getElementById('recalc-bar').style.display = open ? 'block' : 'none';
+});
@@ -0,0 +1,60 @@
+// /nav/<driver> — page data comes from <script id="page-data"> (JSON)
+const PAGE   = JSON.parse(document.getElementById('page-data').textContent);
+const DRIVER = PAGE.driver;
+const STOPS  = PAGE.stops;
+const KEY    = 'nav_v2_' + DRIVER;
+let curIdx = parseInt(localStorage.getItem(KEY) || '1', 10);
+if (isNaN(curIdx) || curIdx < 1 || curIdx >= STOPS.length) curIdx = 1;
+function save() { localStorage.setItem(KEY, curIdx); }
+function openNav(e) {
+  e.preventDefault();
+  const s = STOPS[curIdx];
+  let dest = (s.lat && s.lng) ? encodeURIComponent(s.lat + ',' + s.lng) : encodeURIComponent(s.name);
+  window.open('https://www.google.com/maps/dir/?api=1&destination=' + dest + '&travelmode=driving', '_blank');
+}
+function markArrived() { curIdx++; save(); render(); window.scrollTo(0,0); }
+function resetRoute() { curIdx = 1; save(); render(); }
+function render() {
+  if (curIdx >= STOPS.length) {
+    document.getElementById('main-view').style.display   = 'none';
+    document.getElementById('done-screen').style.display = 'flex';
+    document.getElementById('prog-fill').style.width = '100%';
+    document.getElementById('header-meta').textContent = 'Rutten klar! 🎉';
+    return;
+  }
+  document.getElementById('main-view').style.display   = 'flex';
+  document.getElementById('done-screen').style.display = 'none';
+  const pct = Math.round(((curIdx-1)/(STOPS.length-1))*100);
+  document.getElementById('prog-fill').style.width = pct + '%';
+  const stopsLeft = STOPS.length - 1 - curIdx;
+  document.getElementById('header-meta').textContent = 'Stopp ' + curIdx + ' av ' + (STOPS.length-1) + ' · ' + stopsLeft + ' kvar';
+  const cur = STOPS[curIdx];
+  document.getElementById('cur-num').textContent = (curIdx===STOPS.length-1) ? 'Slutdestination' : 'Stopp ' + curIdx;
+  const curNameEl = document.getElementById('cur-name');
+  curNameEl.textContent = cur.name;
+  curNameEl.className = 'stop-name' + (cur.is_warehouse ? ' warehouse' : '');
+  document.getElementById('nav-btn-text').textContent = 'Navigera till ' + cur.name;
+  const arrivedBtn = document.getElementById('btn-arrived');
+  if (curIdx === STOPS.length-1) {
+    arrivedBtn.textContent = '🏁 Framme på lagret — avsluta rutten';
+    arrivedBtn.className = 'btn-arrived final';
+  } else {
+    arrivedBtn.textContent = '✅ Framme — nästa stopp';
+    arrivedBtn.className = 'btn-arrived';
+  }
+  const nextIdx = curIdx + 1;
+  const nextCard = document.getElementById('next-card');
+  if (nextIdx < STOPS.length) {
+    document.getElementById('nxt-num').textContent = (nextIdx===STOPS.length-1) ? 'Slutdestination' : 'Stopp ' + nextIdx;
+    document.getElementById('nxt-name').textContent = STOPS[nextIdx].name;
+    nextCard.style.display = 'block';
+  } else { nextCard.style.display = 'none'; }
+  document.getElementById('stop-list-items').innerHTML = STOPS.slice(1).map((s,i) => {
+    const idx=i+1; const isDone=idx<curIdx; const isNow=idx===curIdx;
+    return '<div class="stop-item'+(isDone?' done':'')+(isNow?' active-item':'')+'">'
+      +'<span class="item-num'+(isDone?' done-num':'')+'">'+( isDone?'✓':idx)+'</span>'
+      +'<span class="item-name">'+s.name+'</span>'
+      +(isNow?'<span style="color:#f5a623">▶</span>':'')+'</div>';
+  }).join('');
+}
+render();
@@ -0,0 +1,108 @@
+# ============================================================
+# 测试公共夹具：启动本地替身服务（fake_osrm.py / fake_resend.py），
+# 并在导入 app 之前把所有状态文件指向临时目录，
+# 保证测试不联网、不改动仓库里的 last_results.json 等文件。
+# ============================================================
+import os, shutil, socket, subprocess, sys, tempfile, time
+
+import pytest
+
+ROOT    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP_DIR = tempfile.mkdtemp(prefix="routeops-tests-")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+OSRM_PORT   = _free_port()
+RESEND_PORT = _free_port()
+
+# app 在导入时读取环境变量，必须先设置好
+os.environ.update({
+    "OSRM_BASE_URL":       f"http://127.0.0.1:{OSRM_PORT}",
+    "EMAIL_API_URL":       f"http://127.0.0.1:{RESEND_PORT}",
+    "RESEND_API_KEY":      "test",
+    "EMAIL_BACKOFF_SEC":   "0.05",
+    "MATRIX_PROVIDER":     "osrm",
+    "MATRIX_CACHE_FILE":   os.path.join(TMP_DIR, "matrix_cache.sqlite3"),
+    "STATE_DB_FILE":       os.path.join(TMP_DIR, "state.sqlite3"),
+    "HISTORY_DB_FILE":     os.path.join(TMP_DIR, "history.sqlite3"),
+    "SCHEDULER_LOCK_FILE": os.path.join(TMP_DIR, "scheduler.lock"),
+})
+sys.path.insert(0, ROOT)
+
+
+def _start_fake(script, port, **env):
+    """在子进程中启动替身服务，等端口可连接后返回进程。"""
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, script)],
+        env={**os.environ, "PORT": str(port), **env},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"{script} 未能在端口 {port} 启动")
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    """导入 app（读取仓库里的 coords / routes / last_results.json），关闭定时任务。"""
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    import app
+    if app.scheduler.running:
+        app.scheduler.shutdown(wait=False)
+    yield app
+    os.chdir(cwd)
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def fake_osrm():
+    # 车速与 app 内置 Haversine 后端不同，便于区分矩阵来自哪个后端
+    proc = _start_fake("fake_osrm.py", OSRM_PORT, FAKE_OSRM_SPEED_KMH="50")
+    yield os.environ["OSRM_BASE_URL"]
+    proc.terminate()
+    proc.wait()
+
+
+@pytest.fixture(scope="session")
+def fake_resend():
+    proc = _start_fake("fake_resend.py", RESEND_PORT,
+                       FAKE_RESEND_FAIL_RATE="0.3", FAKE_RESEND_LATENCY_MS="5")
+    yield os.environ["EMAIL_API_URL"]
+    proc.terminate()
+    proc.wait()
+
+
+def _extra_resend(**env):
+    port = _free_port()
+    proc = _start_fake("fake_resend.py", port, FAKE_RESEND_LATENCY_MS="5", **env)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+@pytest.fixture
+def failing_resend():
+    """每个请求都返回 429 / 500 的邮件 API 替身，测试重试耗尽。"""
+    proc, url = _extra_resend(FAKE_RESEND_FAIL_RATE="1")
+    yield url
+    proc.terminate()
+    proc.wait()
+
+
+@pytest.fixture
+def malformed_resend():
+    """接受邮件但返回非 JSON 的 200 响应的邮件 API 替身。"""
+    proc, url = _extra_resend(FAKE_RESEND_MALFORMED="1")
+    yield url
+    proc.terminate()
+    proc.wait()
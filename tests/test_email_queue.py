@@ -0,0 +1,109 @@
+# 邮件发送队列：通过 fake_resend.py 端到端验证投递状态和尝试次数
+import time
+
+import pytest
+import requests
+
+DRIVERS_WITH_ADDRESS = ["Sarkis", "Cornelia", "Pawlos"]
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    conn = app_module._state_db_connect()
+    with conn:
+        conn.execute("DELETE FROM deliveries")
+    conn.close()
+    monkeypatch.setitem(app_module.driver_emails, "Abbe", "abbe-utan-snabel-a")   # 无效地址
+    monkeypatch.setitem(app_module.driver_emails, "Saman", "")                    # 未配置
+    for d in DRIVERS_WITH_ADDRESS:
+        monkeypatch.setitem(app_module.driver_emails, d, f"{d.lower()}@example.com")
+    return app_module.app.test_client()
+
+
+def _wait_for_deliveries(client, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        body = client.get("/api/email-status").get_json()
+        if body["pending"] == 0:
+            return body["deliveries"]
+        time.sleep(0.1)
+    pytest.fail(f"邮件队列 {timeout} 秒内未完成: {body}")
+
+
+def test_send_all_with_random_failures(app_module, client, fake_resend, monkeypatch):
+    # 30% 的请求随机返回 429 / 500；放宽尝试次数，避免偶发的重试耗尽
+    monkeypatch.setattr(app_module, "EMAIL_MAX_ATTEMPTS", 10)
+
+    resp = client.post("/api/send-email-all")
+    assert resp.status_code == 202
+    accepted = resp.get_json()
+    assert accepted["Saman"]["status"] == "skipped"
+    assert all(accepted[d]["status"] == "queued" for d in ["Abbe", *DRIVERS_WITH_ADDRESS])
+
+    deliveries = _wait_for_deliveries(client)
+
+    assert deliveries["Saman"]["status"] == "skipped"
+    # 批量请求因无效地址被整批拒绝后逐封重发，只有无效的那封失败
+    assert deliveries["Abbe"]["status"] == "failed"
+    assert "422" in deliveries["Abbe"]["msg"]
+    assert 1 <= deliveries["Abbe"]["attempts"] <= 10
+    for d in DRIVERS_WITH_ADDRESS:
+        assert deliveries[d]["status"] == "sent", deliveries[d]
+        assert 1 <= deliveries[d]["attempts"] <= 10
+        assert deliveries[d]["email_id"]
+
+    # 重试不会重复发信：每个有效地址恰好收到一封
+    sent = requests.get(f"{fake_resend}/sent", timeout=5).json()
+    received = [addr for e in sent for addr in e["to"]]
+    for d in DRIVERS_WITH_ADDRESS:
+        assert received.count(f"{d.lower()}@example.com") == 1
+
+
+def test_retries_exhausted(app_module, client, failing_resend, monkeypatch):
+    monkeypatch.setitem(app_module.HTTP_UPSTREAMS["email"], "base_url", failing_resend)
+    monkeypatch.setattr(app_module, "EMAIL_MAX_ATTEMPTS", 3)
+    monkeypatch.setitem(app_module.driver_emails, "Abbe", "abbe@example.com")
+
+    assert client.post("/api/send-email-all").status_code == 202
+    deliveries = _wait_for_deliveries(client)
+
+    assert deliveries["Saman"]["status"] == "skipped"
+    for d in ["Abbe", *DRIVERS_WITH_ADDRESS]:
+        assert deliveries[d]["status"] == "failed", deliveries[d]
+        assert deliveries[d]["attempts"] == 3
+        assert "429" in deliveries[d]["msg"] or "500" in deliveries[d]["msg"]
+
+
+def test_malformed_success_response(app_module, client, malformed_resend, monkeypatch):
+    monkeypatch.setitem(app_module.HTTP_UPSTREAMS["email"], "base_url", malformed_resend)
+    monkeypatch.setitem(app_module.driver_emails, "Abbe", "abbe@example.com")
+
+    assert client.post("/api/send-email-all").status_code == 202
+    deliveries = _wait_for_deliveries(client, timeout=20)
+
+    # 响应无法解析时不重试（邮件可能已经发出），直接记为 failed
+    for d in ["Abbe", *DRIVERS_WITH_ADDRESS]:
+        assert deliveries[d]["status"] == "failed", deliveries[d]
+        assert deliveries[d]["attempts"] == 1
+        assert "Ogiltigt svar" in deliveries[d]["msg"]
+
+
+def test_unexpected_errors_do_not_leave_deliveries_pending(app_module, client, monkeypatch):
+    def boom(*args, **kwargs):
+        raise RuntimeError("trasig")
+
+    real_html = app_module.build_email_html
+    monkeypatch.setattr(app_module, "build_email_html",
+                        lambda driver, *a: boom() if driver == "Sarkis" else real_html(driver, *a))
+    monkeypatch.setattr(app_module, "_email_post", boom)
+
+    resp = client.post("/api/send-email-all")
+    assert resp.status_code == 202
+    assert resp.get_json()["Sarkis"]["status"] == "failed"
+    deliveries = _wait_for_deliveries(client, timeout=20)
+
+    assert deliveries["Sarkis"]["status"] == "failed"
+    assert "trasig" in deliveries["Sarkis"]["msg"]
+    for d in ["Abbe", "Cornelia", "Pawlos"]:
+        assert deliveries[d]["status"] == "failed", deliveries[d]
+        assert "Internt fel" in deliveries[d]["msg"]
@@ -0,0 +1,64 @@
+# 导出：停靠点的时间 / 距离来自结果中保存的 legs，导出时不访问 OSRM
+import csv
+import io
+
+import openpyxl
+import pytest
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    app = app_module
+    monkeypatch.setattr(app, "MATRIX_PROVIDER", "haversine")
+    stores = [app.Store.parse(f"Butik {i}", 59.82 + 0.011 * i, 17.60 + 0.017 * (i % 3))
+              for i in range(5)]
+    with_legs = app._driver_result("Abbe", [], *app.optimize_route(stores))
+    legacy = dict(with_legs)            # 旧格式结果：没有 legs
+    del legacy["legs"]
+    monkeypatch.setitem(app.state, "results", {"Abbe": with_legs, "Saman": legacy})
+
+    def no_network(*args, **kwargs):
+        raise AssertionError("导出不应请求路线数据")
+
+    monkeypatch.setattr(app, "_route_legs", no_network)
+    monkeypatch.setattr(app, "http_request", no_network)
+    return app.app.test_client()
+
+
+def _csv_rows(client):
+    resp = client.get("/api/export?format=csv")
+    assert resp.status_code == 200
+    return list(csv.DictReader(io.StringIO(resp.get_data(as_text=True).lstrip("﻿"))))
+
+
+def test_csv_uses_stored_legs(app_module, client):
+    r = app_module.state["results"]["Abbe"]
+    rows = [row for row in _csv_rows(client) if row["driver"] == "Abbe"]
+
+    assert [int(row["position"]) for row in rows] == list(range(r["store_count"] + 2))
+    assert rows[0]["store"] == rows[-1]["store"] == app_module.WAREHOUSE.name
+    assert [row["store"] for row in rows[1:-1]] == r["stores"]
+    legs = [(float(row["leg_sec"]), float(row["leg_m"])) for row in rows[1:]]
+    assert legs == [tuple(leg) for leg in r["legs"]]
+    assert abs(float(rows[-1]["cum_sec"]) - r["duration_sec"]) <= 1
+
+
+def test_results_without_legs_export_order_only(client):
+    rows = [row for row in _csv_rows(client) if row["driver"] == "Saman"]
+    assert len(rows) == 7
+    assert all(row["leg_sec"] == "" and row["cum_sec"] == "" for row in rows)
+
+
+def test_xlsx_keeps_row_heights(app_module, client):
+    resp = client.get("/api/export")
+    assert resp.status_code == 200
+    wb = openpyxl.load_workbook(io.BytesIO(resp.data))
+
+    ws = wb["Route Links"]
+    assert ws.row_dimensions[1].height == 22
+    assert all(ws.row_dimensions[ri].height == 30 for ri in range(2, len(app_module.DRIVERS) + 2))
+
+    ws = wb["Abbe"]
+    r = app_module.state["results"]["Abbe"]
+    assert ws.max_row == r["store_count"] + 3          # 表头 + 仓库出发 + 门店 + 返回仓库
+    assert ws.cell(row=ws.max_row, column=7).value == round(sum(t for t, _ in r["legs"]) / 60, 1)
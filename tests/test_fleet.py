@@ -0,0 +1,133 @@
+# 车队 VRP：上限参数校验、放弃门店、相对路线表分配的 makespan，以及后台 job
+import math
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MATRIX_PROVIDER", "haversine")
+    return app_module.app.test_client()
+
+
+def _line_matrix(positions):
+    """一维坐标上的对称秒数矩阵，节点 0 为仓库。"""
+    return [[abs(a - b) for b in positions] for a in positions]
+
+
+def _route_sec(matrix, route):
+    nodes = [0, *route, 0]
+    return sum(matrix[a][b] for a, b in zip(nodes, nodes[1:]))
+
+
+def _wait_job(client, job_id, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f"/api/jobs/{job_id}").get_json()
+        if job["status"] != "running":
+            return job
+        time.sleep(0.1)
+    pytest.fail(f"job {job_id} {timeout} 秒内未结束")
+
+
+@pytest.mark.parametrize("value", [0, -3, "-1", math.nan, "nan", math.inf, True, False, "abc",
+                                   [5], 0.001, {"Abbe": 0}, {"Abbe": True}, {"Okänd": 5}])
+def test_invalid_limits_are_rejected(app_module, value):
+    with pytest.raises(ValueError):
+        app_module._parse_fleet_limit(value, "max_stops", 1)
+
+
+def test_valid_limits(app_module):
+    parse = app_module._parse_fleet_limit
+    assert parse(None, "max_stops", 1) is None
+    assert parse(25, "max_stops", 1) == 25
+    assert parse("6.5", "max_duration_min", 60) == 390
+    assert parse({"Abbe": 4, "Saman": None}, "max_stops", 1) == {"Abbe": 4}
+    assert parse({"Saman": None}, "max_stops", 1) is None
+
+
+@pytest.mark.parametrize("body", [
+    '{"max_stops": 0}',
+    '{"max_stops": -5}',
+    '{"max_duration_min": NaN}',
+    '{"max_duration_min": true}',
+    '{"max_stops": {"Okänd": 5}}',
+    '{"objective": "kortast"}',
+])
+def test_rebalance_rejects_bad_input(client, body):
+    resp = client.post("/api/fleet/rebalance", data=body, content_type="application/json")
+    assert resp.status_code == 400
+    assert resp.get_json()["error"]
+
+
+def test_vrp_beats_unbalanced_baseline(app_module):
+    # 第一辆车拿了全部四个门店，第二辆车空着
+    matrix = _line_matrix([0, 100, 200, -100, -200])
+    baseline = [[1, 2, 3, 4], []]
+    before = max(_route_sec(matrix, r) for r in baseline)
+
+    routes, dropped, _ = app_module._ortools_vrp(matrix, baseline)
+    assert dropped == []
+    assert sorted(n for r in routes for n in r) == [1, 2, 3, 4]
+    assert max(_route_sec(matrix, r) for r in routes) <= before
+    assert max(_route_sec(matrix, r) for r in routes) == 400      # 各走一侧
+
+
+def test_vrp_drops_stores_that_do_not_fit(app_module):
+    matrix = _line_matrix([0, 100, 200, -100, -200])
+    routes, dropped, _ = app_module._ortools_vrp(matrix, [[1, 2], [3, 4]], max_stops=[1, 1])
+    assert all(len(r) <= 1 for r in routes)
+    assert len(dropped) == 2
+    assert sorted([*dropped, *(n for r in routes for n in r)]) == [1, 2, 3, 4]
+
+
+def test_rebalance_runs_as_background_job(app_module, client):
+    resp = client.post("/api/fleet/rebalance", json={"max_stops": 3})
+    assert resp.status_code == 202
+    job_id = resp.get_json()["job_id"]
+
+    job = _wait_job(client, job_id)
+    assert job["trigger"] == "fleet" and job["status"] == "done", job["error"]
+    assert [ev["event"] for ev in job["events"]] == ["started", "matrix", "solving", "done"]
+
+    report = job["events"][-1]["report"]
+    assert all(r["store_count"] <= 3 for r in report["rebalanced"].values())
+    placed = sum(r["store_count"] for r in report["rebalanced"].values())
+    assert report["unassigned"] and placed + len(report["unassigned"]) == report["solver"]["nodes"] - 1
+
+    # 生成看板只跟随生成任务
+    kinds = client.get("/api/jobs?trigger=manual,scheduled").get_json()["jobs"]
+    assert all(j["trigger"] != "fleet" for j in kinds)
+
+
+def test_rebalance_failure_fails_the_job(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "rebalance_fleet",
+                        lambda *a, **k: {"error": "Avståndsmatris kunde inte hämtas"})
+    job_id = client.post("/api/fleet/rebalance", json={}).get_json()["job_id"]
+    job = _wait_job(client, job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "Avståndsmatris kunde inte hämtas"
+
+    def boom(*a, **k):
+        raise RuntimeError("trasig")
+
+    monkeypatch.setattr(app_module, "rebalance_fleet", boom)
+    job = _wait_job(client, client.post("/api/fleet/rebalance", json={}).get_json()["job_id"])
+    assert job["status"] == "failed" and "trasig" in job["error"]
+
+
+def test_one_rebalance_at_a_time(app_module, client, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(app_module, "rebalance_fleet",
+                        lambda *a, **k: release.wait(10) and {"objective": "makespan"})
+    first = client.post("/api/fleet/rebalance", json={}).get_json()["job_id"]
+    try:
+        resp = client.post("/api/fleet/rebalance", json={})
+        assert resp.status_code == 409
+        assert resp.get_json()["job_id"] == first
+    finally:
+        release.set()
+    assert _wait_job(client, first)["status"] == "done"
+    assert client.post("/api/fleet/rebalance", json={}).status_code == 202
@@ -0,0 +1,141 @@
+# 历史归档：归档失败不影响生成 / reorder，查询和导出与 /api/export 口径一致
+import copy
+import csv
+import io
+
+import pytest
+
+
+def _boom(*args, **kwargs):
+    raise KeyError("trasig rad")
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MATRIX_PROVIDER", "haversine")
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def history(app_module, tmp_path, monkeypatch):
+    """每个测试一个空的历史库。"""
+    monkeypatch.setattr(app_module, "HISTORY_DB_FILE", str(tmp_path / "history.sqlite3"))
+    app_module.init_history_db()
+    return app_module
+
+
+def _result(app, n, seed=0):
+    stores = [app.Store.parse(f"Butik {seed}-{i}", 59.82 + 0.011 * i, 17.60 + 0.017 * ((i + seed) % 4))
+              for i in range(n)]
+    return app._driver_result("Test", [], *app.optimize_route(stores))
+
+
+def _csv(resp):
+    assert resp.status_code == 200
+    return list(csv.DictReader(io.StringIO(resp.get_data(as_text=True).lstrip("\ufeff"))))
+
+
+def test_archive_errors_do_not_fail_generation(app_module, monkeypatch):
+    results = copy.deepcopy(app_module.state["results"])
+    monkeypatch.setattr(app_module, "run_all_drivers", lambda progress=None: results)
+    monkeypatch.setattr(app_module, "export_state_json", lambda: None)
+    monkeypatch.setattr(app_module, "_stop_rows_for", _boom)
+
+    job = app_module._new_job("manual")
+    app_module.do_generate(job)
+    assert job["status"] == "done", job["error"]
+
+
+def test_archive_errors_do_not_fail_reorder(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "_stop_rows_for", _boom)
+    stores = app_module.state["results"]["Pawlos"]["store_objects"]
+
+    resp = client.post("/api/reorder/Pawlos", json={"stores": stores})
+    assert resp.status_code == 200
+    assert resp.get_json()["ok"]
+
+
+def test_history_export_matches_current_export(app_module, history, client, monkeypatch):
+    monkeypatch.setitem(app_module.state, "results", {"Abbe": _result(app_module, 5)})
+    monkeypatch.setitem(app_module.state, "generated_at", "2026-10-18T05:00:00Z")
+    app_module.archive_routes(app_module.state["results"], "generate")
+
+    current = _csv(client.get("/api/export?format=csv"))
+    archived = _csv(client.get("/api/history/export?days=1"))
+    assert archived == current
+    assert archived[0]["generated_at"] == "2026-10-18T05:00:00Z"
+    assert archived[0]["position"] == "0" and archived[-1]["position"] == "6"
+
+
+def _route(app, names, duration_sec):
+    """只有门店顺序的最小结果（无 legs），用于第一站统计。"""
+    stores = [app.Store.parse(name, 59.80 + 0.01 * i, 17.60).to_dict() for i, name in enumerate(names)]
+    return {"status": "ok", "store_objects": stores, "store_count": len(stores),
+            "duration_sec": duration_sec}
+
+
+def _archive_on(app, monkeypatch, days_ago, results, source="generate"):
+    """以 days_ago 天前的本地日期归档。"""
+    real = app._local_day
+    with monkeypatch.context() as m:
+        m.setattr(app, "_local_day", lambda d=0: real(d + days_ago))
+        app.archive_routes(results, source)
+
+
+def test_last_route_per_day_counts_once(history, client, monkeypatch):
+    app = history
+    _archive_on(app, monkeypatch, 1, {"Abbe": _route(app, ["A", "B", "C", "D", "E"], 5000)})
+    _archive_on(app, monkeypatch, 1, {"Abbe": _route(app, ["C", "A", "B"], 3000)}, "reorder")
+    _archive_on(app, monkeypatch, 0, {"Abbe": _route(app, ["B", "A", "D", "C"], 4000)})
+
+    summary = client.get("/api/history/drivers?days=7").get_json()["drivers"]
+    assert summary["Abbe"]["days"] == 2
+    assert summary["Abbe"]["avg_stores"] == 3.5                  # 3（reorder 后）和 4
+    assert summary["Abbe"]["min_duration_sec"] == 3000
+
+    rows = _csv(client.get("/api/history/export?days=7"))
+    assert len(rows) == (3 + 2) + (4 + 2)
+    assert [r["store"] for r in rows[1:4]] == ["C", "A", "B"]
+
+
+def test_driver_summary_aggregates(history, client, monkeypatch):
+    app = history
+    abbe = [_result(app, 4, seed=1), _result(app, 6, seed=2)]
+    saman = _result(app, 5, seed=3)
+    _archive_on(app, monkeypatch, 2, {"Abbe": abbe[0], "Saman": saman})
+    _archive_on(app, monkeypatch, 0, {"Abbe": abbe[1]})
+
+    summary = client.get("/api/history/drivers?days=7").get_json()["drivers"]
+    durations = [r["duration_sec"] for r in abbe]
+    assert summary["Abbe"] == {
+        "days":             2,
+        "avg_duration_sec": round(sum(durations) / 2),
+        "min_duration_sec": min(durations),
+        "max_duration_sec": max(durations),
+        "avg_stores":       5.0,
+        "avg_distance_km":  round(sum(round(sum(m for _, m in r["legs"])) for r in abbe) / 2 / 1000, 1),
+    }
+    assert summary["Saman"]["days"] == 1
+
+    # days=1 只含今天；driver 过滤只返回该司机
+    assert set(client.get("/api/history/drivers?days=1").get_json()["drivers"]) == {"Abbe"}
+    assert set(client.get("/api/history/drivers?days=7&driver=Saman").get_json()["drivers"]) == {"Saman"}
+
+
+def test_first_stop_share_for_store(history, client, monkeypatch):
+    app = history
+    _archive_on(app, monkeypatch, 2, {"Abbe": _route(app, ["Ica", "Coop"], 100),
+                                      "Saman": _route(app, ["Coop", "Ica"], 100)})
+    _archive_on(app, monkeypatch, 1, {"Abbe": _route(app, ["Ica", "Willys"], 100)})
+    _archive_on(app, monkeypatch, 1, {"Abbe": _route(app, ["Willys", "Ica"], 100)}, "reorder")
+    _archive_on(app, monkeypatch, 0, {"Abbe": _route(app, ["Ica", "Coop"], 100)})
+
+    top = client.get("/api/history/first-stops?days=7").get_json()["first_stops"]
+    assert top == [{"store": "Ica", "count": 2}, {"store": "Coop", "count": 1},
+                   {"store": "Willys", "count": 1}]
+
+    body = client.get("/api/history/first-stops?days=7&store=Ica").get_json()
+    assert body["first_count"] == 2 and body["visit_count"] == 4
+    assert body["first_share"] == 0.5
+    assert body["by_driver"] == {"Abbe": {"first_count": 2, "visit_count": 3},
+                                 "Saman": {"first_count": 0, "visit_count": 1}}
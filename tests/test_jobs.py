@@ -0,0 +1,109 @@
+# 生成任务：事件顺序（矩阵在求解之前上报）、SSE 实时推送和按 Last-Event-ID 补发
+import json
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    app = app_module
+    monkeypatch.setattr(app, "MATRIX_PROVIDER", "haversine")
+    monkeypatch.setattr(app, "SOLVE_WORKERS", 1)
+    monkeypatch.setattr(app, "export_state_json", lambda: None)
+    # 生成会替换结果；测试结束后恢复，其他测试仍使用原来的结果
+    monkeypatch.setitem(app.state, "results", app.state["results"])
+    monkeypatch.setitem(app.state, "generated_at", app.state["generated_at"])
+    return app.app.test_client()
+
+
+def _sse(resp):
+    """解析 SSE 响应为事件列表（跳过保活注释）。"""
+    events = []
+    for block in resp.get_data(as_text=True).split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if fields:
+            ev = json.loads(fields["data"])
+            assert int(fields["id"]) == ev["seq"] and fields["event"] == ev["event"]
+            events.append(ev)
+    return events
+
+
+def _wait_job(client, job_id, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f"/api/jobs/{job_id}").get_json()
+        if job["status"] != "running":
+            return job
+        time.sleep(0.2)
+    pytest.fail(f"job {job_id} {timeout} 秒内未结束")
+
+
+def test_generation_job_lifecycle(app_module, client):
+    resp = client.post("/api/generate")
+    assert resp.status_code == 200
+    job_id = resp.get_json()["job_id"]
+    assert client.post("/api/generate").status_code == 409       # 同时只有一次生成
+
+    job = _wait_job(client, job_id)
+    assert job["status"] == "done", job["error"]
+    events = job["events"]
+    assert [ev["seq"] for ev in events] == list(range(1, len(events) + 1))
+    assert events[0]["event"] == "started" and events[-1]["event"] == "done"
+
+    ok = [d for d in app_module.DRIVERS if app_module.state["results"][d]["status"] == "ok"]
+    assert ok
+    for driver in ok:
+        kinds = [ev["event"] for ev in events if ev["driver"] == driver]
+        assert kinds == ["loaded", "matrix", "solved", "stats"], (driver, kinds)
+    # 矩阵在父进程中获取：所有 matrix 事件都在第一个 solved 之前
+    first_solved = min(ev["seq"] for ev in events if ev["event"] == "solved")
+    assert all(ev["seq"] < first_solved for ev in events if ev["event"] == "matrix")
+    assert job["progress"] == {d: "stats" for d in app_module.DRIVERS}
+
+    summary = client.get("/api/jobs?limit=1").get_json()["jobs"][0]
+    assert summary["id"] == job_id and "events" not in summary
+
+
+def _finished_job(app, n_drivers=3):
+    job = app._new_job("manual")
+    app._job_event(job, "started")
+    for d in app.DRIVERS[:n_drivers]:
+        app._job_event(job, "loaded", d, stores=1)
+    app._job_event(job, "done", generated_at="2026-10-18T05:00:00Z")
+    return job
+
+
+def test_sse_replays_after_last_event_id(app_module, client):
+    job = _finished_job(app_module)
+    url = f"/api/jobs/{job['id']}/events"
+
+    assert [ev["seq"] for ev in _sse(client.get(url))] == [1, 2, 3, 4, 5]
+    assert [ev["seq"] for ev in _sse(client.get(url, headers={"Last-Event-ID": "3"}))] == [4, 5]
+    assert [ev["seq"] for ev in _sse(client.get(url + "?after=4"))] == [5]
+    assert _sse(client.get(url, headers={"Last-Event-ID": "5"})) == []
+
+    # 其他 worker 运行的 job：只在状态库里，同样按 Last-Event-ID 补发
+    app_module.jobs.pop(job["id"])
+    replay = _sse(client.get(url, headers={"Last-Event-ID": "2"}))
+    assert [ev["event"] for ev in replay] == ["loaded", "loaded", "done"]
+
+    assert client.get("/api/jobs/finns-inte/events").status_code == 404
+
+
+def test_sse_streams_live_events(app_module, client):
+    job = app_module._new_job("manual")
+
+    def run():
+        for event, driver in [("started", None), ("loaded", "Abbe"), ("matrix", "Abbe")]:
+            time.sleep(0.05)
+            app_module._job_event(job, event, driver)
+        time.sleep(0.05)
+        app_module._job_event(job, "failed", error="trasig")
+
+    threading.Thread(target=run, daemon=True).start()
+    events = _sse(client.get(f"/api/jobs/{job['id']}/events"))
+    assert [ev["event"] for ev in events] == ["started", "loaded", "matrix", "failed"]
+    assert events[-1]["error"] == "trasig"
+    assert client.get(f"/api/jobs/{job['id']}").get_json()["status"] == "failed"
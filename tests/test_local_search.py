@@ -0,0 +1,85 @@
+# 内置局部搜索：合法排列、锁定位置、不劣于最近邻初始解；指标中的 engine 为实际使用的引擎
+import random
+
+import numpy as np
+import pytest
+
+
+def _matrix(n, seed, symmetric=True):
+    rnd = random.Random(seed)
+    pts = [(rnd.uniform(0, 20000), rnd.uniform(0, 20000)) for _ in range(n)]
+    m = [[((ax - bx) ** 2 + (ay - by) ** 2) ** 0.5 / 10 for bx, by in pts] for ax, ay in pts]
+    if not symmetric:       # 单行道 / 坡道：每个方向各自加一点
+        m = [[0 if i == j else v + rnd.uniform(0, 60) for j, v in enumerate(row)]
+             for i, row in enumerate(m)]
+    return m
+
+
+def _locks(n, seed, count):
+    rnd = random.Random(seed)
+    steps = rnd.sample(range(1, n), count)
+    nodes = rnd.sample(range(1, n), count)
+    return dict(zip(steps, nodes))
+
+
+CASES = [(n, seed, symmetric, locks)
+         for n, seed in [(5, 1), (12, 2), (30, 3), (60, 4)]
+         for symmetric in (True, False)
+         for locks in (0, 3)]
+
+
+@pytest.mark.parametrize("n,seed,symmetric,lock_count", CASES)
+def test_local_search_tour(app_module, n, seed, symmetric, lock_count):
+    app = app_module
+    matrix = _matrix(n, seed, symmetric)
+    locks = _locks(n, seed, lock_count) if lock_count else None
+
+    order = app._local_search_tsp(matrix, 0, locks, profile="interactive")
+    assert sorted(order) == list(range(1, n))
+    assert all(order[step - 1] == node for step, node in (locks or {}).items())
+
+    nn = app._nearest_neighbour_tour(np.asarray(matrix), 0, locks)
+    assert app._tour_cost(matrix, order) <= app._tour_cost(matrix, [int(x) for x in nn[1:]]) + 1e-6
+
+
+@pytest.mark.parametrize("start", [0, 4])
+def test_local_search_other_start(app_module, start):
+    matrix = _matrix(15, seed=9)
+    order = app_module._local_search_tsp(matrix, start, {2: 7}, profile="warm")
+    assert sorted([start, *order]) == list(range(15))
+    assert order[1] == 7
+
+
+def test_local_search_tiny_and_warm(app_module):
+    app = app_module
+    assert app._local_search_tsp([[0]], 0) == []
+    assert app._local_search_tsp([[0, 5], [5, 0]], 0) == [1]
+
+    matrix = _matrix(20, seed=5)
+    cold = app._local_search_tsp(matrix, 0, profile="interactive")
+    warm = app._local_search_tsp(matrix, 0, profile="warm", initial_order=list(range(19, 0, -1)))
+    assert sorted(warm) == list(range(1, 20))
+    assert app._tour_cost(matrix, warm) <= app._tour_cost(matrix, list(range(19, 0, -1)))
+    assert app._tour_cost(matrix, cold) <= app._tour_cost(matrix, app._greedy_tsp_from(matrix, 0))
+
+
+def test_metrics_report_engine_actually_used(app_module, monkeypatch):
+    from ortools.constraint_solver import pywrapcp
+
+    app = app_module
+    matrix = _matrix(12, seed=6)
+    monkeypatch.setattr(app, "TSP_ENGINE", "ortools")
+    assert app._solve_with_metrics(matrix, profile="warm")[2]["engine"] == "ortools"
+
+    monkeypatch.setattr(app, "TSP_ENGINE", "local")
+    assert app._solve_with_metrics(matrix, profile="warm")[2]["engine"] == "local"
+
+    def boom(*args, **kwargs):
+        raise RuntimeError("trasig")
+
+    # OR-Tools 出错时回退到局部搜索，指标如实记录
+    monkeypatch.setattr(app, "TSP_ENGINE", "ortools")
+    monkeypatch.setattr(pywrapcp, "RoutingIndexManager", boom)
+    order, honored, metrics = app._solve_with_metrics(matrix, profile="warm")
+    assert metrics["engine"] == "local"
+    assert sorted(order) == list(range(1, 12)) and honored
@@ -0,0 +1,176 @@
+# 距离矩阵：后端切换、OSRM 分块请求和坐标对缓存（通过 fake_osrm.py）
+import json
+
+import pytest
+
+
+def _stores(app, n):
+    """仓库附近 n 个稳定的测试坐标。"""
+    return [app.Store.parse(f"Butik {i}", 59.80 + 0.013 * i, 17.58 + 0.021 * ((i * 7) % n))
+            for i in range(n)]
+
+
+def _osrm_requests(app):
+    return app.http_stats().get("osrm", {}).get("requests", 0)
+
+
+@pytest.fixture
+def app(app_module, fake_osrm, tmp_path, monkeypatch):
+    # 每个测试一个空缓存
+    monkeypatch.setattr(app_module, "MATRIX_CACHE_FILE", str(tmp_path / "matrix_cache.sqlite3"))
+    monkeypatch.setattr(app_module, "MATRIX_PROVIDER", "osrm")
+    return app_module
+
+
+def test_provider_switch(app, tmp_path, monkeypatch):
+    points = [app.WAREHOUSE] + _stores(app, 6)
+    osrm  = app._osrm_table_request(points, points)
+    haver = app._distance_matrix_haversine(points, points)
+    assert osrm[0] and osrm != haver        # fake_osrm 的车速与内置 Haversine 不同
+
+    assert app._distance_matrix(points, points) == osrm
+
+    monkeypatch.setattr(app, "MATRIX_PROVIDER", "haversine")
+    before = _osrm_requests(app)
+    assert app._distance_matrix(points, points) == haver
+    assert _osrm_requests(app) == before
+
+    matrix_file = tmp_path / "matrix.json"
+    matrix_file.write_text(json.dumps({
+        "points":    [app._coord_key(p) for p in points],
+        "durations": [[i * 100 + j for j in range(len(points))] for i in range(len(points))],
+        "distances": [[i * 1000 + j for j in range(len(points))] for i in range(len(points))],
+    }))
+    monkeypatch.setattr(app, "MATRIX_PROVIDER", "file")
+    monkeypatch.setattr(app, "MATRIX_FILE", str(matrix_file))
+    monkeypatch.setitem(app._matrix_file_cache, "mtime_ns", None)
+    time_m, dist_m = app._distance_matrix(points[2:4], points[:3])
+    assert time_m == [[200, 201, 202], [300, 301, 302]]
+    assert dist_m == [[2000, 2001, 2002], [3000, 3001, 3002]]
+
+    monkeypatch.setattr(app, "MATRIX_PROVIDER", "nonsense")    # 未知后端退回 osrm
+    assert app._distance_matrix(points, points) == osrm
+
+
+def test_tiled_matrix_equals_single_request(app, monkeypatch):
+    origins      = [app.WAREHOUSE] + _stores(app, 9)
+    destinations = _stores(app, 13)[::-1]
+    single = app._osrm_table_request(origins, destinations)
+    assert single[0]
+
+    monkeypatch.setattr(app, "OSRM_MAX_TABLE_COORDS", 6)
+    before = _osrm_requests(app)
+    tiled = app._distance_matrix_osrm(origins, destinations)
+    assert _osrm_requests(app) - before > 1
+    assert tiled == single
+
+
+def test_pair_cache_hits_on_second_call(app):
+    points = [app.WAREHOUSE] + _stores(app, 8)
+    n = len(points) * len(points)
+
+    stats0 = app.matrix_cache_stats()
+    first = app._distance_matrix(points, points)
+    stats1 = app.matrix_cache_stats()
+    assert first[0]
+    assert stats1["misses"] - stats0["misses"] == n
+    assert stats1["fetches"] > stats0["fetches"]
+    assert stats1["entries"] == n
+
+    requests_before = _osrm_requests(app)
+    second = app._distance_matrix(points, points)
+    stats2 = app.matrix_cache_stats()
+    assert second == first
+    assert stats2["hits"] - stats1["hits"] == n
+    assert stats2["misses"] == stats1["misses"]
+    assert stats2["fetches"] == stats1["fetches"]
+    assert _osrm_requests(app) == requests_before
+
+
+def test_missing_pairs_fetched_in_one_block(app):
+    points = [app.WAREHOUSE] + _stores(app, 8)
+    first = app._distance_matrix(points, points)
+
+    # 每行缺的列都不同：仍然只发一次请求
+    keys = [app._coord_key(p) for p in points]
+    holes = [(keys[1], keys[2]), (keys[3], keys[5]), (keys[6], keys[0]), (keys[8], keys[7])]
+    conn = app._matrix_cache_connect()
+    with conn:
+        conn.executemany("DELETE FROM pairs WHERE src = ? AND dst = ?", holes)
+    conn.close()
+
+    stats0, requests0 = app.matrix_cache_stats(), _osrm_requests(app)
+    assert app._distance_matrix(points, points) == first
+    assert app.matrix_cache_stats()["fetches"] - stats0["fetches"] == 1
+    assert _osrm_requests(app) - requests0 == 1
+
+
+def test_unreachable_pairs_are_cached(app, monkeypatch):
+    points = [app.WAREHOUSE] + _stores(app, 4)
+    real_fetch = app._MATRIX_PROVIDERS["osrm"]
+    calls = []
+
+    def fetch(origins, destinations):
+        calls.append((len(origins), len(destinations)))
+        time_m, dist_m = real_fetch(origins, destinations)
+        time_m[-1][0] = 999999          # 最后一家门店回不到仓库
+        return time_m, dist_m
+
+    monkeypatch.setitem(app._MATRIX_PROVIDERS, "osrm", fetch)
+    first = app._distance_matrix(points, points)
+    assert first[0][-1][0] == 999999
+    assert app._distance_matrix(points, points) == first
+    assert len(calls) == 1
+
+
+@pytest.fixture
+def memo(app, monkeypatch):
+    """空的内存矩阵，当前生成为 gen-1。"""
+    monkeypatch.setattr(app, "_route_matrix_memo",
+                        {"generated_at": None, "pending": False, "fleet": None, "drivers": {}})
+    monkeypatch.setitem(app.state, "generated_at", "gen-1")
+    return app._route_matrix_memo
+
+
+def test_reorder_matrix_reused_within_generation(app, memo):
+    stores = _stores(app, 6)
+    first = app.route_matrix_for("Abbe", stores)
+    fetches = app.matrix_cache_stats()["fetches"]
+    assert app.route_matrix_for("Abbe", stores[::-1]) is first
+    assert app._route_legs([app.WAREHOUSE, *stores, app.WAREHOUSE])
+    assert app.matrix_cache_stats()["fetches"] == fetches
+
+
+def test_new_generation_drops_memo_and_uses_pair_cache(app, memo, monkeypatch):
+    stores = _stores(app, 6)
+    first = app.route_matrix_for("Abbe", stores)
+
+    # 其他 worker 重新生成：sync_state 带来新的 generated_at
+    monkeypatch.setitem(app.state, "generated_at", "gen-2")
+    stats0, requests0 = app.matrix_cache_stats(), _osrm_requests(app)
+    second = app.route_matrix_for("Abbe", stores)
+    assert second is not first
+    assert second["time"] == first["time"]
+    stats1 = app.matrix_cache_stats()
+    assert stats1["hits"] - stats0["hits"] == len(stores) ** 2 + 2 * len(stores) + 1
+    assert stats1["fetches"] == stats0["fetches"] and _osrm_requests(app) == requests0
+
+
+def test_memo_expires_with_cache_ttl(app, memo, monkeypatch):
+    stores = _stores(app, 5)
+    first = app.route_matrix_for("Abbe", stores)
+    assert app.route_matrix_for("Abbe", stores) is first
+
+    first["built_at"] -= app.MATRIX_CACHE_TTL + 1
+    assert app.route_matrix_for("Abbe", stores) is not first
+    assert "Abbe" in memo["drivers"] and memo["drivers"]["Abbe"] is not first
+
+
+def test_memo_kept_while_generation_pending(app, memo):
+    stores = _stores(app, 5)
+    fleet = app.build_fleet_matrix(stores)
+    memo.update(pending=True, fleet=fleet, drivers={})         # run_all_drivers 刚建好矩阵
+
+    assert app.route_matrix_for("Abbe", stores[:3]) is fleet    # 生成尚未结束：仍可复用
+    memo.update(pending=False, generated_at="gen-1")            # do_generate 结束
+    assert app.route_matrix_for("Abbe", stores[:3]) is fleet
@@ -0,0 +1,51 @@
+# 求解预算：按解数停止，小路线毫秒级返回，结果与 CPU 负载无关
+import random
+import time
+
+import pytest
+
+
+def _matrix(n, seed=7):
+    rnd = random.Random(seed)
+    pts = [(rnd.uniform(0, 20000), rnd.uniform(0, 20000)) for _ in range(n)]
+    return [[((ax - bx) ** 2 + (ay - by) ** 2) ** 0.5 / 10 for bx, by in pts] for ax, ay in pts]
+
+
+def _solve_ms(app, matrix, profile):
+    t0 = time.perf_counter()
+    order, _, _ = app._solve_tsp(matrix, profile=profile)
+    return order, (time.perf_counter() - t0) * 1000
+
+
+@pytest.mark.parametrize("profile", ["batch", "interactive", "warm"])
+@pytest.mark.parametrize("n", [10, 30])
+def test_solver_stops_well_before_time_limit(app_module, n, profile):
+    budget = app_module._solver_budget(n, profile)
+    assert budget["solution_limit"] and budget["stall_solutions"]
+
+    order, ms = _solve_ms(app_module, _matrix(n), profile)
+    assert sorted(order) == list(range(1, n))
+    # 按解数停止：正常负载下用不到时间上限的一半
+    assert ms < budget["time_limit_ms"] / 2, (n, profile, ms, budget)
+
+
+@pytest.mark.parametrize("n", [6, 10])
+def test_small_routes_return_in_milliseconds(app_module, n):
+    for profile in ("interactive", "warm"):
+        _, ms = _solve_ms(app_module, _matrix(n), profile)
+        assert ms < 100, (n, profile, ms)
+
+
+def test_solution_counts_do_not_grow_for_small_routes(app_module):
+    for profile in ("batch", "interactive", "warm", "fleet"):
+        small, medium = (app_module._solver_budget(n, profile) for n in (10, 40))
+        assert small["stall_solutions"] == medium["stall_solutions"]
+        assert small["time_limit_ms"] <= medium["time_limit_ms"]
+        assert small["time_limit_ms"] <= app_module.SOLVER_PROFILES[profile]["max_ms"]
+
+
+def test_same_matrix_same_route(app_module):
+    matrix = _matrix(25, seed=3)
+    first, _ = _solve_ms(app_module, matrix, "interactive")
+    second, _ = _solve_ms(app_module, matrix, "interactive")
+    assert first == second
@@ -0,0 +1,56 @@
+# /api/status：ETag / 304、since= 增量，reorder 后版本号递增
+import pytest
+
+
+@pytest.fixture
+def client(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "MATRIX_PROVIDER", "haversine")
+    return app_module.app.test_client()
+
+
+def _reorder(app, client, driver):
+    stores = app.state["results"][driver]["store_objects"]
+    resp = client.post(f"/api/reorder/{driver}", json={"stores": stores[::-1]})
+    assert resp.status_code == 200 and resp.get_json()["ok"]
+
+
+def test_matching_etag_returns_304(client):
+    resp = client.get("/api/status")
+    assert resp.status_code == 200
+    version = resp.get_json()["version"]
+    assert resp.headers["ETag"] == f'"{version}-summary"'
+    assert resp.headers["Cache-Control"] == "no-cache"
+
+    cached = client.get("/api/status", headers={"If-None-Match": resp.headers["ETag"]})
+    assert cached.status_code == 304 and cached.data == b""
+    assert cached.headers["ETag"] == resp.headers["ETag"]
+
+    # 视图不同 ETag 不同：summary 的 ETag 不能拿来验证 full
+    full = client.get("/api/status?view=full", headers={"If-None-Match": resp.headers["ETag"]})
+    assert full.status_code == 200 and full.headers["ETag"] == f'"{version}-full"'
+    assert "store_objects" in next(iter(full.get_json()["results"].values()))
+    assert client.get("/api/status", headers={"If-None-Match": '"0-summary"'}).status_code == 200
+
+
+def test_reorder_bumps_version_and_delta_has_only_changed_driver(app_module, client):
+    before = client.get("/api/status?view=full").get_json()
+    etag = f'"{before["version"]}-summary"'
+
+    _reorder(app_module, client, "Pawlos")
+
+    after = client.get("/api/status", headers={"If-None-Match": etag})
+    assert after.status_code == 200
+    body = after.get_json()
+    assert body["version"] > before["version"]
+
+    delta = client.get(f"/api/status?since={before['version']}").get_json()
+    assert delta["view"] == "delta"
+    assert list(delta["results"]) == ["Pawlos"]
+    assert delta["results"]["Pawlos"]["stores"] == app_module.state["results"]["Pawlos"]["stores"]
+    assert delta["versions"]["Pawlos"] == body["version"]
+    assert all(v <= before["version"] for d, v in delta["versions"].items() if d != "Pawlos")
+
+    # 已是最新版本：增量为空；版本号比当前还新时退回完整视图
+    assert client.get(f"/api/status?since={body['version']}").get_json()["results"] == {}
+    newer = client.get(f"/api/status?since={body['version'] + 1}").get_json()
+    assert newer["view"] == "full" and set(newer["results"]) == set(app_module.state["results"])